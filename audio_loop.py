@@ -18,14 +18,62 @@ Dependencies:
 
 Logging:
     - Logs are configured using `setup_logging()` and written to a file in the `logs` directory.
+      Importing this module has no side effects: the CLI calls `setup_logging()`, and GUI apps
+      that import `AudioLoop` should call it (or configure logging themselves) before running.
+
+Imports:
+    - cv2, mss, PIL and google.genai are imported lazily, only when the selected mode needs them,
+      so text-only use does not pay for loading them. `bench_import.py` guards this.
+
+Metrics:
+    - Stage latencies, message/byte counters, queue depths and playback underruns are recorded
+      in the `metrics` registry. Use `--metrics-port` to scrape them and `--metrics-json` to
+      dump them when the session ends.
+    - Event loop lag is measured continuously by `LoopWatchdog`; stalls longer than
+      `--stall-threshold` are written with the blocking stack to `logs/stalls_*.log`.
+    - `--trace FILE` records per-turn spans in Chrome trace/Perfetto JSON format.
+    - Send SIGUSR1 (or POST /control/profile on the metrics port) to toggle the sampling
+      profiler; collapsed stacks are written to `logs/profile_*.folded`.
+
+Video:
+    - Camera and screen frames are speech-gated by default (see `video_gate.py`): they are sent
+      while the user talks, at each turn start, and on request. A GUI requests a frame with
+      `loop.video_gate.request_frame()` or by queueing the text "/frame".
+      `--video-policy fixed` sends one every interval.
+
+Text:
+    - With a `response_cache.ResponseCache` (`--response-cache`), text mode with TEXT responses
+      answers prompts it has seen before locally: the cached answer is shown through
+      `display_text_callback` without a model turn.
 
 This implementation of AudioLoop() is meant to be imported into other porgrams that manage the GUI
 """
 
+import asyncio
+import base64
+import importlib
 import logging
 import os
-from datetime import datetime
 import time
+import traceback
+from datetime import datetime
+
+import audio_manager
+import audio_transcriber
+import bandwidth
+import frame_archive
+import frame_encoder
+import metrics
+import motion
+import profiler
+import response_cache
+import screen_capture
+import video_gate
+from loop_watchdog import LoopWatchdog
+from recorder import Recorder
+from tracing import TurnTracer
+
+logger = logging.getLogger(__name__)
 
 def setup_logging():
     """
@@ -55,23 +103,7 @@ def setup_logging():
     logger.info("Root logger configured with a FileHandler using UTF-8 encoding.")
     return logger
 
-logger = setup_logging()
-logger.info("audio_loop module loaded.")
-
-
-import asyncio
-import base64
-import io
-import traceback
-import cv2
-import pyaudio
-import PIL.Image
-import mss
-
-from dotenv import load_dotenv
-from google import genai
-
-FORMAT = pyaudio.paInt16
+FORMAT = audio_manager.PA_INT16
 CHANNELS = 1
 SEND_SAMPLE_RATE = 16000
 RECEIVE_SAMPLE_RATE = 24000
@@ -89,14 +121,22 @@ class AudioLoop:
     Attributes:
         user_input_queue (asyncio.Queue): A queue for receiving user messages.
         display_text_callback (callable): Callback function to handle text outputs.
-        pya (pyaudio.PyAudio): PyAudio instance for audio handling.
+        audio (AudioDeviceManager): Process-wide PyAudio/device manager shared by all sessions.
         audio_in_queue (asyncio.Queue): Queue for incoming audio responses.
         out_queue (asyncio.Queue): Queue for outgoing data streams.
-        audio_stream (pyaudio.Stream): PyAudio stream for microphone input.
+        audio_stream (ManagedStream): Stream for microphone input.
         session (AsyncSession): Live session object for communication with the AI model.
     """
+
+    # Report queue depths in the metrics registry; turned off where many sessions share a process.
+    watch_queues = True
         
-    def __init__(self, user_input_queue: asyncio.Queue, display_text_callback=None):
+    def __init__(self, user_input_queue: asyncio.Queue, display_text_callback=None, metrics_json=None,
+                 stall_threshold=0.2, trace_path=None, record_path=None, transcript_path=None,
+                 upload_budget=None, max_frame_bytes=None, video_policy=video_gate.DEFAULT_POLICY,
+                 camera_min_interval=motion.MIN_INTERVAL, camera_max_interval=motion.MAX_INTERVAL,
+                 focus_capture=False, capture_target=screen_capture.DEFAULT_TARGET, frame_archive_path=None,
+                 frame_archive_bytes=frame_archive.DEFAULT_MAX_BYTES, response_cache=None):
         """
         Initialize the AudioLoop instance.
 
@@ -105,17 +145,66 @@ class AudioLoop:
             display_text_callback (callable, optional): A callback function to display text responses.
                 This function should accept a single string argument. If not provided,
                 text output will be ignored. Defaults to a no-op function.
+            metrics_json (str, optional): Path the metrics registry is dumped to when the session ends.
+            stall_threshold (float, optional): Event loop stalls longer than this many seconds are
+                reported by a `LoopWatchdog`. Set to None or 0 to disable the watchdog.
+            trace_path (str, optional): File per-turn tracing spans are appended to.
+            record_path (str, optional): File the session is recorded to (see `recorder.py`).
+            transcript_path (str, optional): SQLite transcript database the session's text is
+                stored in (see `audio_transcriber.py`).
+            upload_budget (float, optional): Upload budget in bytes/s; video quality and frame rate
+                adapt to stay within it and within the measured link throughput (see `bandwidth.py`).
+            max_frame_bytes (int, optional): Largest encoded frame in bytes; quality is lowered per frame
+                to stay within it. Screen frames pick their codec by content (see `frame_encoder.py`).
+            video_policy (str, optional): "speech" sends frames only around user speech, at turn starts
+                and on request; "fixed" sends one every interval (see `video_gate.py`).
+            camera_min_interval (float, optional): Camera frame interval for a busy scene, in seconds.
+            camera_max_interval (float, optional): Camera frame interval for a still scene, in seconds;
+                the interval follows scene motion between the two (see `motion.py`).
+            focus_capture (bool, optional): Send a low-resolution overview of the screen plus a
+                full-resolution crop around the cursor or focused window (see `screen_focus.py`).
+            capture_target (str, optional): Screen area to capture: "all", a monitor number, "monitors"
+                (each monitor in parallel), "L,T,W,H" or "window:ID" (see `screen_capture.py`).
+            frame_archive_path (str, optional): Directory the sent frames are archived in, deduplicated
+                by content (see `frame_archive.py`).
+            frame_archive_bytes (int, optional): Size the frame archive is kept under.
+            response_cache (ResponseCache, optional): Answers repeated text prompts locally in text mode
+                with TEXT responses; sessions may share one (see `response_cache.py`).
         """
         logger.debug("Initializing AudioLoop...")
         self.audio_in_queue = None
         self.out_queue = None
         self.audio_stream = None
         self.session = None
+        self.metrics_json = metrics_json
+        self.stall_threshold = stall_threshold
+        self.tracer = TurnTracer(trace_path)
+        self.recorder = Recorder(record_path, {"variant": "audio_loop", "send_sample_rate": SEND_SAMPLE_RATE,
+                                               "receive_sample_rate": RECEIVE_SAMPLE_RATE})
+        self.transcript_path = transcript_path
+        self.transcript = audio_transcriber.Transcript()
+        self.frame_archive_path = frame_archive_path
+        self.frame_archive_bytes = frame_archive_bytes
+        self.frame_archive = frame_archive.FrameArchive()
+        self.governor = bandwidth.BandwidthGovernor(upload_budget)
+        self.camera_encoder = frame_encoder.JpegEncoder(max_frame_bytes)
+        self.camera_pacer = motion.MotionPacer(camera_min_interval, camera_max_interval)
+        # Grabs the capture target; regions whose pixels did not change are not resent
+        self.screen_capture = screen_capture.ScreenCapture(capture_target, max_frame_bytes, focus_capture)
+        self.video_gate = video_gate.VideoGate(video_policy)
+        self.response_cache = response_cache
+        # (model, config) cache keys are scoped to while the session's answers are cacheable
+        self._cache_scope = None
+        # Keys of the uncached prompts sent during the current turn, and the turn's text deltas
+        self._cache_pending = []
+        self._cache_deltas = []
+        # True while the model is streaming audio for the current turn
+        self._turn_active = False
 
         self.user_input_queue = user_input_queue
         self.display_text_callback = display_text_callback if display_text_callback else (lambda x: None)
 
-        self.pya = pyaudio.PyAudio()
+        self.audio = audio_manager.get_manager()
         logger.debug("AudioLoop initialized.")
 
     async def send_text(self):
@@ -132,9 +221,41 @@ class AudioLoop:
             if text.lower() == "q":
                 logger.info("User requested exit by sending 'q'.")
                 break
-            await self.session.send(text or ".", end_of_turn=True)
+            if text.strip() == video_gate.FRAME_COMMAND:
+                logger.info("User requested a video frame.")
+                self.video_gate.request_frame()
+                continue
+            if self._cache_scope is not None and text.strip():
+                key = response_cache.cache_key(text, *self._cache_scope)
+                deltas = self.response_cache.get(key)
+                if deltas is not None:
+                    await self._replay_cached(text, deltas)
+                    continue
+                self._cache_pending.append(key)
+            self.tracer.on_user_text(text)
+            self.recorder.text_out(text)
+            self.transcript.on_user_text(text)
+            send_start = time.monotonic()
+            with metrics.STAGE_SECONDS.labels("send").time():
+                await self.session.send(text or ".", end_of_turn=True)
+            self.tracer.on_upload(len(text), send_start)
+            metrics.MESSAGES_SENT.labels("text").inc()
+            metrics.BYTES_SENT.labels("text").inc(len(text))
+            self.video_gate.on_user_text(text)
             logger.debug("Text sent to session.")
 
+    async def _replay_cached(self, text, deltas):
+        """Show a cached answer to `text` as the text deltas it first arrived in, without a model turn."""
+        logger.info("Answering from the response cache.")
+        self.recorder.event("response_cache_hit", text=text)
+        self.transcript.on_user_text(text)
+        for delta in deltas:
+            self.transcript.on_text_delta(delta)
+            self.display_text_callback(delta)
+            # Let other tasks run between deltas, as they would between server messages
+            await asyncio.sleep(0)
+        self.transcript.on_turn_complete()
+
     def _get_frame(self, cap):
         """
         Captures a single frame from the given video capture device and converts it to a JPEG.
@@ -145,23 +266,26 @@ class AudioLoop:
         Returns:
             dict: A dictionary containing MIME type and Base64-encoded JPEG data.
         """
-        ret, frame = cap.read()
+        import cv2
+        import PIL.Image
+
+        with metrics.STAGE_SECONDS.labels("capture_video").time():
+            ret, frame = cap.read()
         if not ret:
             logger.warning("Failed to read frame from camera.")
             return None
+        self.camera_pacer.update(frame)
+        encode_start = time.perf_counter()
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         img = PIL.Image.fromarray(frame_rgb)
         original_size = img.size
-        img.thumbnail([1024, 1024])
-        logger.debug(f"Captured frame resized from {original_size} to {img.size}")
-
-        image_io = io.BytesIO()
-        img.save(image_io, format="jpeg")
-        image_io.seek(0)
-
-        image_bytes = image_io.read()
+        settings = self.governor.video_settings()
+        image_bytes = self.camera_encoder.encode(img, settings.max_size, settings.quality)
+        logger.debug(f"Captured frame resized from {original_size} to {self.camera_encoder.size}")
         logger.debug(f"Frame converted to JPEG of size {len(image_bytes)} bytes.")
-        return {"mime_type": "image/jpeg", "data": base64.b64encode(image_bytes).decode()}
+        frame_data = {"mime_type": "image/jpeg", "data": base64.b64encode(image_bytes).decode()}
+        metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+        return frame_data
 
     async def get_frames(self):
         """
@@ -171,6 +295,8 @@ class AudioLoop:
         adds them to the output queue until the task is cancelled or the camera is closed.
         """
         logger.info("Attempting to open camera...")
+        # cv2 is only needed in camera mode; load it off the event loop
+        cv2 = await asyncio.to_thread(importlib.import_module, "cv2")
         cap = await asyncio.to_thread(cv2.VideoCapture, 0)
         if not cap.isOpened():
             logger.error("Failed to open camera.")
@@ -180,6 +306,7 @@ class AudioLoop:
         frame_count = 0
         try:
             while True:
+                await self.video_gate.wait(self.camera_pacer.interval)
                 frame = await asyncio.to_thread(self._get_frame, cap)
                 if frame is None:
                     logger.warning("No more frames retrieved from camera.")
@@ -188,46 +315,35 @@ class AudioLoop:
                 if frame_count % 10 == 0:
                     logger.debug(f"Captured frame {frame_count}")
 
-                await asyncio.sleep(1.0)
+                # Queue the frame as captured, then wait before the next one; motion seen while
+                # waiting, or a frame request, shortens the wait
                 await self.out_queue.put(frame)
                 logger.debug(f"Frame {frame_count} queued for sending.")
+                delay = self.governor.frame_delay(len(frame["data"]), self.camera_pacer.interval)
+                await self.camera_pacer.pace(delay, read=lambda: cap.read()[1],
+                                             until=lambda: self.video_gate.requested)
         except asyncio.CancelledError:
             logger.info("get_frames task cancelled.")
         finally:
             logger.info("Releasing camera...")
             cap.release()
 
-    def _get_screen_frame(self):
-        """Get a screen frame using mss."""
+    def _get_screen_frames(self, force=False):
+        """Get the frames of the capture target that changed (all of them with `force`), using mss."""
         try:
-            with mss.mss() as sct:
-                monitor = sct.monitors[0]
-                screenshot = sct.grab(monitor)
-                img = PIL.Image.frombytes('RGB', screenshot.size, screenshot.bgra, 'raw', 'BGRX')
-                
-                # Save first screenshot if it hasn't been saved yet
-                if not hasattr(self, '_first_screenshot_saved'):
-                    try:
-                        timestamp = time.strftime("%Y%m%d_%H%M%S")
-                        project_dir = os.path.dirname(os.path.abspath(__file__))
-                        save_path = os.path.join(project_dir, f"first_frame_{timestamp}.jpg")
-                        img.save(save_path, format='JPEG', quality=95)
-                        logger.info(f"First frame saved to {save_path}")
-                        self._first_screenshot_saved = True
-                    except Exception as e:
-                        logger.error(f"Failed to save first frame: {str(e)}")
-                
-                original_size = img.size
-                img.thumbnail([1024, 1024])
-                logger.debug(f"Captured screen resized from {original_size} to {img.size}")
-
-                image_io = io.BytesIO()
-                img.save(image_io, format="jpeg")
-                image_io.seek(0)
-
-                image_bytes = image_io.read()
-                logger.debug(f"Screen frame converted to JPEG of size {len(image_bytes)} bytes.")
-                return {"mime_type": "image/jpeg", "data": base64.b64encode(image_bytes).decode()}
+            frames = self.screen_capture.frames(self.governor.video_settings(), force)
+            # Save first screenshot if it hasn't been saved yet: the encoded frame as sent, written
+            # from a background thread
+            if not hasattr(self, '_first_screenshot_saved') and frames:
+                timestamp = time.strftime("%Y%m%d_%H%M%S")
+                project_dir = os.path.dirname(os.path.abspath(__file__))
+                frame_archive.save_frame(frames[0]["data"], frames[0]["mime_type"],
+                                         os.path.join(project_dir, f"first_frame_{timestamp}"))
+                self._first_screenshot_saved = True
+            for frame in frames:
+                logger.debug(f"Screen frame converted to {frame['mime_type']} of size {len(frame['data'])} bytes.")
+            # The encoders' bytes objects go to the session as is; send() base64-encodes them
+            return frames
         except Exception as e:
             logger.error(f"Error capturing screen: {str(e)}")
             return None
@@ -236,8 +352,9 @@ class AudioLoop:
         """
         Captures screen frames and queues them for sending.
 
-        Continuously captures screenshots of the primary monitor and queues them
-        until the task is cancelled.
+        Continuously captures the capture target and queues its frames until the
+        task is cancelled. Each capture yields one frame per changed region (or,
+        with screen focus, an overview and a crop), so it may yield none.
         """
         logger.info("Starting screen capture...")
         # Reset the first screenshot flag when starting new capture
@@ -246,16 +363,20 @@ class AudioLoop:
         try:
             frame_count = 0
             while True:
-                frame = await asyncio.to_thread(self._get_screen_frame)
-                if frame is None:
+                await self.video_gate.wait(self.governor.video_settings().interval)
+                # A requested frame, or the first of a turn, is sent even if the screen is unchanged
+                frames = await asyncio.to_thread(self._get_screen_frames, self.video_gate.forced)
+                if frames is None:
                     logger.warning("No screen frame retrieved.")
                     break
                 frame_count += 1
                 if frame_count % 10 == 0:
                     logger.debug(f"Captured screen frame {frame_count}")
-                await asyncio.sleep(1.0)
-                await self.out_queue.put(frame)
+                for frame in frames:
+                    await self.out_queue.put(frame)
                 logger.debug(f"Screen frame {frame_count} queued for sending.")
+                nbytes = sum(bandwidth.wire_size(frame["data"]) for frame in frames)
+                await self.video_gate.pause(self.governor.frame_delay(nbytes))
         except asyncio.CancelledError:
             logger.info("get_screen task cancelled.")
 
@@ -268,27 +389,36 @@ class AudioLoop:
         logger.info("send_realtime task started.")
         while True:
             msg = await self.out_queue.get()
+            kind = "audio" if msg["mime_type"] == "audio/pcm" else "video"
+            # Measure the payload before send(), which base64-encodes raw bytes in place
+            nbytes = len(msg["data"])
+            wire_bytes = bandwidth.wire_size(msg["data"])
+            self.recorder.media_out(msg["data"], msg["mime_type"])
+            if kind == "video":
+                self.frame_archive.frame(msg["data"], msg["mime_type"])
             logger.debug("Sending realtime data to session.")
-            await self.session.send(msg)
+            send_start = time.monotonic()
+            with metrics.STAGE_SECONDS.labels("send").time():
+                await self.session.send(msg)
+            self.governor.on_sent(kind, wire_bytes, time.monotonic() - send_start)
+            self.tracer.on_upload(nbytes, send_start)
+            metrics.MESSAGES_SENT.labels(kind).inc()
+            metrics.BYTES_SENT.labels(kind).inc(nbytes)
             logger.debug("Data sent.")
 
     async def listen_audio(self):
         """
         Captures audio from the default microphone and queues it for sending.
 
-        Opens a PyAudio stream to capture microphone input, processes audio chunks,
+        Opens (or reuses) a microphone stream from the shared device manager, processes audio chunks,
         and adds them to the output queue.
         """
         logger.info("Starting audio input listening...")
-        mic_info = self.pya.get_default_input_device_info()
-        logger.debug(f"Default microphone: {mic_info['name']} (index {mic_info['index']})")
         self.audio_stream = await asyncio.to_thread(
-            self.pya.open,
+            self.audio.open_input,
             format=FORMAT,
             channels=CHANNELS,
             rate=SEND_SAMPLE_RATE,
-            input=True,
-            input_device_index=mic_info["index"],
             frames_per_buffer=CHUNK_SIZE,
         )
         logger.info("Microphone audio stream opened successfully.")
@@ -296,8 +426,12 @@ class AudioLoop:
             kwargs = {"exception_on_overflow": False}
         else:
             kwargs = {}
+        capture_seconds = metrics.STAGE_SECONDS.labels("capture_audio")
         while True:
-            data = await asyncio.to_thread(self.audio_stream.read, CHUNK_SIZE, **kwargs)
+            with capture_seconds.time():
+                data = await asyncio.to_thread(self.audio_stream.read, CHUNK_SIZE, **kwargs)
+            self.tracer.on_user_audio(data)
+            self.video_gate.on_user_audio(data)
             await self.out_queue.put({"data": data, "mime_type": "audio/pcm"})
             logger.debug("Audio chunk queued for sending.")
 
@@ -309,18 +443,50 @@ class AudioLoop:
         audio and text, and updates the respective queues or callbacks.
         """
         logger.info("Starting receive_audio task...")
+        receive_seconds = metrics.STAGE_SECONDS.labels("receive")
         while True:
             turn = self.session.receive()
+            last_message = None
             async for response in turn:
+                # Gap between consecutive messages of the same turn
+                now = time.perf_counter()
+                if last_message is not None:
+                    receive_seconds.observe(now - last_message)
+                last_message = now
+                self.tracer.on_server_message()
                 if data := response.data:
+                    self._turn_active = True
                     self.audio_in_queue.put_nowait(data)
+                    self.recorder.audio_in(data)
+                    metrics.MESSAGES_RECEIVED.labels("audio").inc()
+                    metrics.BYTES_RECEIVED.labels("audio").inc(len(data))
                     logger.debug("Received audio data from session.")
                     continue
                 if text := response.text:
+                    metrics.MESSAGES_RECEIVED.labels("text").inc()
+                    metrics.BYTES_RECEIVED.labels("text").inc(len(text))
                     logger.debug(f"Received text response: {text.strip()}")
+                    self.tracer.on_text_delta(text)
+                    self.recorder.text_in(text)
+                    self.transcript.on_text_delta(text)
                     self.display_text_callback(text)
+                    if self._cache_pending:
+                        self._cache_deltas.append(text)
+                if response.server_content and response.server_content.interrupted:
+                    # A cut-off answer must not be replayed as the whole one
+                    self._cache_pending.clear()
 
             # On turn_complete, empty out the audio queue
+            self._turn_active = False
+            metrics.TURNS_COMPLETED.inc()
+            self.tracer.on_turn_complete()
+            self.recorder.event("turn_complete")
+            self.transcript.on_turn_complete()
+            # Only an answer to exactly one uncached prompt can be attributed to that prompt
+            if len(self._cache_pending) == 1:
+                self.response_cache.put(self._cache_pending[0], self._cache_deltas)
+            self._cache_pending.clear()
+            self._cache_deltas.clear()
             while not self.audio_in_queue.empty():
                 discarded = self.audio_in_queue.get_nowait()
                 logger.debug("Discarding old audio data on turn complete.")
@@ -333,17 +499,24 @@ class AudioLoop:
         """
         logger.info("Starting audio playback...")
         stream = await asyncio.to_thread(
-            self.pya.open,
+            self.audio.open_output,
             format=FORMAT,
             channels=CHANNELS,
             rate=RECEIVE_SAMPLE_RATE,
-            output=True,
         )
         logger.info("Audio playback stream opened successfully.")
+        playback_seconds = metrics.STAGE_SECONDS.labels("playback")
         try:
             while True:
+                if self.audio_in_queue.empty():
+                    if self._turn_active:
+                        metrics.PLAYBACK_UNDERRUNS.inc()
+                    self.tracer.on_playback_idle()
                 bytestream = await self.audio_in_queue.get()
-                await asyncio.to_thread(stream.write, bytestream)
+                write_start = time.monotonic()
+                with playback_seconds.time():
+                    await asyncio.to_thread(stream.write, bytestream)
+                self.tracer.on_playback(write_start, time.monotonic())
                 logger.debug("Played received audio chunk.")
         except asyncio.CancelledError:
             logger.info("play_audio task cancelled.")
@@ -351,6 +524,15 @@ class AudioLoop:
             logger.info("Closing playback audio stream...")
             stream.close()
 
+    def connect(self, model, config, client):
+        """
+        Open the live session. Returns an async context manager yielding the session.
+
+        Subclasses override this to connect elsewhere, e.g. the gateway's headless
+        sessions connecting to a local mock server.
+        """
+        return client.aio.live.connect(model=model, config=config)
+
     async def run(self, model, config, mode, client):
         """
         Runs the main loop for managing AI interactions.
@@ -370,14 +552,28 @@ class AudioLoop:
         logger.info("Starting AudioLoop.run()")
         try:
             async with (
-                client.aio.live.connect(model=model, config=config) as session,
+                self.connect(model, config, client) as session,
                 asyncio.TaskGroup() as tg,
             ):
                 self.session = session
                 logger.info("Session connected successfully.")
+                self.recorder.event("session_start", model=model, mode=mode)
+                self.transcript = audio_transcriber.open_transcript(self.transcript_path, "audio_loop", model, mode)
+                self.frame_archive = frame_archive.open_archive(self.frame_archive_path, "audio_loop",
+                                                                self.frame_archive_bytes)
+                if self.response_cache is not None:
+                    generation_config = config.get("generation_config", {}) if isinstance(config, dict) else {}
+                    if mode in ("text", None) and generation_config.get("response_modalities") == ["TEXT"]:
+                        self._cache_scope = (model, config)
+                    else:
+                        logger.info("Response cache unused: it needs text mode and TEXT responses.")
 
                 self.audio_in_queue = asyncio.Queue()
                 self.out_queue = asyncio.Queue(maxsize=5)
+                if self.watch_queues:
+                    metrics.watch_queue("audio_in", self.audio_in_queue)
+                    metrics.watch_queue("out", self.out_queue)
+                    metrics.register_command("frame", self.video_gate.request_frame)
 
                 send_text_task = tg.create_task(self.send_text(), name="send_text")
                 tg.create_task(self.send_realtime(), name="send_realtime")
@@ -396,6 +592,9 @@ class AudioLoop:
 
                 tg.create_task(self.receive_audio(), name="receive_audio")
                 tg.create_task(self.play_audio(), name="play_audio")
+                if self.stall_threshold:
+                    watchdog = LoopWatchdog(threshold=self.stall_threshold)
+                    tg.create_task(watchdog.run(), name="loop_watchdog")
 
                 await send_text_task
                 raise asyncio.CancelledError("User requested exit")
@@ -410,17 +609,26 @@ class AudioLoop:
             logger.error(traceback.format_exc())
         finally:
             if self.audio_stream:
+                # Releases the stream to the device manager, which keeps it for the next session
+                # and terminates PortAudio at exit.
                 self.audio_stream.close()
+                self.audio_stream = None
                 logger.info("Audio stream closed.")
-            # best practice to close pya
-            self.pya.terminate()
-            logger.info("PyAudio terminated.")
+            if mode in ("camera", "screen"):
+                logger.info(self.video_gate.summary())
+            self.screen_capture.close()
+            if self.response_cache is not None:
+                self.response_cache.save()
+            metrics.dump_json(self.metrics_json)
+            self.tracer.close()
+            self.recorder.close()
 
 def main():
     """
     Main function to run the AudioLoop application as a CLI.
     """
     import argparse
+    from google import genai
 
     parser = argparse.ArgumentParser(description="Run the AudioLoop application as a CLI.")
     parser.add_argument(
@@ -430,8 +638,120 @@ def main():
         help="Source of video frames to stream",
         choices=["text", "camera", "screen"]
     )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        default=None,
+        help="Write a JSON dump of the metrics to this file when the session ends",
+    )
+    parser.add_argument(
+        "--stall-threshold",
+        type=float,
+        default=0.2,
+        help="Report event loop stalls longer than this many seconds (0 disables the watchdog)",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Append per-turn tracing spans (Chrome trace/Perfetto JSON) to this file",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Record the session (audio, frames, text and turn events) to this file",
+    )
+    parser.add_argument(
+        "--transcript",
+        type=str,
+        default=None,
+        help="Store user turns and model text in this SQLite transcript database",
+    )
+    parser.add_argument(
+        "--upload-kbps",
+        type=float,
+        default=None,
+        help="Upload budget in kilobits/s; video quality and frame rate adapt to stay within it",
+    )
+    parser.add_argument(
+        "--max-frame-kb",
+        type=float,
+        default=None,
+        help="Largest encoded frame in kilobytes (at least 2); quality is lowered per frame to stay within it",
+    )
+    parser.add_argument(
+        "--video-policy",
+        type=str,
+        default=video_gate.DEFAULT_POLICY,
+        choices=video_gate.POLICIES,
+        help="Send frames only around user speech and on request (speech), or every interval (fixed)",
+    )
+    parser.add_argument(
+        "--camera-min-interval",
+        type=float,
+        default=motion.MIN_INTERVAL,
+        help="Seconds between camera frames when the scene is busy",
+    )
+    parser.add_argument(
+        "--camera-max-interval",
+        type=float,
+        default=motion.MAX_INTERVAL,
+        help="Seconds between camera frames when the scene is still",
+    )
+    parser.add_argument(
+        "--screen-focus",
+        action="store_true",
+        help="In screen mode, send a small overview plus a full-resolution crop around the cursor (cursor and window tracking on Windows only; elsewhere the crop follows screen changes)",
+    )
+    parser.add_argument(
+        "--capture-target",
+        type=str,
+        default=screen_capture.DEFAULT_TARGET,
+        help="Screen area to capture: all, a monitor number, monitors (each in parallel), L,T,W,H or window:ID",
+    )
+    parser.add_argument(
+        "--frame-archive",
+        type=str,
+        default=None,
+        help="Archive the frames sent to the model in this directory, deduplicated by content",
+    )
+    parser.add_argument(
+        "--frame-archive-mb",
+        type=float,
+        default=frame_archive.DEFAULT_MAX_BYTES / 1e6,
+        help="Size in megabytes the frame archive is kept under; the least recently sent frames go first",
+    )
+    parser.add_argument(
+        "--response-cache",
+        action="store_true",
+        help="In text mode with TEXT responses, answer repeated prompts from a local cache",
+    )
+    parser.add_argument(
+        "--response-cache-file",
+        type=str,
+        default=None,
+        help="JSON file the response cache is loaded from and saved to",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=response_cache.TTL,
+        help="Seconds a cached response stays valid",
+    )
     args = parser.parse_args()
 
+    setup_logging()
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    profiler.install_signal_handler()
+
     MODEL = "models/gemini-2.0-flash-exp"
     client = genai.Client(http_options={"api_version": "v1alpha"})
 
@@ -460,7 +780,26 @@ def main():
             await user_input_queue.put(text)
 
     async def run_loop():
-        loop_instance = AudioLoop(user_input_queue=user_input_queue, display_text_callback=display_callback)
+        loop_instance = AudioLoop(
+            user_input_queue=user_input_queue,
+            display_text_callback=display_callback,
+            metrics_json=args.metrics_json,
+            stall_threshold=args.stall_threshold,
+            trace_path=args.trace,
+            record_path=args.record,
+            transcript_path=args.transcript,
+            upload_budget=args.upload_kbps * 1000 / 8 if args.upload_kbps else None,
+            max_frame_bytes=int(args.max_frame_kb * 1000) if args.max_frame_kb else None,
+            video_policy=args.video_policy,
+            camera_min_interval=args.camera_min_interval,
+            camera_max_interval=args.camera_max_interval,
+            focus_capture=args.screen_focus,
+            capture_target=args.capture_target,
+            frame_archive_path=args.frame_archive,
+            frame_archive_bytes=int(args.frame_archive_mb * 1e6),
+            response_cache=response_cache.ResponseCache(ttl=args.response_cache_ttl, path=args.response_cache_file)
+            if args.response_cache else None,
+        )
         user_input_task = asyncio.create_task(read_user_input())
         try:
             await loop_instance.run(MODEL, CONFIG, args.mode, client)
@@ -469,8 +808,14 @@ def main():
             logger.info("Main run_loop ended.")
 
     logger.info("Starting main CLI mode...")
-    asyncio.run(run_loop())
+    try:
+        asyncio.run(run_loop())
+    finally:
+        # Write out a profile that was still running when the session ended
+        profiler.PROFILER.stop()
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
     load_dotenv()
     main()
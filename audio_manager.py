@@ -0,0 +1,422 @@
+# audio_manager.py
+
+"""
+Process-wide PyAudio/device manager shared by every AudioLoop variant.
+
+Before this module each variant created its own `pyaudio.PyAudio()` in several
+places (module level, `listen_audio`, `play_audio`). Every one of them initialized
+PortAudio and scanned devices again, and most were never terminated.
+`AudioDeviceManager` keeps a single PortAudio instance per process and
+provides the following:
+
+    - caches device enumeration and the default input/output devices;
+    - opens streams on demand and hands them out again to later callers with the same
+      parameters. An input stream is reused only once its last user released it, because
+      concurrent readers would each take every other chunk; a second concurrent caller
+      gets a stream of its own. Input streams are paused while nobody uses them;
+    - survives device hot-plug: when a read or write fails because the device went
+      away, PortAudio is re-initialized, devices are rescanned and every open stream
+      is reopened in place. Callers keep their `ManagedStream` object and the session
+      keeps running; reads return silence until a device is available again.
+
+Usage:
+    manager = audio_manager.get_manager()
+    mic = await asyncio.to_thread(manager.open_input, rate=16000, channels=1, frames_per_buffer=512)
+    data = await asyncio.to_thread(mic.read, 512)
+    mic.close()
+
+pyaudio is imported on first use, so importing this module is cheap.
+"""
+
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PA_INT16 = 8  # pyaudio.paInt16
+SAMPLE_WIDTH = 2  # bytes per int16 sample
+
+# Wait between attempts to reopen a stream whose device disappeared.
+REOPEN_BACKOFF = (0.1, 0.25, 0.5, 1.0, 2.0)
+
+
+class ManagedStream:
+    """
+    A PyAudio stream owned by the `AudioDeviceManager`.
+
+    `read`/`write` have the same signatures as `pyaudio.Stream`; on device errors
+    the manager reopens the underlying stream in place instead of raising.
+    """
+
+    def __init__(self, manager, key, open_kwargs):
+        self._manager = manager
+        self.key = key
+        self.is_input = open_kwargs.get("input", False)
+        self.open_kwargs = open_kwargs
+        self.users = 0
+        self._stream = None
+        self._lock = threading.Lock()  # serialises I/O against reopen/close
+        self._failed_at = None
+        self._failures = 0
+
+    @property
+    def rate(self):
+        return self.open_kwargs["rate"]
+
+    @property
+    def channels(self):
+        return self.open_kwargs["channels"]
+
+    def read(self, num_frames, exception_on_overflow=True):
+        for attempt in range(2):
+            with self._lock:
+                if self._stream is not None:
+                    try:
+                        return self._stream.read(num_frames, exception_on_overflow=exception_on_overflow)
+                    except OSError as e:
+                        if exception_on_overflow and "overflow" in str(e).lower():
+                            raise
+                        self._lost(e)
+            if not self._manager._recover(self):
+                break
+        # No device: keep the capture pipeline moving with silence, at the device's pace.
+        time.sleep(num_frames / self.rate)
+        return bytes(num_frames * self.channels * SAMPLE_WIDTH)
+
+    def write(self, data):
+        for attempt in range(2):
+            with self._lock:
+                if self._stream is not None:
+                    try:
+                        self._stream.write(data)
+                        return
+                    except OSError as e:
+                        self._lost(e)
+            if not self._manager._recover(self):
+                break
+        # Audio written while the device is gone is dropped.
+
+    def close(self):
+        """Release this user's handle; the stream stays cached for reuse."""
+        self._manager._release(self)
+
+    def _lost(self, error):
+        logger.warning(f"Audio device error on {'input' if self.is_input else 'output'} stream: {error}")
+        self._close_stream()
+        self._failed_at = time.monotonic()
+
+    def _open_stream(self, pya, device_index):
+        kwargs = dict(self.open_kwargs)
+        if device_index is not None:
+            kwargs["input_device_index" if self.is_input else "output_device_index"] = device_index
+        self._stream = pya.open(**kwargs)
+
+    def _close_stream(self):
+        stream, self._stream = self._stream, None
+        if stream is None:
+            return
+        try:
+            stream.stop_stream()
+            stream.close()
+        except Exception as e:
+            logger.debug(f"Ignoring error while closing stream: {e}")
+
+    def _pause(self):
+        with self._lock:
+            if self._stream is not None and self.is_input:
+                try:
+                    self._stream.stop_stream()
+                except Exception as e:
+                    logger.debug(f"Ignoring error while pausing stream: {e}")
+
+    def _resume(self):
+        with self._lock:
+            if self._stream is not None and not self._stream.is_active():
+                self._stream.start_stream()
+
+
+class AudioDeviceManager:
+    """
+    Owns the process's single PortAudio instance, its device list and its streams.
+
+    Use `get_manager()` rather than constructing this directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pya = None
+        self._devices = None
+        self._default_input = None
+        self._default_output = None
+        # Open parameters -> streams opened with them
+        self._streams = {}
+        self.reinit_count = 0
+
+    # ---- devices ------------------------------------------------------------
+
+    @property
+    def pya(self):
+        """The shared `pyaudio.PyAudio` instance, initialized on first use."""
+        with self._lock:
+            if self._pya is None:
+                import pyaudio
+
+                started = time.perf_counter()
+                self._pya = pyaudio.PyAudio()
+                logger.info(f"PortAudio initialized in {(time.perf_counter() - started) * 1000:.0f} ms")
+            return self._pya
+
+    def devices(self):
+        """Return the cached list of device info dicts, scanning devices on first call."""
+        with self._lock:
+            if self._devices is None:
+                pya = self.pya
+                self._devices = [pya.get_device_info_by_index(i) for i in range(pya.get_device_count())]
+                self._default_input = self._default_info(pya.get_default_input_device_info)
+                self._default_output = self._default_info(pya.get_default_output_device_info)
+                logger.info(f"Found {len(self._devices)} audio devices; default input: "
+                            f"{self._name(self._default_input)}, default output: {self._name(self._default_output)}")
+            return self._devices
+
+    def default_input(self):
+        """Info dict of the default input device, or None if there is none."""
+        self.devices()
+        return self._default_input
+
+    def default_output(self):
+        """Info dict of the default output device, or None if there is none."""
+        self.devices()
+        return self._default_output
+
+    def refresh_devices(self):
+        """
+        Re-initialize PortAudio to pick up added or removed devices, then reopen every
+        open stream in place on the (possibly new) default device.
+        """
+        with self._lock:
+            streams = self._all_streams()
+            for stream in streams:
+                stream._lock.acquire()
+            try:
+                for stream in streams:
+                    stream._close_stream()
+                if self._pya is not None:
+                    self._pya.terminate()
+                    self._pya = None
+                self._devices = None
+                self.reinit_count += 1
+                self.devices()
+                for stream in streams:
+                    self._try_open(stream)
+            finally:
+                for stream in streams:
+                    stream._lock.release()
+
+    # ---- streams ------------------------------------------------------------
+
+    def open_input(self, rate, channels=1, frames_per_buffer=1024, format=PA_INT16):
+        """Open (or reuse) a capture stream on the default input device."""
+        return self._acquire(dict(format=format, channels=channels, rate=rate, input=True,
+                                  frames_per_buffer=frames_per_buffer))
+
+    def open_output(self, rate, channels=1, format=PA_INT16):
+        """Open (or reuse) a playback stream on the default output device."""
+        return self._acquire(dict(format=format, channels=channels, rate=rate, output=True))
+
+    def terminate(self):
+        """Close every stream and release PortAudio. Called automatically at exit."""
+        with self._lock:
+            for stream in self._all_streams():
+                with stream._lock:
+                    stream._close_stream()
+            self._streams.clear()
+            if self._pya is not None:
+                self._pya.terminate()
+                self._pya = None
+                logger.info("PortAudio terminated.")
+
+    def _acquire(self, open_kwargs):
+        key = tuple(sorted(open_kwargs.items()))
+        with self._lock:
+            streams = self._streams.setdefault(key, [])
+            # Output streams are shared (writes are serialized); an input stream only once it is free
+            free = [stream for stream in streams if not (stream.is_input and stream.users)]
+            if free:
+                stream = free[0]
+            else:
+                stream = ManagedStream(self, key, open_kwargs)
+                streams.append(stream)
+            if stream._stream is None:
+                with stream._lock:
+                    self._try_open(stream, raise_errors=True)
+            elif stream.users == 0:
+                stream._resume()
+                logger.debug(f"Reusing cached audio stream {open_kwargs}")
+            stream.users += 1
+            return stream
+
+    def _release(self, stream):
+        with self._lock:
+            stream.users = max(0, stream.users - 1)
+            if stream.users == 0:
+                # Keep the device open for the next user, but stop capturing into its buffer
+                stream._pause()
+
+    def _all_streams(self):
+        return [stream for streams in self._streams.values() for stream in streams]
+
+    def _try_open(self, stream, raise_errors=False):
+        device = self.default_input() if stream.is_input else self.default_output()
+        try:
+            stream._open_stream(self.pya, device["index"] if device else None)
+        except OSError as e:
+            if raise_errors:
+                raise
+            logger.warning(f"Could not reopen {'input' if stream.is_input else 'output'} stream: {e}")
+            return False
+        stream._failed_at = None
+        stream._failures = 0
+        logger.info(f"Opened {'input' if stream.is_input else 'output'} stream on "
+                    f"{self._name(device)} ({stream.rate} Hz)")
+        return True
+
+    def _recover(self, stream):
+        """
+        Reopen a stream whose device failed, rescanning devices, with backoff.
+        Returns True if the stream is open again.
+        """
+        if stream._stream is not None:
+            return True
+        if stream._failed_at is None:
+            return False
+        backoff = REOPEN_BACKOFF[min(stream._failures, len(REOPEN_BACKOFF) - 1)]
+        if time.monotonic() - stream._failed_at < backoff:
+            return False
+        stream._failures += 1
+        logger.info("Rescanning audio devices after a device error...")
+        self.refresh_devices()
+        if stream._stream is None:
+            stream._failed_at = time.monotonic()
+            return False
+        return True
+
+    @staticmethod
+    def _default_info(getter):
+        try:
+            return getter()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _name(info):
+        return f"{info['name']} (index {info['index']})" if info else "none"
+
+
+class PcmRingBuffer:
+    """
+    Byte ring buffer between a PCM producer thread and an asyncio playback task.
+
+    `write` may be called from any thread (e.g. a decode worker); `wait` and `read`
+    are for the event loop side. The buffer doubles when a write does not fit, because
+    the model streams audio faster than it plays and a full buffer must not hold up
+    the receiver.
+
+    Args:
+        capacity (int): Initial size in bytes.
+        block_size (int): Bytes per playback block; `qsize()` counts buffered blocks.
+    """
+
+    def __init__(self, capacity=1 << 19, block_size=4096):
+        self.block_size = block_size
+        self._buffer = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._ready = None
+
+    def __len__(self):
+        return self._size
+
+    def qsize(self):
+        return -(-self._size // self.block_size)
+
+    def write(self, data):
+        """Append `data` (any bytes-like object)."""
+        with memoryview(data) as view, view.cast("B") as chunk:
+            n = len(chunk)
+            if not n:
+                return
+            with self._lock:
+                if self._size + n > len(self._buffer):
+                    self._grow(self._size + n)
+                capacity = len(self._buffer)
+                end = (self._start + self._size) % capacity
+                first = min(n, capacity - end)
+                self._buffer[end:end + first] = chunk[:first]
+                self._buffer[:n - first] = chunk[first:]
+                was_empty = not self._size
+                self._size += n
+                loop, ready = self._loop, self._ready
+        if was_empty and loop is not None:
+            loop.call_soon_threadsafe(ready.set)
+
+    def read(self, max_bytes):
+        """Up to `max_bytes` from the front as bytes (b"" when empty)."""
+        with self._lock:
+            n = min(max_bytes, self._size)
+            capacity = len(self._buffer)
+            first = min(n, capacity - self._start)
+            data = bytes(self._buffer[self._start:self._start + first])
+            if first < n:
+                data += self._buffer[:n - first]
+            self._start = (self._start + n) % capacity
+            self._size -= n
+            return data
+
+    def clear(self):
+        with self._lock:
+            self._start = 0
+            self._size = 0
+
+    async def wait(self):
+        """Return once the buffer holds data."""
+        if self._ready is None:
+            with self._lock:
+                self._ready = asyncio.Event()
+                self._loop = asyncio.get_running_loop()
+        while not self._size:
+            self._ready.clear()
+            if self._size:
+                break
+            await self._ready.wait()
+
+    def _grow(self, needed):
+        capacity = len(self._buffer)
+        while capacity < needed:
+            capacity *= 2
+        buffer = bytearray(capacity)
+        old = len(self._buffer)
+        first = min(self._size, old - self._start)
+        buffer[:first] = self._buffer[self._start:self._start + first]
+        buffer[first:self._size] = self._buffer[:self._size - first]
+        self._buffer = buffer
+        self._start = 0
+        logger.debug(f"Playback buffer grown to {capacity} bytes")
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """Return the process-wide `AudioDeviceManager`."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = AudioDeviceManager()
+            atexit.register(_manager.terminate)
+        return _manager
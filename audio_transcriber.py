@@ -0,0 +1,405 @@
+# audio_transcriber.py
+
+"""
+Transcript store: every session's user turns and model text in one SQLite database.
+
+The AudioLoop variants write to it through a per-session `Transcript`, using the same
+callback names as the turn tracer:
+
+    transcript = open_transcript("logs/transcripts.db", variant="live_api_starter_desk", model=MODEL)
+    transcript.on_user_text("what is on my screen?")
+    transcript.on_text_delta("It looks like ")      # model text, as it streams in
+    transcript.on_text_delta("a spreadsheet.")
+    transcript.on_turn_complete()
+
+A turn has one row per role. Model deltas are appended to the model row of the current
+turn. Writes are never done on the caller's thread: the callbacks put small tuples on a
+queue, and one writer thread per database merges consecutive deltas and commits them
+in batches (every `flush_interval` seconds or `batch_size` operations).
+
+The database runs in WAL mode, so readers (the overlay, `python audio_transcriber.py`)
+never block the writer. Text is indexed with FTS5 (an external-content table over
+`entries`, kept in sync by triggers). Where SQLite was built without FTS5, search falls
+back to LIKE.
+
+Reading:
+
+    store = get_store("logs/transcripts.db")
+    store.search("spreadsheet")                       # ranked matches with snippets
+    page = store.history(limit=50)                    # newest 50 entries, oldest first
+    older = store.history(limit=50, before=page[0].id)
+    store.updated_since(timestamp)                    # rows written or extended since then
+
+    python audio_transcriber.py search "spreadsheet"
+    python audio_transcriber.py history --limit 20
+"""
+
+import argparse
+import atexit
+import collections
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "transcripts.db")
+
+Entry = collections.namedtuple("Entry", "id session_id turn role text created updated")
+Match = collections.namedtuple("Match", "id session_id turn role text created snippet")
+Session = collections.namedtuple("Session", "id started variant model mode entries")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    variant TEXT,
+    model TEXT,
+    mode TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (session_id, turn, role)
+);
+CREATE INDEX IF NOT EXISTS entries_updated ON entries (updated);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    text, session_id UNINDEXED, turn UNINDEXED, content='entries', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, text, session_id, turn) VALUES (new.id, new.text, new.session_id, new.turn);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_update AFTER UPDATE OF text ON entries BEGIN
+    INSERT INTO entries_fts (entries_fts, rowid, text, session_id, turn)
+        VALUES ('delete', old.id, old.text, old.session_id, old.turn);
+    INSERT INTO entries_fts (rowid, text, session_id, turn) VALUES (new.id, new.text, new.session_id, new.turn);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts (entries_fts, rowid, text, session_id, turn)
+        VALUES ('delete', old.id, old.text, old.session_id, old.turn);
+END;
+"""
+
+# Appends text to the (session, turn, role) row, creating it on the first write
+UPSERT = """
+INSERT INTO entries (session_id, turn, role, text, created, updated) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (session_id, turn, role) DO UPDATE SET text = text || excluded.text, updated = excluded.updated
+"""
+
+ENTRY_COLUMNS = "id, session_id, turn, role, text, created, updated"
+
+
+class TranscriptStore:
+    """
+    A transcript database with a batched background writer.
+
+    Args:
+        path (str): SQLite file; created with its schema if missing.
+        batch_size (int): Operations committed in one transaction at most.
+        flush_interval (float): Seconds the writer waits to fill a batch.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, batch_size=256, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        try:
+            conn.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite has no FTS5 ({e}); transcript search falls back to LIKE")
+            self.fts = False
+        self._local.conn = conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps commits durable across crashes of the app; only a power loss can drop the last ones
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def _conn(self):
+        """Read connection of the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # ---- writing ---------------------------------------------------------------
+
+    def open_session(self, variant=None, model=None, mode=None):
+        """Start a session; returns the `Transcript` its callbacks write through."""
+        session_id = uuid.uuid4().hex
+        self._put(("session", session_id, time.time(), variant, model, mode))
+        return Transcript(self, session_id)
+
+    def _put(self, op):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="transcript-writer", daemon=True)
+                    self._writer.start()
+                    atexit.register(self.close)
+        self._queue.put(op)
+
+    def _write_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            ops = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(ops) < self.batch_size and ops[-1] is not None and ops[-1][0] != "flush":
+                try:
+                    ops.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if ops[-1] is None:
+                running = False
+                ops.pop()
+            flushed = [op[1] for op in ops if op[0] == "flush"]
+            try:
+                self._write_batch(conn, [op for op in ops if op[0] != "flush"])
+            except sqlite3.Error as e:
+                logger.error(f"Writing {len(ops)} transcript operations failed: {e}")
+            for done in flushed:
+                done.set()
+        conn.close()
+
+    def _write_batch(self, conn, ops):
+        if not ops:
+            return
+        sessions, rows = [], []
+        for op in ops:
+            if op[0] == "session":
+                sessions.append(op[1:])
+            elif rows and rows[-1][:3] == op[1:4]:
+                # Consecutive deltas of the same row become one upsert
+                session_id, turn, role, text, created, _ = rows[-1]
+                rows[-1] = (session_id, turn, role, text + op[4], created, op[5])
+            else:
+                rows.append(op[1:] + (op[5],))
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT OR IGNORE INTO sessions (id, started, variant, model, mode) VALUES (?, ?, ?, ?, ?)",
+                             sessions)
+            conn.executemany(UPSERT, rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far is committed."""
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._put(("flush", done))
+        done.wait(timeout)
+
+    def close(self):
+        """Commit pending writes and stop the writer thread."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+            atexit.unregister(self.close)
+
+    # ---- reading ---------------------------------------------------------------
+
+    def sessions(self, limit=50, before=None):
+        """Most recent sessions first; page with `before=<started of the last one>`."""
+        sql = ("SELECT s.id, s.started, s.variant, s.model, s.mode, "
+               "(SELECT COUNT(*) FROM entries e WHERE e.session_id = s.id) FROM sessions s")
+        params = []
+        if before is not None:
+            sql += " WHERE s.started < ?"
+            params.append(before)
+        sql += " ORDER BY s.started DESC LIMIT ?"
+        params.append(limit)
+        return [Session(*row) for row in self._conn.execute(sql, params)]
+
+    def history(self, limit=50, before=None, session_id=None):
+        """
+        One page of entries, oldest first: the `limit` newest entries with an id below `before`.
+
+        Load older pages with `before=page[0].id`; an empty list means the start was reached.
+        """
+        where, params = [], []
+        if before is not None:
+            where.append("id < ?")
+            params.append(before)
+        if session_id is not None:
+            where.append("session_id = ?")
+            params.append(session_id)
+        sql = f"SELECT {ENTRY_COLUMNS} FROM entries"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        rows = self._conn.execute(sql, params).fetchall()
+        return [Entry(*row) for row in reversed(rows)]
+
+    def updated_since(self, timestamp, session_id=None):
+        """Entries created or extended after `timestamp` (wall clock), oldest first."""
+        sql = f"SELECT {ENTRY_COLUMNS} FROM entries WHERE updated > ?"
+        params = [timestamp]
+        if session_id is not None:
+            sql += " AND session_id = ?"
+            params.append(session_id)
+        return [Entry(*row) for row in self._conn.execute(sql + " ORDER BY id", params)]
+
+    def turn(self, session_id, turn):
+        """The entries (user and model) of one turn."""
+        sql = f"SELECT {ENTRY_COLUMNS} FROM entries WHERE session_id = ? AND turn = ? ORDER BY id"
+        return [Entry(*row) for row in self._conn.execute(sql, (session_id, turn))]
+
+    def search(self, query, limit=50, session_id=None, role=None):
+        """
+        Entries matching `query`, best first.
+
+        With FTS5, `query` uses FTS5 syntax (words, "phrases", prefix*, AND/OR/NOT);
+        plain words are matched as given. Without FTS5 it is a substring match.
+        """
+        where, params = [], []
+        if session_id is not None:
+            where.append("e.session_id = ?")
+            params.append(session_id)
+        if role is not None:
+            where.append("e.role = ?")
+            params.append(role)
+        filters = "".join(" AND " + clause for clause in where)
+        if self.fts:
+            sql = ("SELECT e.id, e.session_id, e.turn, e.role, e.text, e.created, "
+                   "snippet(entries_fts, 0, '[', ']', '...', 12) "
+                   "FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid "
+                   f"WHERE entries_fts MATCH ?{filters} ORDER BY bm25(entries_fts) LIMIT ?")
+            try:
+                rows = self._conn.execute(sql, [query] + params + [limit]).fetchall()
+            except sqlite3.OperationalError:
+                # Not valid FTS5 syntax (e.g. stray quotes or punctuation): search it as a phrase
+                phrase = '"' + query.replace('"', '""') + '"'
+                rows = self._conn.execute(sql, [phrase] + params + [limit]).fetchall()
+        else:
+            sql = ("SELECT e.id, e.session_id, e.turn, e.role, e.text, e.created, e.text FROM entries e "
+                   f"WHERE e.text LIKE ? ESCAPE '\\'{filters} ORDER BY e.id DESC LIMIT ?")
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            rows = self._conn.execute(sql, [pattern] + params + [limit]).fetchall()
+        return [Match(*row) for row in rows]
+
+
+class Transcript:
+    """
+    Callbacks that record one session; all no-ops without a store.
+
+    `on_text_delta` takes a single string, so it can also serve as an AudioLoop
+    `display_text_callback`.
+    """
+
+    def __init__(self, store=None, session_id=None):
+        self.store = store
+        self.session_id = session_id
+        self.turn = 1
+        self._user_text = False
+        self._model_text = False
+
+    def on_user_text(self, text):
+        if self.store is None:
+            return
+        if self._model_text:
+            # The user spoke up while the model was answering: that starts the next turn
+            self.on_turn_complete()
+        self._write("user", ("\n" + text) if self._user_text else text)
+        self._user_text = True
+
+    def on_text_delta(self, text):
+        if self.store is None or not text:
+            return
+        self._write("model", text)
+        self._model_text = True
+
+    def on_turn_complete(self):
+        if self._user_text or self._model_text:
+            self.turn += 1
+            self._user_text = self._model_text = False
+
+    def _write(self, role, text):
+        now = time.time()
+        self.store._put(("entry", self.session_id, self.turn, role, text, now))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path=DEFAULT_PATH):
+    """The process-wide store for `path`; sessions sharing a database share its writer thread."""
+    path = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = TranscriptStore(path)
+        return store
+
+
+def open_transcript(path, variant=None, model=None, mode=None):
+    """A `Transcript` for a new session in the database at `path`, or a no-op one if `path` is empty."""
+    if not path:
+        return Transcript()
+    return get_store(path).open_session(variant, model, mode)
+
+
+def _print_entries(entries):
+    for entry in entries:
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry.created))
+        print(f"{stamp}  {entry.session_id[:8]} #{entry.turn:<3} {entry.role:<5} {entry.text}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the transcript database.")
+    parser.add_argument("--db", default=DEFAULT_PATH, help="transcript database")
+    sub = parser.add_subparsers(dest="command", required=True)
+    search = sub.add_parser("search", help="full-text search")
+    search.add_argument("query")
+    search.add_argument("--limit", type=int, default=20)
+    history = sub.add_parser("history", help="latest entries")
+    history.add_argument("--limit", type=int, default=20)
+    history.add_argument("--session", default=None, help="only this session (id prefix)")
+    sub.add_parser("sessions", help="latest sessions")
+    args = parser.parse_args()
+
+    store = TranscriptStore(args.db)
+    if args.command == "search":
+        for match in store.search(args.query, limit=args.limit):
+            print(f"{match.session_id[:8]} #{match.turn:<3} {match.role:<5} {match.snippet}")
+    elif args.command == "history":
+        session_id = None
+        if args.session:
+            matches = [s.id for s in store.sessions(limit=1000) if s.id.startswith(args.session)]
+            session_id = matches[0] if matches else args.session
+        _print_entries(store.history(limit=args.limit, session_id=session_id))
+    else:
+        for session in store.sessions():
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(session.started))
+            print(f"{stamp}  {session.id[:8]}  {session.variant or '-':<24}{session.mode or '-':<8}"
+                  f"{session.entries} entries")
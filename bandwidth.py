@@ -0,0 +1,226 @@
+# bandwidth.py
+
+"""
+Upstream bandwidth governor: keeps video within what the link (or a budget) can carry.
+
+The capture loops used to send a 1024px JPEG once a second, whatever the link could
+carry. On a congested uplink those frames sit in the websocket's send buffer ahead
+of the microphone audio, and the model hears the user late.
+
+`BandwidthGovernor` splits the upload into two lanes:
+
+    audio  never throttled; its share (16 kHz PCM as base64, ~43 KB/s) is reserved first;
+    video  a token bucket that gets what is left of the budget.
+
+The budget is the smaller of the configured `--upload-kbps` and the measured link
+throughput. The throughput estimate comes from send times: a large send that takes
+more than a few milliseconds waited for the socket to drain, so bytes/second of
+those sends is what the link really carries. Only video sends of at least
+`MIN_SAMPLE_BYTES` count. On a small send, event loop and GIL delays dominate the
+measured time. The estimate is lowered only after `CONGESTED_SAMPLES` congested sends
+in a row, so a single hiccup does not throttle video.
+
+The video lane adapts through a ladder of settings, from the old behaviour (1024px,
+1 frame/s) down to small, infrequent frames. A camera loop (`pacer` is its
+`motion.MotionPacer`, `gate` its `video_gate.VideoGate`):
+
+    settings = governor.video_settings()           # max_size, quality, interval
+    frame = encode(capture(), settings)
+    queue(frame)                                   # as captured, then pace the next one
+    delay = governor.frame_delay(wire_size(frame["data"]), pacer.interval)
+    await pacer.pace(delay, read=lambda: cap.read()[1], until=lambda: gate.requested)
+    ...
+    governor.on_sent("audio", nbytes, send_seconds)   # from the send paths
+
+Screen loops keep the ladder's interval: `await gate.pause(governor.frame_delay(nbytes))`.
+
+Each frame moves the ladder one step down if its bytes/second at the current
+interval exceed the video budget. The ladder moves back up after a few frames that
+used less than half of it. All sizes are bytes on the wire, i.e. after base64.
+"""
+
+import collections
+import logging
+import statistics
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+VideoSettings = collections.namedtuple("VideoSettings", "max_size quality interval")
+
+# From the original 1024px at one frame per second down to a thumbnail every 5 s
+LADDER = (
+    VideoSettings(1024, 80, 1.0),
+    VideoSettings(1024, 65, 1.0),
+    VideoSettings(768, 60, 1.0),
+    VideoSettings(768, 50, 1.5),
+    VideoSettings(640, 45, 2.0),
+    VideoSettings(512, 40, 3.0),
+    VideoSettings(384, 35, 5.0),
+)
+
+# 16 kHz 16-bit mono PCM, base64-encoded
+AUDIO_WIRE_RATE = 16000 * 2 * 4 / 3
+
+# A send slower than this waited for the socket buffer to drain
+CONGESTED_SEND = 0.005
+# Smaller sends say more about event loop delays than about the link
+MIN_SAMPLE_BYTES = 16 * 1024
+# Consecutive congested sends needed before the link estimate is lowered
+CONGESTED_SAMPLES = 3
+# Forget the link estimate after this long without a congested send
+CAPACITY_TTL = 10.0
+# Keep at least this fraction of the budget for video so frames never stop entirely
+MIN_VIDEO_SHARE = 0.05
+# Frames under half the budget needed before stepping back up the ladder
+STEP_UP_FRAMES = 3
+# Longest a frame is held back; older debt is forgiven so video never freezes for long
+MAX_FRAME_WAIT = 10.0
+
+VIDEO_LEVEL = metrics.REGISTRY.gauge(
+    "audioloop_video_level", "Current step of the video quality ladder (0 = full quality)."
+)
+VIDEO_BUDGET = metrics.REGISTRY.gauge(
+    "audioloop_video_budget_bytes", "Bytes per second available to video after audio's share (0 = unlimited)."
+)
+LINK_CAPACITY = metrics.REGISTRY.gauge(
+    "audioloop_link_capacity_bytes", "Measured upload throughput in bytes per second (0 = not congested)."
+)
+VIDEO_THROTTLED = metrics.REGISTRY.counter(
+    "audioloop_video_throttled_seconds_total", "Seconds frames were held back by the bandwidth governor."
+)
+
+
+def wire_size(data):
+    """Bytes `data` takes in a realtime message: str payloads are already base64, bytes get encoded."""
+    if isinstance(data, str):
+        return len(data)
+    return (len(data) + 2) // 3 * 4
+
+
+class _Rate:
+    """Exponentially weighted bytes/second over roughly `window` seconds."""
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self.rate = 0.0
+        self._last = None
+
+    def add(self, nbytes, now):
+        if self._last is None:
+            self._last = now
+            return
+        elapsed = max(now - self._last, 1e-3)
+        self._last = now
+        weight = min(1.0, elapsed / self.window)
+        self.rate += weight * (nbytes / elapsed - self.rate)
+
+
+class BandwidthGovernor:
+    """
+    Token-bucket governor for the video lane, with audio's share reserved.
+
+    Args:
+        budget (float, optional): Upload budget in bytes/s on the wire; None adapts to the link only.
+        audio_rate (float): Bytes/s reserved for audio (the measured rate is used if higher).
+        ladder (tuple): `VideoSettings` from best to most frugal.
+        burst (float): Seconds of video budget the bucket can save up.
+    """
+
+    def __init__(self, budget=None, audio_rate=AUDIO_WIRE_RATE, ladder=LADDER, burst=2.0):
+        self.budget = budget
+        self.audio_rate = audio_rate
+        self.ladder = ladder
+        self.burst = burst
+        self.level = 0
+        self.capacity = None
+        self._capacity_at = 0.0
+        # Throughput of the current run of congested video sends
+        self._congested = collections.deque(maxlen=CONGESTED_SAMPLES)
+        self._audio = _Rate()
+        self._tokens = None
+        self._updated = time.monotonic()
+        self._under = 0
+        VIDEO_LEVEL.set(0)
+
+    def video_settings(self):
+        return self.ladder[self.level]
+
+    def video_budget(self):
+        """Bytes/s video may use now, or None when nothing limits it."""
+        now = time.monotonic()
+        if self.capacity is not None and now - self._capacity_at > CAPACITY_TTL:
+            self.capacity = None
+            LINK_CAPACITY.set(0)
+        limits = [limit for limit in (self.budget, self.capacity) if limit]
+        if not limits:
+            return None
+        limit = min(limits)
+        return max(limit - max(self.audio_rate, self._audio.rate), limit * MIN_VIDEO_SHARE)
+
+    def on_sent(self, kind, nbytes, seconds):
+        """Report a completed send: `kind` is "audio" or "video", `nbytes` its wire size."""
+        now = time.monotonic()
+        if kind == "audio":
+            self._audio.add(nbytes, now)
+        if kind != "video" or nbytes < MIN_SAMPLE_BYTES:
+            return
+        if seconds <= CONGESTED_SEND:
+            self._congested.clear()
+            return
+        self._congested.append(nbytes / seconds)
+        if len(self._congested) == CONGESTED_SAMPLES:
+            sample = statistics.median(self._congested)
+            # Smooth, but let a collapse of the link show up at once
+            self.capacity = sample if self.capacity is None else min(sample, 0.7 * self.capacity + 0.3 * sample)
+            self._capacity_at = now
+            LINK_CAPACITY.set(self.capacity)
+
+    def frame_delay(self, nbytes, interval=None):
+        """
+        Debit a frame of `nbytes` from the video bucket and adapt the ladder.
+
+        Returns the seconds to wait, after queueing the frame, before the next one: the current frame
+        interval, or longer while the bucket is in debt. A source that picks its own
+        `interval` (the camera's motion pacing) passes it; it is stretched by the
+        same factor as the ladder's interval when the ladder steps down.
+        """
+        settings = self.ladder[self.level]
+        if interval is None:
+            interval = settings.interval
+        else:
+            interval *= settings.interval / self.ladder[0].interval
+        budget = self.video_budget()
+        VIDEO_BUDGET.set(budget or 0)
+        self._adapt(nbytes / interval, budget)
+        if budget is None:
+            return interval
+        now = time.monotonic()
+        if self._tokens is None:
+            self._tokens = budget * self.burst
+        self._tokens = min(budget * self.burst, self._tokens + (now - self._updated) * budget)
+        self._updated = now
+        self._tokens = max(self._tokens - nbytes, -budget * MAX_FRAME_WAIT)
+        # Tokens keep accruing during the interval the frame waits anyway
+        wait = max(interval, -self._tokens / budget)
+        if wait > interval:
+            VIDEO_THROTTLED.inc(wait - interval)
+        return wait
+
+    def _adapt(self, rate, budget):
+        level = self.level
+        if budget is None or rate < budget / 2:
+            self._under += 1
+            if self._under >= STEP_UP_FRAMES and self.level > 0:
+                self.level -= 1
+                self._under = 0
+        else:
+            self._under = 0
+            if rate > budget and self.level < len(self.ladder) - 1:
+                self.level += 1
+        if self.level != level:
+            VIDEO_LEVEL.set(self.level)
+            logger.info(f"Video settings {self.ladder[level]} -> {self.ladder[self.level]} "
+                        f"(video {rate / 1000:.0f} KB/s, budget {(budget or 0) / 1000:.0f} KB/s)")
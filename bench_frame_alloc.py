@@ -0,0 +1,154 @@
+# bench_frame_alloc.py
+
+"""
+Allocation benchmark and regression guard for the screen frame path.
+
+Replays synthetic 1920x1080 BGRA captures of text, mixed and photo content (the
+layout of mss's `ScreenShot.raw`) through two versions of the path from capture
+buffer to the payload handed to the session:
+
+    copying    PIL.Image.frombytes, thumbnail, save to a BytesIO, getvalue,
+               base64.b64encode(...).decode() (the path before `FrameBuffer`);
+    reused     frame_encoder.FrameBuffer and an encoder that writes into reused
+               output buffers (`JpegEncoder`, and `ScreenEncoder` as audio_loop uses).
+
+For each frame after a warm-up cycle it measures, with tracemalloc:
+
+    peak      Python-heap memory allocated at the frame's peak, beyond what was live
+              before it (numpy buffers are traced too);
+    kept      blocks of 4 KiB or more still alive after the frame, i.e. the frame's
+              payload plus any buffer that was allocated instead of reused;
+    pil       images allocated by PIL, whose pixel storage tracemalloc cannot see
+              (`PIL.Image.core.get_stats()`).
+
+and checks the reused path: one kept block (the payload bytes), no PIL images for
+the JPEG path, a peak within `PEAK_SLACK` of the payload, and a `FrameBuffer` that
+is never reallocated after the warm-up (an encoder that resized its input in place
+would shrink the buffer's image and force a reallocation on the next frame). It exits with status 1
+when a check fails, so it can run in CI.
+
+Usage:
+    python bench_frame_alloc.py
+    python bench_frame_alloc.py --frames 50
+"""
+
+import argparse
+import base64
+import collections
+import io
+import sys
+import time
+import tracemalloc
+
+import frame_encoder
+
+SIZE = (1920, 1080)
+MAX_SIZE = 1024
+QUALITY = 80
+# Blocks at least this large count as frame data rather than bookkeeping
+LARGE_BLOCK = 4096
+# Peak allowed beyond the payload on the reused JPEG path: PIL's write chunks
+PEAK_SLACK = 256 * 1024
+
+
+def copying_path(raw):
+    import PIL.Image
+
+    img = PIL.Image.frombytes("RGB", SIZE, bytes(raw), "raw", "BGRX")
+    img.thumbnail([MAX_SIZE, MAX_SIZE])
+    image_io = io.BytesIO()
+    img.save(image_io, format="jpeg", quality=QUALITY)
+    return base64.b64encode(image_io.getvalue()).decode()
+
+
+def reused_path(buffer, encoder):
+    def path(raw):
+        img = buffer.from_bgra(raw, SIZE, MAX_SIZE)
+        if path.image is not None and img is not path.image:
+            path.reallocations += 1
+        path.image = img
+        return encoder.encode(img, MAX_SIZE, QUALITY)
+
+    path.image = None
+    path.reallocations = 0
+    return path
+
+
+def _large_blocks(snapshot):
+    return collections.Counter((trace.size, trace.traceback) for trace in snapshot.traces if trace.size >= LARGE_BLOCK)
+
+
+def measure(path, captures, warmup):
+    """Per-frame (peak bytes, kept large blocks, PIL images, seconds, payload bytes) after `warmup` frames."""
+    import PIL.Image
+
+    results = []
+    tracemalloc.start()
+    try:
+        for i, raw in enumerate(captures):
+            before = tracemalloc.take_snapshot()
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            pil_before = PIL.Image.core.get_stats()["new_count"]
+            start = time.perf_counter()
+            payload = path(raw)
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            pil = PIL.Image.core.get_stats()["new_count"] - pil_before
+            after = tracemalloc.take_snapshot()
+            kept = sum((_large_blocks(after) - _large_blocks(before)).values())
+            if i >= warmup:
+                results.append((peak - baseline, kept, pil, seconds, len(payload)))
+            del payload, before, after
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Allocation benchmark and regression guard for the screen frame path.")
+    parser.add_argument("--frames", type=int, default=20, help="frames measured per path (after a warm-up cycle)")
+    args = parser.parse_args()
+
+    # Text, mixed and photo content, so `ScreenEncoder` takes each of its codec paths
+    frames = (frame_encoder._synthetic_frames("screen", 4) + frame_encoder._synthetic_frames("mixed", 4)
+              + frame_encoder._synthetic_frames("camera", 2))
+    bgra = [bytearray(frame.convert("RGBX").tobytes("raw", "BGRX")) for frame in frames]
+    # One warm-up cycle through all captures grows the reused buffers to their largest frame
+    warmup = len(bgra)
+    captures = [bgra[i % len(bgra)] for i in range(args.frames + warmup)]
+
+    paths = {
+        "copying": copying_path,
+        "reused jpeg": reused_path(frame_encoder.FrameBuffer(), frame_encoder.JpegEncoder()),
+        "reused screen": reused_path(frame_encoder.FrameBuffer(), frame_encoder.ScreenEncoder()),
+    }
+    print(f"{'path':15} {'peak KB':>9} {'kept':>5} {'pil':>4} {'payload KB':>11} {'ms':>6}")
+    failures = []
+    for name, path in paths.items():
+        results = measure(path, captures, warmup)
+        reallocations = getattr(path, "reallocations", 0)
+        peak = max(r[0] for r in results)
+        kept = max(r[1] for r in results)
+        pil = max(r[2] for r in results)
+        payload = max(r[4] for r in results)
+        ms = sorted(r[3] for r in results)[len(results) // 2] * 1000
+        print(f"{name:15} {peak / 1024:9.0f} {kept:5} {pil:4} {payload / 1024:11.1f} {ms:6.1f}")
+        if name.startswith("reused"):
+            if kept != 1:
+                failures.append(f"{name}: {kept} large blocks kept per frame, expected only the payload")
+            if reallocations:
+                failures.append(f"{name}: FrameBuffer reallocated {reallocations} times, expected 0")
+        if name == "reused jpeg":
+            if pil:
+                failures.append(f"{name}: PIL allocated {pil} images per frame, expected 0")
+            if peak > payload + PEAK_SLACK:
+                failures.append(f"{name}: peak {peak} bytes exceeds payload {payload} + {PEAK_SLACK}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# bench_import.py
+
+"""
+Import-time benchmark and regression guard for the AudioLoop modules.
+
+Each module is imported in a fresh interpreter with `python -X importtime`. The
+script reports the median cumulative import time over several runs and checks
+two things:
+
+    - no heavy module (cv2, mss, PIL, numpy, pyaudio, google.genai, http.server)
+      is loaded just by importing; they must be imported lazily for the mode in use;
+    - the median cumulative import time stays under the module's budget.
+
+It exits with status 1 when either check fails, so it can run in CI or before a
+release.
+
+Usage:
+    python bench_import.py
+    python bench_import.py --runs 10 --budget-scale 2.0
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules that must not be loaded by a plain import of an AudioLoop module.
+HEAVY_MODULES = ("cv2", "mss", "PIL", "numpy", "pyaudio", "google.genai", "http.server")
+
+# Cumulative import-time budget per module, in milliseconds.
+BUDGETS_MS = {
+    "audio_loop": 150,
+    "live_api_starter": 250,  # imports websockets for every mode
+    "live_api_starter_cv": 150,
+    "live_api_starter_desk": 150,
+}
+
+
+def measure(module, cwd):
+    """Import `module` once with -X importtime; return (cumulative_ms, imported module names)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    cumulative_ms = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        if name == "imported package":
+            continue
+        imported.add(name)
+        if name == module:
+            cumulative_ms = int(cumulative) / 1000
+    return cumulative_ms, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure and guard import time of the AudioLoop modules.")
+    parser.add_argument("--runs", type=int, default=5, help="imports per module (median is reported)")
+    parser.add_argument("--budget-scale", type=float, default=1.0,
+                        help="multiply all budgets, e.g. on slow CI machines")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS_MS), help="modules to check")
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    failed = False
+    print(f"{'module':<24}{'median ms':>10}{'budget ms':>11}  result")
+    for module in args.modules:
+        budget = BUDGETS_MS.get(module, 150) * args.budget_scale
+        try:
+            runs = [measure(module, cwd) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{module:<24}{'-':>10}{budget:>11.0f}  ERROR {e}")
+            failed = True
+            continue
+        median = statistics.median(ms for ms, _ in runs)
+        heavy = sorted(
+            name for name in set().union(*(imported for _, imported in runs))
+            if any(name == h or name.startswith(h + ".") for h in HEAVY_MODULES)
+        )
+        problems = []
+        if median > budget:
+            problems.append("over budget")
+        if heavy:
+            problems.append("imports " + ", ".join(heavy))
+        failed = failed or bool(problems)
+        print(f"{module:<24}{median:>10.1f}{budget:>11.0f}  {'; '.join(problems) or 'ok'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
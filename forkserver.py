@@ -0,0 +1,286 @@
+# forkserver.py
+
+"""
+Warm fork-server launcher for the AudioLoop apps.
+
+When `run_desk.sh` saw the app die it started `python3 live_api_starter_desk.py`
+from scratch. Each restart paid again for the interpreter and for importing
+google.genai, PIL, cv2, numpy and websockets, which takes seconds on a cold
+cache. The fork server imports all of that once. It then forks a fresh child
+for every (re)start and runs the target module's `__main__` block in the child
+with `runpy`, so a restart costs a `fork()` and not a cold start.
+
+    python forkserver.py live_api_starter_desk --mode screen
+
+Behaviour:
+    - the child is restarted as soon as it exits (with backoff if it keeps dying quickly);
+    - SIGHUP restarts the child on demand; SIGINT/SIGTERM stop the child and the server.
+
+What is *not* preloaded: PortAudio. `pyaudio.PyAudio()` starts audio threads and
+opens device handles, and neither survives `fork()`. The shared device manager in
+`audio_manager.py` initializes it lazily, so each child starts its own PortAudio.
+The same goes for anything else that starts threads or opens sockets: only
+imports happen before the fork. `gc.freeze()` moves the preloaded objects out of
+the collector's reach, so collections in a child do not touch, and thereby copy,
+the shared pages.
+
+Needs `os.fork` (Linux/macOS). Elsewhere it falls back to starting a new interpreter.
+
+Startup benchmark: time from launch to the first audio chunk arriving at the local
+mock server, cold `python gateway.py` against a warm fork of the same module:
+
+    python forkserver.py --bench --runs 5
+"""
+
+import argparse
+import atexit
+import gc
+import importlib
+import logging
+import os
+import random
+import runpy
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Imported once in the server; each entry is optional (missing packages are skipped).
+DEFAULT_PRELOAD = (
+    "google.genai",
+    "google.genai.live",
+    "websockets.asyncio.client",
+    "numpy",
+    "cv2",
+    "PIL.Image",
+    "PIL.ImageGrab",
+    "mss",
+    "pyaudio",  # the module only; PortAudio is initialized in the child
+    "dotenv",
+)
+
+# Restart delays when the child keeps exiting within MIN_UPTIME seconds
+RESTART_BACKOFF = (0.0, 0.5, 1.0, 2.0, 5.0)
+MIN_UPTIME = 2.0
+
+
+class ForkServer:
+    """
+    Preloads modules once and forks children that run `module` as `__main__`.
+
+    Args:
+        module (str): Module to run in each child, e.g. "live_api_starter_desk".
+        argv (list): Command-line arguments for the child.
+        preload (iterable): Extra modules to import before forking; `module` itself is always imported.
+    """
+
+    def __init__(self, module, argv=(), preload=DEFAULT_PRELOAD):
+        self.module = module
+        self.argv = list(argv)
+        self.preload_modules = list(preload)
+        self.child = None
+        self.preload_seconds = None
+        self._stopping = False
+        self._restart_requested = False
+
+    def preload(self):
+        """Import the preload modules and the target module; returns the seconds it took."""
+        started = time.perf_counter()
+        for name in self.preload_modules + [self.module]:
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                # A missing optional package (e.g. cv2 on a desk-only install) just stays cold
+                logger.info(f"Not preloading {name}: {e}")
+        gc.collect()
+        gc.freeze()
+        self.preload_seconds = time.perf_counter() - started
+        logger.info(f"Preloaded {len(sys.modules)} modules in {self.preload_seconds:.2f}s")
+        if threading.active_count() > 1:
+            logger.warning(f"{threading.active_count() - 1} extra threads are running before fork; "
+                           "they will not exist in the children")
+        return self.preload_seconds
+
+    def spawn(self):
+        """Start one child; returns its pid."""
+        if not hasattr(os, "fork"):
+            # No fork (Windows): fall back to a cold interpreter
+            self.child = subprocess.Popen([sys.executable, "-m", self.module] + self.argv).pid
+            return self.child
+        pid = os.fork()
+        if pid == 0:
+            self._child_main()  # never returns
+        self.child = pid
+        return pid
+
+    def _child_main(self):
+        code = 1
+        try:
+            for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL if signum != signal.SIGINT else signal.default_int_handler)
+            random.seed()
+            sys.argv = [self.module + ".py"] + self.argv
+            runpy.run_module(self.module, run_name="__main__", alter_sys=True)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except KeyboardInterrupt:
+            code = 130
+        except BaseException:
+            logger.exception(f"{self.module} failed")
+        finally:
+            # Run the child's atexit handlers (e.g. PortAudio terminate), then leave without
+            # unwinding into the server's code
+            try:
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def _wait(self):
+        """Wait for the current child; returns its exit status."""
+        if not hasattr(os, "fork"):
+            return os.waitpid(self.child, 0)[1]
+        while True:
+            try:
+                _, status = os.waitpid(self.child, 0)
+                return os.waitstatus_to_exitcode(status)
+            except ChildProcessError:
+                return None
+            except InterruptedError:
+                continue
+
+    def _signal_child(self, signum):
+        if self.child is not None:
+            try:
+                os.kill(self.child, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_restart(self, signum, frame):
+        logger.info("SIGHUP: restarting the child")
+        self._restart_requested = True
+        self._signal_child(signal.SIGTERM)
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+        if signum != signal.SIGINT:
+            # SIGINT already reached the child through the process group
+            self._signal_child(signum)
+
+    def serve_forever(self):
+        """Fork the child, restart it whenever it exits, until SIGINT/SIGTERM."""
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._on_restart)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        failures = 0
+        while not self._stopping:
+            started = time.monotonic()
+            fork_start = time.perf_counter()
+            pid = self.spawn()
+            logger.info(f"Started {self.module} as pid {pid} in {(time.perf_counter() - fork_start) * 1000:.1f} ms")
+            code = self._wait()
+            uptime = time.monotonic() - started
+            logger.info(f"{self.module} (pid {pid}) exited with {code} after {uptime:.1f}s")
+            if self._stopping:
+                break
+            if self._restart_requested:
+                self._restart_requested = False
+                failures = 0
+                continue
+            failures = failures + 1 if uptime < MIN_UPTIME else 0
+            delay = RESTART_BACKOFF[min(failures, len(RESTART_BACKOFF) - 1)]
+            if delay:
+                logger.warning(f"{self.module} keeps exiting; restarting in {delay:.1f}s")
+                time.sleep(delay)
+        logger.info("Fork server stopped")
+
+
+# ---- startup benchmark -----------------------------------------------------------
+
+def _first_audio_after(server, count_before, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while len(server.first_audio_at) <= count_before:
+        if time.monotonic() > deadline:
+            raise TimeoutError("no audio reached the mock server")
+        time.sleep(0.001)
+    return server.first_audio_at[count_before]
+
+
+def bench(runs):
+    """Time to first audio sent: cold interpreter vs warm fork, for a headless gateway session."""
+    import asyncio
+    from mock_server import MockLiveServer
+
+    server = MockLiveServer(port=0)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run_server():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    # The mock server's thread must not exist in forked children, so it is started before
+    # preloading and the children never touch it.
+    threading.Thread(target=run_server, name="mock-server", daemon=True).start()
+    ready.wait()
+    child_args = ["--sessions", "1", "--uri", server.uri, "--stall-threshold", "0", "--max-duration", "30"]
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    cold = []
+    for _ in range(runs):
+        count = len(server.first_audio_at)
+        start = time.monotonic()
+        proc = subprocess.Popen([sys.executable, os.path.join(here, "gateway.py")] + child_args,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cold.append(_first_audio_after(server, count) - start)
+        proc.terminate()
+        proc.wait()
+
+    forkserver = ForkServer("gateway", child_args)
+    preload = forkserver.preload()
+    warm, fork_ms = [], []
+    for _ in range(runs):
+        count = len(server.first_audio_at)
+        start = time.monotonic()
+        pid = forkserver.spawn()
+        fork_ms.append((time.monotonic() - start) * 1000)
+        warm.append(_first_audio_after(server, count) - start)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    print(f"time to first audio sent, {runs} runs (median / min):")
+    print(f"  cold start  {statistics.median(cold) * 1000:8.1f} ms / {min(cold) * 1000:.1f} ms")
+    print(f"  warm fork   {statistics.median(warm) * 1000:8.1f} ms / {min(warm) * 1000:.1f} ms"
+          f"   (fork() {statistics.median(fork_ms):.1f} ms; one-time preload {preload * 1000:.0f} ms)")
+    print(f"  speedup     {statistics.median(cold) / statistics.median(warm):8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Preload the AudioLoop dependencies once and fork the app on every (re)start.",
+        usage="%(prog)s [--bench] [--runs N] [module [module args ...]]",
+    )
+    parser.add_argument("--bench", action="store_true", help="measure cold vs warm time to first audio sent")
+    parser.add_argument("--runs", type=int, default=5, help="benchmark runs per variant")
+    parser.add_argument("module", nargs="?", default="live_api_starter_desk", help="module to run in the child")
+    parser.add_argument("module_args", nargs=argparse.REMAINDER, help="arguments passed to the module")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - forkserver - %(levelname)s - %(message)s")
+    if args.bench:
+        # The benchmark's own mock server thread triggers the extra-threads warning; it is harmless here
+        logging.getLogger().setLevel(logging.ERROR)
+        bench(args.runs)
+    else:
+        forkserver = ForkServer(args.module, args.module_args)
+        forkserver.preload()
+        forkserver.serve_forever()
@@ -0,0 +1,457 @@
+# frame_archive.py
+
+"""
+Frame archive: the camera and screen frames that were actually sent, kept for audits.
+
+The AudioLoop variants hand every frame they send to a per-session `FrameArchive`,
+as the already-encoded payload (raw bytes, or the base64 str some variants send):
+
+    archive = open_archive("logs/frames", variant="live_api_starter")
+    archive.frame(data, "image/webp")       # returns at once; never blocks the caller
+
+Nothing is decoded, hashed or written on the caller's thread. `frame()` puts a
+reference on a bounded queue. When the writer falls behind, frames are dropped and
+counted in `audioloop_frame_archive_frames_total{outcome="dropped"}`, so capture is
+never slowed down. One writer thread per archive directory:
+
+    - hashes the decoded payload (BLAKE2b, 128 bits) and stores each distinct frame once,
+      as objects/<2 hex>/<digest>.<ext> (identical frames, e.g. a static screen resent
+      every refresh, cost one file);
+    - indexes every sent frame by session and wall-clock time in index.db (SQLite, WAL);
+    - keeps the objects under `max_bytes`, deleting the least recently sent ones, and
+      their index rows, first.
+
+Each batch of frames is one transaction. If it fails, the object files it wrote are
+deleted (no index row would ever evict them), its frames are counted as dropped,
+and its session rows are written with the next batch.
+
+Reading:
+
+    store = get_store("logs/frames")
+    store.sessions()                        # latest sessions with frame counts
+    store.frames(session_id, since=t0)      # Frame(session_id, t, digest, mime_type, size, path)
+
+    python frame_archive.py sessions
+    python frame_archive.py frames <session id prefix>
+    python frame_archive.py bench           # hook cost vs a synchronous save, and dedupe
+
+`save_frame()` writes a single encoded frame to a file from a short-lived thread; the
+variants use it for the first screenshot instead of re-encoding it in the capture thread.
+"""
+
+import argparse
+import atexit
+import base64
+import collections
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "frames")
+DEFAULT_MAX_BYTES = 512 * 1000 * 1000
+# Eviction frees space down to this share of max_bytes, so it does not run on every frame
+EVICT_TO = 0.9
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+
+Frame = collections.namedtuple("Frame", "session_id t digest mime_type size path")
+Session = collections.namedtuple("Session", "id started variant frames")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    variant TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    mime_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_sent REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_last_sent ON objects (last_sent);
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    t REAL NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_session_t ON frames (session_id, t);
+CREATE INDEX IF NOT EXISTS frames_digest ON frames (digest);
+"""
+
+ARCHIVE_FRAMES = metrics.REGISTRY.counter(
+    "audioloop_frame_archive_frames_total",
+    "Frames handed to the frame archive, by outcome (stored, duplicate, dropped or evicted).",
+    ["outcome"],
+)
+ARCHIVE_BYTES = metrics.REGISTRY.gauge(
+    "audioloop_frame_archive_bytes", "Bytes of frame objects in the frame archive."
+)
+
+
+def _extension(mime_type):
+    return EXTENSIONS.get(mime_type, ".bin")
+
+
+def _payload(data):
+    """Raw bytes of a frame payload that may be a base64 str."""
+    return base64.b64decode(data) if isinstance(data, str) else bytes(data)
+
+
+def _write_file(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def save_frame(data, mime_type, stem):
+    """
+    Write one encoded frame to `stem` plus the extension of `mime_type`, from a background thread.
+
+    Returns the path the frame will be written to.
+    """
+    path = stem + _extension(mime_type)
+
+    def write():
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            _write_file(path, _payload(data))
+            logger.info(f"Frame saved to {path}")
+        except Exception as e:
+            logger.error(f"Failed to save frame to {path}: {e}")
+
+    threading.Thread(target=write, name="frame-save", daemon=True).start()
+    return path
+
+
+class FrameStore:
+    """
+    A frame archive directory with a background writer.
+
+    Args:
+        root (str): Directory holding index.db and objects/; created if missing.
+        max_bytes (int): Objects are evicted, least recently sent first, beyond this size.
+        max_pending (int): Frames that may wait for the writer before new ones are dropped.
+        batch_size (int): Frames committed in one transaction at most.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, max_bytes=DEFAULT_MAX_BYTES, max_pending=256, batch_size=64):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._writer = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        self._local.conn = conn
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def _conn(self):
+        """Read connection of the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def object_path(self, digest, mime_type):
+        return os.path.join(self.root, "objects", digest[:2], digest + _extension(mime_type))
+
+    # ---- writing ---------------------------------------------------------------
+
+    def open_session(self, variant=None):
+        """Start a session; returns the `FrameArchive` its frames go through."""
+        session_id = uuid.uuid4().hex
+        self._put(("session", session_id, time.time(), variant), block=True)
+        return FrameArchive(self, session_id)
+
+    def _put(self, op, block=False):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="frame-archive", daemon=True)
+                    self._writer.start()
+                    atexit.register(self.close)
+        if block:
+            self._queue.put(op)
+            return
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            ARCHIVE_FRAMES.labels("dropped").inc()
+
+    def _write_loop(self):
+        conn = self._connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        ARCHIVE_BYTES.set(total)
+        running = True
+        # Session ops of a failed batch, written with the next one
+        retry = []
+        while running:
+            ops = [self._queue.get()]
+            while len(ops) < self.batch_size and ops[-1] is not None:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if ops[-1] is None:
+                running = False
+                ops.pop()
+            ops, retry = retry + ops, []
+            try:
+                total += self._write_batch(conn, ops)
+            except (sqlite3.Error, OSError, ValueError) as e:
+                # A lost session row would orphan the frames of the whole session, not just these
+                retry = [op for op in ops if op[0] == "session"]
+                lost = sum(op[0] == "frame" for op in ops)
+                ARCHIVE_FRAMES.labels("dropped").inc(lost)
+                logger.error(f"Archiving {lost} frames failed: {e}" + (f"; retrying {len(retry)} sessions"
+                                                                      if retry else ""))
+                if not running and retry:
+                    self._retry_sessions(conn, retry)
+            if total > self.max_bytes:
+                try:
+                    total -= self._evict(conn, total - int(self.max_bytes * EVICT_TO))
+                except (sqlite3.Error, OSError) as e:
+                    logger.error(f"Frame archive eviction failed: {e}")
+            ARCHIVE_BYTES.set(total)
+            for op in ops:
+                if op[0] == "flush":
+                    op[1].set()
+        conn.close()
+
+    def _retry_sessions(self, conn, ops):
+        """Last attempt at the session rows of a failed batch, as the writer stops."""
+        try:
+            self._write_batch(conn, ops)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Archiving {len(ops)} sessions failed: {e}")
+
+    def _write_batch(self, conn, ops):
+        """Store new objects and index every frame; returns the bytes added."""
+        added, stored, duplicates = 0, 0, 0
+        # Object files written by this batch, deleted if it rolls back
+        created = []
+        conn.execute("BEGIN")
+        try:
+            for op in ops:
+                if op[0] == "session":
+                    conn.execute("INSERT OR IGNORE INTO sessions (id, started, variant) VALUES (?, ?, ?)", op[1:])
+                elif op[0] == "frame":
+                    _, session_id, t, data, mime_type = op
+                    data = _payload(data)
+                    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+                    if conn.execute("UPDATE objects SET last_sent = ? WHERE digest = ?", (t, digest)).rowcount:
+                        duplicates += 1
+                    else:
+                        path = self.object_path(digest, mime_type)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        _write_file(path, data)
+                        created.append(path)
+                        conn.execute("INSERT INTO objects (digest, mime_type, size, last_sent) VALUES (?, ?, ?, ?)",
+                                     (digest, mime_type, len(data), t))
+                        added += len(data)
+                        stored += 1
+                    conn.execute("INSERT INTO frames (session_id, t, digest) VALUES (?, ?, ?)", (session_id, t, digest))
+            conn.execute("COMMIT")
+        except BaseException:
+            # No objects row refers to these files once the batch is rolled back
+            for path in created:
+                _remove(path)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        ARCHIVE_FRAMES.labels("stored").inc(stored)
+        ARCHIVE_FRAMES.labels("duplicate").inc(duplicates)
+        return added
+
+    def _evict(self, conn, nbytes):
+        """Delete the least recently sent objects totalling at least `nbytes`, and their frames."""
+        freed, victims = 0, []
+        for digest, mime_type, size in conn.execute("SELECT digest, mime_type, size FROM objects ORDER BY last_sent"):
+            if freed >= nbytes:
+                break
+            victims.append((digest, mime_type))
+            freed += size
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("DELETE FROM frames WHERE digest = ?", [(digest,) for digest, _ in victims])
+            conn.executemany("DELETE FROM objects WHERE digest = ?", [(digest,) for digest, _ in victims])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        for digest, mime_type in victims:
+            _remove(self.object_path(digest, mime_type))
+        ARCHIVE_FRAMES.labels("evicted").inc(len(victims))
+        logger.debug(f"Frame archive evicted {len(victims)} objects ({freed} bytes)")
+        return freed
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far is written."""
+        if self._writer is None:
+            return
+        done = threading.Event()
+        self._put(("flush", done), block=True)
+        done.wait(timeout)
+
+    def close(self):
+        """Write pending frames and stop the writer thread."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+            atexit.unregister(self.close)
+
+    # ---- reading ---------------------------------------------------------------
+
+    def sessions(self, limit=50):
+        rows = self._conn.execute(
+            "SELECT s.id, s.started, s.variant, COUNT(f.id) FROM sessions s LEFT JOIN frames f ON f.session_id = s.id "
+            "GROUP BY s.id ORDER BY s.started DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [Session(*row) for row in rows]
+
+    def frames(self, session_id, since=None, until=None, limit=None):
+        """Frames of a session in the order they were sent, optionally between two `time.time()` stamps."""
+        rows = self._conn.execute(
+            "SELECT f.session_id, f.t, f.digest, o.mime_type, o.size FROM frames f JOIN objects o USING (digest) "
+            "WHERE f.session_id = ? AND f.t >= ? AND f.t <= ? ORDER BY f.t LIMIT ?",
+            (session_id, since or 0.0, until or float("inf"), -1 if limit is None else limit),
+        ).fetchall()
+        return [Frame(*row, self.object_path(row[2], row[3])) for row in rows]
+
+
+class FrameArchive:
+    """
+    One session's view of a `FrameStore`. A no-op without a store, so the variants can call it unconditionally.
+    """
+
+    def __init__(self, store=None, session_id=None):
+        self.store = store
+        self.session_id = session_id
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def frame(self, data, mime_type):
+        """Archive a sent frame: raw bytes or a base64 str, as it went to the session."""
+        if self.store is not None:
+            self.store._put(("frame", self.session_id, time.time(), data, mime_type))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(root=DEFAULT_ROOT, max_bytes=DEFAULT_MAX_BYTES):
+    """The process-wide store for `root`; sessions sharing a directory share its writer thread."""
+    root = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = _stores[root] = FrameStore(root, max_bytes)
+        return store
+
+
+def open_archive(root, variant=None, max_bytes=DEFAULT_MAX_BYTES):
+    """A `FrameArchive` for a new session in `root`, or a no-op one if `root` is empty."""
+    if not root:
+        return FrameArchive()
+    return get_store(root, max_bytes).open_session(variant)
+
+
+def _bench(frames=300, distinct=30):
+    """Hook cost against a synchronous save, and what dedupe keeps, for a session resending frames."""
+    import tempfile
+
+    import frame_encoder
+
+    images = frame_encoder._synthetic_frames("screen", distinct, (1920, 1080))
+    encoder = frame_encoder.ScreenEncoder()
+    payloads = [(encoder.encode(image, 1024, 80), encoder.mime_type) for image in images]
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        for i, image in enumerate(images[:10]):
+            image.save(os.path.join(root, f"first_frame_{i}.jpg"), format="JPEG", quality=95)
+        sync_ms = (time.perf_counter() - start) / 10 * 1000
+
+        store = FrameStore(root)
+        archive = store.open_session("bench")
+        worst = total = 0.0
+        for i in range(frames):
+            # A static stretch resends the same few frames, as refreshes and the speech gate do
+            data, mime_type = payloads[(i // 10) % distinct if i % 3 else 0]
+            start = time.perf_counter()
+            archive.frame(data, mime_type)
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            worst = max(worst, elapsed)
+        store.flush()
+        indexed = store.frames(archive.session_id)
+        sent = sum(frame.size for frame in indexed)
+        stored = sum({frame.digest: frame.size for frame in indexed}.values())
+        store.close()
+
+    print(f"synchronous q95 JPEG save of a 1920x1080 frame: {sync_ms:.1f} ms")
+    print(f"archive.frame(): {total / frames * 1e6:.1f} us mean, {worst * 1e6:.0f} us worst")
+    print(f"{len(indexed)} of {frames} frames indexed ({frames - len(indexed)} dropped by the burst), "
+          f"{sent / 1000:.0f} KB in those frames, {stored / 1000:.0f} KB stored")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the frame archive.")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="frame archive directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("sessions", help="latest sessions")
+    frames = sub.add_parser("frames", help="frames of a session")
+    frames.add_argument("session", help="session id (or prefix)")
+    frames.add_argument("--limit", type=int, default=50)
+    sub.add_parser("bench", help="hook cost and dedupe on synthetic frames")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        _bench()
+    else:
+        store = FrameStore(args.root)
+        if args.command == "sessions":
+            for session in store.sessions():
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(session.started))
+                print(f"{stamp}  {session.id[:8]}  {session.variant or '-':<24}{session.frames} frames")
+        else:
+            matches = [s.id for s in store.sessions(limit=1000) if s.id.startswith(args.session)]
+            for frame in store.frames(matches[0] if matches else args.session, limit=args.limit):
+                stamp = time.strftime("%H:%M:%S", time.localtime(frame.t))
+                print(f"{stamp}.{int(frame.t % 1 * 1000):03d}  {frame.mime_type:<11}{frame.size:>8}  {frame.path}")
@@ -0,0 +1,480 @@
+# frame_encoder.py
+
+"""
+Frame encoding shared by the camera and screen capture paths.
+
+`encode_jpeg` encodes at a fixed quality. `JpegEncoder` can also cap the size of each
+frame: busy screens otherwise produce payloads several times larger than a camera
+frame at the same quality.
+
+    encoder = JpegEncoder(max_bytes=60_000)
+    data = encoder.encode(img, max_size=1024, quality=80)   # len(data) <= 60_000
+
+To stay within `max_bytes` the encoder searches for the highest quality (up to
+`quality`) that fits:
+
+    1. Encode at the quality the previous frame settled on. Consecutive frames
+       are similar, so this usually fits with some headroom and is the only encode.
+    2. Otherwise, binary-search quality on a proxy downscaled 2x per side (a quarter
+       of the pixels, so each probe costs about a quarter of a full encode). The
+       proxy's sizes are scaled by the full/proxy ratio measured in step 1.
+    3. Encode at the quality found. If that still overshoots, step quality down.
+       Below `MIN_QUALITY`, shrink the image instead, down to 16px on its longest side.
+
+A 16px JPEG at `MIN_QUALITY` is under 1 KB whatever its content, so the limit
+always holds; a `max_bytes` below `MIN_FRAME_BYTES` could not be met and is
+rejected with ValueError when the encoder is created.
+
+`ScreenEncoder` picks the codec and resolution per frame, because screens vary more
+than camera images do. JPEG blurs text and spends many bytes on its edges, while
+photo-like content compresses well as JPEG. `classify` measures two statistics
+on a ~256px sample:
+
+    edges  fraction of neighbouring pixels that differ sharply (text, UI borders)
+    flat   fraction of pixels in the 16 most common colours (flat UI backgrounds)
+
+and the frame is encoded by `CODECS[content]`:
+
+    text   flat >= 0.85         palette PNG: lossless-looking text, smallest for flat UIs
+    photo  edges < 0.02         JPEG at most PHOTO_MAX_SIZE px: nothing fine to keep
+    mixed  anything else        WebP (JPEG without WebP support): sharper edges per byte
+
+A text frame that exceeds `max_bytes` as PNG is encoded as a mixed frame instead.
+The mime_type of the last frame is `encoder.mime_type`. Decisions are counted in
+`audioloop_screen_frames_total{content,mime_type}`.
+
+PIL (and numpy, for `classify`) is imported by the caller or on first use, so
+importing this module stays cheap.
+
+`python frame_encoder.py` benchmarks both encoders on synthetic screen, mixed and
+camera frames, and checks the size limit on each frame.
+"""
+
+import collections
+import io
+import logging
+import math
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUALITY = 75
+MIN_QUALITY = 20
+# Smallest max_bytes accepted: a 16px frame at MIN_QUALITY always fits (JPEG headers alone are ~0.6 KB)
+MIN_FRAME_BYTES = 2000
+# Longest side, in pixels, the shrink step goes down to
+MIN_SIDE = 16
+# Step 1 result is kept if it is at least this fraction of max_bytes (or at the ceiling)
+FILL_TARGET = 0.8
+# Proxy downscale factor per side
+PROXY_FACTOR = 2
+# Images smaller than this per side are searched directly rather than through a proxy
+MIN_PROXY_SIDE = 64
+# Encoder settings per format; WebP's fastest method is still smaller than JPEG
+SAVE_OPTIONS = {"jpeg": {}, "webp": {"method": 0}, "png": {}}
+MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+# Content classification, see `classify`
+SAMPLE_WIDTH = 256
+EDGE_STEP = 96  # summed RGB difference between neighbours that counts as an edge
+TEXT_FLAT = 0.85
+PHOTO_EDGES = 0.02
+PHOTO_MAX_SIZE = 768
+PALETTE_COLORS = 64
+CODECS = {"text": "png", "mixed": "webp", "photo": "jpeg"}
+
+Classification = collections.namedtuple("Classification", "content edges flat")
+
+FRAME_ENCODES = metrics.REGISTRY.counter(
+    "audioloop_frame_encodes_total", "Image encodes by the frame encoder (full frames and search proxies).", ["kind"]
+)
+JPEG_QUALITY = metrics.REGISTRY.gauge(
+    "audioloop_jpeg_quality", "JPEG quality of the last frame encoded under a byte limit."
+)
+SCREEN_FRAMES = metrics.REGISTRY.counter(
+    "audioloop_screen_frames_total", "Screen frames by classified content and chosen codec.", ["content", "mime_type"]
+)
+SCREEN_BYTES = metrics.REGISTRY.counter(
+    "audioloop_screen_frame_bytes_total", "Encoded screen frame bytes by codec.", ["mime_type"]
+)
+
+
+def _save(img, quality, out, kind="full", format="jpeg"):
+    """Encode `img` into `out` from its start, reusing its buffer; returns the encoded size."""
+    out.seek(0)
+    if quality is None:
+        img.save(out, format=format, **SAVE_OPTIONS[format])
+    else:
+        img.save(out, format=format, quality=quality, **SAVE_OPTIONS[format])
+    FRAME_ENCODES.labels(kind).inc()
+    return out.tell()
+
+
+def _take(out, size):
+    """The first `size` bytes of `out` as the frame's one bytes object; `out` stays reusable."""
+    with out.getbuffer() as view, view[:size] as data:
+        return bytes(data)
+
+
+def _check_max_bytes(max_bytes):
+    if max_bytes is not None and max_bytes < MIN_FRAME_BYTES:
+        raise ValueError(f"Frame byte limit {max_bytes} is below the minimum of {MIN_FRAME_BYTES}")
+    return max_bytes
+
+
+def _prepare(img, max_size):
+    """`img` as RGB within `max_size` px per side; a new image when it must shrink, so `img` is never modified."""
+    if max(img.size) > max_size:
+        # Same size and filter as `thumbnail`, which would shrink a caller's reused `FrameBuffer` image
+        scale = max_size / max(img.size)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), reducing_gap=2.0)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+
+def encode_jpeg(img, max_size=1024, quality=None):
+    """
+    Downscale `img` (a PIL image) to fit `max_size` and encode it as JPEG.
+
+    `quality=None` uses PIL's default. `img` itself is not modified.
+    """
+    out = io.BytesIO()
+    return _take(out, _save(_prepare(img, max_size), quality, out))
+
+
+class FrameBuffer:
+    """
+    Downscales raw BGRA/BGRX captures (mss's `ScreenShot.raw`) into a reused RGB image.
+
+    The capture buffer is wrapped as a numpy view and box-filtered by an integer factor
+    into a preallocated buffer, which is unpacked into a preallocated PIL image. So a
+    frame allocates nothing frame-sized until the encoder's output. The factor is
+    rounded up, so a 1920px screen becomes 960px rather than 1024px, and a capture that
+    already fits `max_size` is unpacked directly.
+
+    `box` (left, top, right, bottom) takes a region of the capture instead of all of it.
+
+    The returned image is overwritten by the next call.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._sums = None
+        self._pixels = None
+        self._image = None
+
+    def from_bgra(self, raw, size, max_size=1024, box=None):
+        import numpy as np
+        import PIL.Image
+
+        width, height = size
+        left, top, right, bottom = box or (0, 0, width, height)
+        factor = max(1, -(-max(right - left, bottom - top) // max_size))
+        out_size = ((right - left) // factor, (bottom - top) // factor)
+        # A whole capture at factor 1 is unpacked straight from the capture buffer
+        direct = factor == 1 and box is None
+        key = (size, factor, direct)
+        if key != self._key or self._image.size != out_size:
+            # Box sums of up to 16x16 pixels fit in 16 bits
+            dtype = np.uint16 if factor <= 16 else np.uint32
+            self._sums = np.empty((out_size[1], out_size[0], 3), dtype) if factor > 1 else None
+            self._pixels = np.empty((out_size[1], out_size[0], 3), np.uint8) if not direct else None
+            self._image = PIL.Image.new("RGB", out_size)
+            self._key = key
+        if direct:
+            self._image.frombytes(raw, "raw", "BGRX")
+            return self._image
+
+        capture = np.frombuffer(raw, np.uint8).reshape(height, width, 4)
+        capture = capture[top:top + out_size[1] * factor, left:left + out_size[0] * factor, :3]
+        if factor == 1:
+            np.copyto(self._pixels, capture)
+            self._image.frombytes(self._pixels, "raw", "BGR")
+            return self._image
+        sums = self._sums
+        np.copyto(sums, capture[::factor, ::factor])
+        for dy in range(factor):
+            for dx in range(factor):
+                if dy or dx:
+                    np.add(sums, capture[dy::factor, dx::factor], out=sums)
+        np.floor_divide(sums, factor * factor, out=self._pixels, casting="unsafe")
+        self._image.frombytes(self._pixels, "raw", "BGR")
+        return self._image
+
+
+class JpegEncoder:
+    """
+    JPEG encoder with an optional per-frame byte limit (`WebpEncoder` for WebP).
+
+    Keep one per capture stream: the quality found for one frame is where the search for
+    the next frame starts.
+
+    Args:
+        max_bytes (int, optional): Largest encoded frame in bytes (before base64), at least
+            `MIN_FRAME_BYTES`. None encodes at the requested quality, like `encode_jpeg`.
+    """
+
+    format = "jpeg"
+    mime_type = "image/jpeg"
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = _check_max_bytes(max_bytes)
+        self.quality = None
+        self.size = None
+        # Encoder output buffers, reused from frame to frame
+        self._out = io.BytesIO()
+        self._scratch = io.BytesIO()
+
+    def encode(self, img, max_size=1024, quality=None):
+        """
+        Encode `img` (a PIL image, downscaled to fit `max_size`; `img` itself is not modified).
+
+        `quality` is the ceiling of the search; None means PIL's default of 75.
+        `self.quality` and `self.size` describe the frame that was returned.
+        """
+        img = _prepare(img, max_size)
+        self.size = img.size
+        if not self.max_bytes:
+            self.quality = quality
+            return _take(self._out, _save(img, quality, self._out, format=self.format))
+
+        ceiling = quality or DEFAULT_QUALITY
+        q = min(self.quality or ceiling, ceiling)
+        size = _save(img, q, self._out, format=self.format)
+        fits = size <= self.max_bytes
+        if fits and (q >= ceiling or size >= FILL_TARGET * self.max_bytes):
+            return self._done(q, size)
+
+        # Search on a proxy for the best quality in the direction step 1 pointed
+        if fits:
+            lo, hi = q, ceiling
+        else:
+            lo, hi = MIN_QUALITY, q - 1
+        if lo < hi:
+            lo = self._search(img, q, size, lo, hi)
+        if lo != q:
+            q = lo
+            size = _save(img, q, self._out, format=self.format)
+
+        # The proxy estimate is not exact: step down until the frame fits
+        while size > self.max_bytes and q > MIN_QUALITY:
+            q = max(MIN_QUALITY, q - max(2, round(q * (1 - self.max_bytes / size))))
+            size = _save(img, q, self._out, format=self.format)
+
+        # Even the lowest quality is too large: fewer pixels
+        while size > self.max_bytes and max(img.size) > MIN_SIDE:
+            scale = max(0.5, min(0.95, math.sqrt(self.max_bytes / size) * 0.95))
+            img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+            self.size = img.size
+            size = _save(img, q, self._out, format=self.format)
+        if size > self.max_bytes:
+            raise ValueError(f"Cannot encode a frame within {self.max_bytes} bytes ({size} bytes at {img.size})")
+        return self._done(q, size)
+
+    def _search(self, img, q, full_bytes, lo, hi):
+        """Highest quality in [lo, hi] whose estimated size fits; `lo` is assumed to fit."""
+        if min(img.size) >= MIN_PROXY_SIDE * PROXY_FACTOR:
+            proxy = img.reduce(PROXY_FACTOR)
+            ratio = full_bytes / _save(proxy, q, self._scratch, "proxy", self.format)
+        else:
+            proxy, ratio = img, 1.0
+        kind = "proxy" if proxy is not img else "full"
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if _save(proxy, mid, self._scratch, kind, self.format) * ratio <= self.max_bytes:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def _done(self, q, size):
+        self.quality = q
+        JPEG_QUALITY.set(q)
+        return _take(self._out, size)
+
+class WebpEncoder(JpegEncoder):
+    """`JpegEncoder` producing WebP, which keeps edges sharper at the same size."""
+
+    format = "webp"
+    mime_type = "image/webp"
+
+
+def classify(img):
+    """
+    Classify a frame's content as "text", "mixed" or "photo" (see the module docstring).
+
+    Takes about 3 ms for a 1024px frame; numpy is imported on first use.
+    """
+    import numpy as np
+
+    factor = max(1, img.width // SAMPLE_WIDTH)
+    sample = np.asarray(img.reduce(factor) if factor > 1 else img)
+    gray = sample.astype(np.int16).sum(axis=2)
+    edges = float((np.abs(np.diff(gray, axis=1)) > EDGE_STEP).mean() + (np.abs(np.diff(gray, axis=0)) > EDGE_STEP).mean()) / 2
+    # Colours quantized to 5 bits per channel
+    packed = ((sample[..., 0] >> 3).astype(np.int32) << 10) | ((sample[..., 1] >> 3).astype(np.int32) << 5) | (sample[..., 2] >> 3)
+    counts = np.bincount(packed.ravel(), minlength=1 << 15)
+    flat = float(np.sort(counts)[-16:].sum()) / packed.size
+    if flat >= TEXT_FLAT:
+        content = "text"
+    elif edges < PHOTO_EDGES:
+        content = "photo"
+    else:
+        content = "mixed"
+    return Classification(content, edges, flat)
+
+
+class ScreenEncoder:
+    """
+    Per-frame codec and resolution choice for screen captures.
+
+    Same interface as `JpegEncoder`, plus `mime_type` and `classification` of the last frame.
+
+    Args:
+        max_bytes (int, optional): Largest encoded frame in bytes (before base64), at least
+            `MIN_FRAME_BYTES`.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = _check_max_bytes(max_bytes)
+        self.mime_type = None
+        self.quality = None
+        self.size = None
+        self.classification = None
+        self._lossy = None
+        self._out = io.BytesIO()
+
+    def _encoders(self):
+        import PIL.features
+
+        webp = WebpEncoder if PIL.features.check("webp") else JpegEncoder
+        if webp is JpegEncoder:
+            logger.info("PIL has no WebP support; mixed screen content is encoded as JPEG")
+        return {"mixed": webp(self.max_bytes), "photo": JpegEncoder(self.max_bytes)}
+
+    def encode(self, img, max_size=1024, quality=None):
+        """Encode `img` (a PIL image, downscaled to fit `max_size`) with the codec its content calls for."""
+        if self._lossy is None:
+            self._lossy = self._encoders()
+        img = _prepare(img, max_size)
+        classification = classify(img)
+        content = classification.content
+        data = None
+        if content == "text":
+            import PIL.Image
+
+            palette = img.quantize(PALETTE_COLORS, method=PIL.Image.Quantize.FASTOCTREE)
+            size = _save(palette, None, self._out, format=CODECS["text"])
+            if self.max_bytes and size > self.max_bytes:
+                content = "mixed"
+            else:
+                data = _take(self._out, size)
+                self.mime_type = MIME_TYPES[CODECS["text"]]
+                self.quality = None
+                self.size = img.size
+        if data is None:
+            encoder = self._lossy[content]
+            bound = min(max_size, PHOTO_MAX_SIZE) if content == "photo" else max_size
+            data = encoder.encode(img, bound, quality)
+            self.mime_type = encoder.mime_type
+            self.quality = encoder.quality
+            self.size = encoder.size
+        if self.classification is None or self.classification.content != classification.content:
+            logger.debug(f"Screen content {classification.content} (edges {classification.edges:.3f}, "
+                         f"flat {classification.flat:.2f}): {self.mime_type} at {self.size}")
+        self.classification = classification
+        SCREEN_FRAMES.labels(content, self.mime_type).inc()
+        SCREEN_BYTES.labels(self.mime_type).inc(len(data))
+        return data
+
+
+def _synthetic_frames(kind, count, size=(1920, 1080)):
+    """Frames for the benchmark: a text editor ("screen"), the same with a picture ("mixed"), or "camera"."""
+    import random
+
+    import PIL.Image
+    import PIL.ImageDraw
+    import PIL.ImageFilter
+    import PIL.ImageFont
+
+    rng = random.Random(0)
+    width, height = size
+    font = PIL.ImageFont.load_default(size=15)
+    gradient = PIL.Image.linear_gradient("L")
+    scene = PIL.Image.merge("RGB", (gradient.resize(size), gradient.rotate(180).resize(size),
+                                    PIL.Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 60)))
+    scene = scene.filter(PIL.ImageFilter.GaussianBlur(6))
+    frames = []
+    for i in range(count):
+        if kind == "camera":
+            # A slowly panning scene with sensor noise
+            img = scene.transform(size, PIL.Image.Transform.AFFINE, (1, 0, i * 4, 0, 1, i * 2))
+            noise = PIL.Image.merge("RGB", [PIL.Image.effect_noise(size, 10) for _ in range(3)])
+            frames.append(PIL.Image.blend(img, noise, 0.08))
+            continue
+        img = PIL.Image.new("RGB", size, (255, 255, 255))
+        draw = PIL.ImageDraw.Draw(img)
+        draw.rectangle((0, 0, width, 40), fill=(45, 45, 48))
+        draw.rectangle((0, 40, 260, height), fill=(240, 240, 243))
+        for item in range(20):
+            draw.text((16, 60 + item * 26), f"module_{item}.py", fill=(60, 60, 60), font=font)
+        # Scrolling text
+        for line in range((height - 60) // 22):
+            words = " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9)))
+                             for _ in range(rng.randint(3, 14)))
+            color = rng.choice(((20, 20, 20), (20, 20, 20), (0, 90, 180), (160, 30, 30)))
+            draw.text((290 + rng.choice((0, 0, 30, 60)), 60 + line * 22 - (i * 5) % 22), words, fill=color, font=font)
+        if kind == "mixed":
+            picture = scene.resize((width // 2, height // 2)).rotate(i * 3)
+            img.paste(picture, (width // 2 - 40, height // 4))
+        frames.append(img)
+    return frames
+
+
+def _bench(label, frames, encoder, max_size, quality):
+    import time
+
+    encodes_before = {kind: FRAME_ENCODES.labels(kind).value for kind in ("full", "proxy")}
+    sizes, seconds, decisions = [], [], collections.Counter()
+    for frame in frames:
+        img = frame.copy()
+        start = time.perf_counter()
+        data = encoder.encode(img, max_size, quality)
+        seconds.append(time.perf_counter() - start)
+        sizes.append(len(data))
+        decisions[f"{getattr(encoder, 'mime_type', 'image/jpeg')} q{encoder.quality or '-'} {encoder.size[0]}px"] += 1
+        if encoder.max_bytes and len(data) > encoder.max_bytes:
+            raise AssertionError(f"{label}: frame of {len(data)} bytes exceeds max_bytes={encoder.max_bytes}")
+    n = len(frames)
+    encodes = {kind: (FRAME_ENCODES.labels(kind).value - before) / n for kind, before in encodes_before.items()}
+    seconds.sort()
+    print(f"{label:26} size avg {sum(sizes) / n / 1000:6.1f} KB max {max(sizes) / 1000:6.1f} KB"
+          f"  encodes/frame {encodes['full']:.2f} + {encodes['proxy']:.2f} proxy"
+          f"  time p50 {seconds[n // 2] * 1000:5.1f} ms max {seconds[-1] * 1000:5.1f} ms")
+    for decision, frames_count in decisions.most_common(3):
+        print(f"{'':28}{frames_count:3} x {decision}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark frame encoding: byte limits and per-content codecs.")
+    parser.add_argument("--frames", type=int, default=30, help="frames per content kind")
+    parser.add_argument("--max-size", type=int, default=1024, help="longest side after downscaling")
+    parser.add_argument("--quality", type=int, default=80, help="quality ceiling")
+    parser.add_argument("--max-kb", type=float, nargs="+", default=[40, 80],
+                        help="per-frame limits to benchmark, in KB (an unlimited run is always included)")
+    args = parser.parse_args()
+
+    for kind in ("screen", "mixed", "camera"):
+        frames = _synthetic_frames(kind, args.frames)
+        for max_bytes in [None] + [int(kb * 1000) for kb in args.max_kb]:
+            for encoder in (JpegEncoder(max_bytes), ScreenEncoder(max_bytes)):
+                label = f"{kind} {type(encoder).__name__} {max_bytes // 1000 if max_bytes else '-'} KB"
+                _bench(label, frames, encoder, args.max_size, args.quality)
+
+
+if __name__ == "__main__":
+    main()
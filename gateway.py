@@ -0,0 +1,593 @@
+# gateway.py
+
+"""
+Headless multi-session gateway: many independent AudioLoop sessions in one process.
+
+Each AudioLoop variant is built around one session on the default microphone,
+speaker and camera. The gateway instead hosts N `HeadlessAudioLoop` sessions on a
+single event loop, each with its own queues and virtual sources/sinks:
+
+    - audio source: a speech-like test tone or a 16 kHz mono WAV file, paced in real time;
+    - video source: a fixed JPEG (or synthetic payload) sent at a fixed interval;
+    - audio sink: a virtual speaker that consumes the model's audio at 24 kHz;
+    - text sink: an optional callback per session.
+
+All sessions share one genai client, one TLS context and the process's metrics,
+watchdog and profiler. Every live session still needs its own websocket, but
+nothing else is set up per session. `SessionLimits` caps what a single session
+can consume:
+
+    max_duration       seconds before the session is closed;
+    max_upload_rate    bytes/s of realtime input (audio and frames) it may send;
+    max_audio_queue    received audio chunks buffered for playback; older chunks are dropped.
+
+A scaling benchmark runs against the local mock server (`mock_server.py`), which
+runs in a separate process so that only the gateway's CPU is measured:
+
+    python gateway.py --bench --sessions 10,50,100 --duration 10
+
+Serving:
+
+    python gateway.py --sessions 20 --mode camera --uri ws://127.0.0.1:8765 --metrics-port 9100
+
+Without `--uri` the sessions connect to the real Live API with GEMINI_API_KEY.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import math
+import os
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import time
+import wave
+
+import metrics
+import profiler
+from audio_loop import AudioLoop, CHUNK_SIZE, SEND_SAMPLE_RATE, RECEIVE_SAMPLE_RATE, setup_logging
+from loop_watchdog import LoopWatchdog
+
+logger = logging.getLogger(__name__)
+
+MODEL = "models/gemini-2.0-flash-exp"
+AUDIO_CONFIG = {"generation_config": {"response_modalities": ["AUDIO"]}}
+TEXT_CONFIG = {"generation_config": {"response_modalities": ["TEXT"]}}
+
+GATEWAY_SESSIONS = metrics.REGISTRY.gauge(
+    "audioloop_gateway_sessions", "Sessions currently hosted by the gateway."
+)
+GATEWAY_LIMIT_EVENTS = metrics.REGISTRY.counter(
+    "audioloop_gateway_limit_events_total", "Times a per-session limit was enforced.", ["limit"]
+)
+
+_ssl_context = None
+
+
+def shared_ssl_context():
+    """One TLS context for every session: loading the CA bundle costs milliseconds and ~1 MB each."""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+@contextlib.asynccontextmanager
+async def connect_live(client, model, config, uri=None):
+    """
+    Open a live session like `client.aio.live.connect`, but reusing the shared TLS
+    context and optionally connecting to `uri` (e.g. the ws:// mock server).
+
+    Mirrors the API-key branch of `AsyncLive.connect` in google-genai 0.2.2; other
+    auth setups fall back to the SDK's own connect.
+    """
+    from google.genai import _transformers
+    from google.genai.live import AsyncSession
+    from websockets.asyncio.client import connect
+
+    api_client = client._api_client
+    if not api_client.api_key and uri is None:
+        async with client.aio.live.connect(model=model, config=config) as session:
+            yield session
+        return
+
+    if uri is None:
+        base_url = api_client._websocket_base_url()
+        version = api_client._http_options["api_version"]
+        uri = (f"{base_url}/ws/google.ai.generativelanguage.{version}.GenerativeService."
+               f"BidiGenerateContent?key={api_client.api_key}")
+    request = json.dumps(client.aio.live._LiveSetup_to_mldev(
+        model=_transformers.t_model(api_client, model), config=config
+    ))
+    ssl_context = shared_ssl_context() if uri.startswith("wss:") else None
+    # Payloads are base64 of PCM/JPEG: permessage-deflate burns CPU on every message for ~25% savings
+    async with connect(uri, additional_headers=api_client._http_options["headers"], ssl=ssl_context,
+                       max_size=None, compression=None) as ws:
+        await ws.send(request)
+        logger.debug(await ws.recv(decode=False))
+        yield AsyncSession(api_client=api_client, websocket=ws)
+
+
+# ---- virtual sources and sinks -----------------------------------------------
+
+class ToneSource:
+    """
+    Speech-like PCM source: `speech` seconds of a tone, then `silence` seconds of silence,
+    repeated. Chunks are paced in real time like a microphone.
+    """
+
+    def __init__(self, speech=2.0, silence=2.0, amplitude=3000, frequency=220, chunk_frames=CHUNK_SIZE,
+                 rate=SEND_SAMPLE_RATE):
+        self.chunk_frames = chunk_frames
+        self.rate = rate
+        period = rate // frequency
+        tone = bytearray()
+        for i in range(chunk_frames):
+            tone += (amplitude if i % period < period // 2 else -amplitude).to_bytes(2, "little", signed=True)
+        self._tone = bytes(tone)
+        self._silence = bytes(chunk_frames * 2)
+        chunk_seconds = chunk_frames / rate
+        self._pattern = ([self._tone] * max(1, round(speech / chunk_seconds))
+                         + [self._silence] * round(silence / chunk_seconds))
+
+    async def chunks(self):
+        async for chunk in _paced(itertools.cycle(self._pattern), self.chunk_frames / self.rate):
+            yield chunk
+
+
+class WavSource:
+    """PCM source reading a 16-bit mono WAV file (16 kHz), looped and paced in real time."""
+
+    def __init__(self, path, chunk_frames=CHUNK_SIZE, loop=True):
+        with wave.open(path, "rb") as f:
+            if f.getsampwidth() != 2 or f.getnchannels() != 1 or f.getframerate() != SEND_SAMPLE_RATE:
+                raise ValueError(f"{path}: expected 16-bit mono {SEND_SAMPLE_RATE} Hz PCM")
+            pcm = f.readframes(f.getnframes())
+        step = chunk_frames * 2
+        self._chunks = [pcm[i:i + step] for i in range(0, len(pcm), step)]
+        self.chunk_frames = chunk_frames
+        self.loop = loop
+
+    async def chunks(self):
+        source = itertools.cycle(self._chunks) if self.loop else iter(self._chunks)
+        async for chunk in _paced(source, self.chunk_frames / SEND_SAMPLE_RATE):
+            yield chunk
+
+
+class FrameSource:
+    """Video source yielding the same encoded frame every `interval` seconds."""
+
+    def __init__(self, data=None, mime_type="image/jpeg", size=50_000, interval=1.0):
+        # The mock server never decodes frames, so a synthetic payload of realistic size will do
+        self.data = data if data is not None else b"\xff\xd8" + os.urandom(size)
+        self.mime_type = mime_type
+        self.interval = interval
+
+    @classmethod
+    def from_file(cls, path, interval=1.0):
+        with open(path, "rb") as f:
+            data = f.read()
+        mime_type = "image/png" if path.lower().endswith(".png") else "image/jpeg"
+        return cls(data, mime_type, interval=interval)
+
+    async def frames(self):
+        async for frame in _paced(itertools.repeat(self.data), self.interval):
+            yield frame
+
+
+async def _paced(items, period):
+    """Yield from `items` one per `period` seconds, on an absolute schedule so delays do not drift."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    for item in items:
+        yield item
+        deadline += period
+        delay = deadline - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            deadline = loop.time()
+
+
+class _RateLimit:
+    """Token bucket for bytes/s; `acquire` waits until `nbytes` may be sent."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self, nbytes):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            GATEWAY_LIMIT_EVENTS.labels("upload_rate").inc()
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class SessionLimits:
+    """Per-session resource limits. None disables a limit."""
+
+    def __init__(self, max_duration=None, max_upload_rate=None, max_audio_queue=50):
+        self.max_duration = max_duration
+        self.max_upload_rate = max_upload_rate
+        self.max_audio_queue = max_audio_queue
+
+
+class HeadlessAudioLoop(AudioLoop):
+    """
+    An `AudioLoop` session with virtual sources and sinks instead of devices.
+
+    Args:
+        session_id (str): Name used in logs and task names.
+        audio_source: Object with an async `chunks()` generator of 16 kHz PCM, or None for no audio.
+        frame_source (FrameSource, optional): Frames sent in camera/screen mode.
+        on_audio (callable, optional): Called with each chunk of model audio, at playback pace.
+        on_text (callable, optional): Called with each text chunk from the model.
+        limits (SessionLimits, optional): Resource limits for this session.
+        uri (str, optional): Websocket URI to connect to instead of the Live API.
+    """
+
+    watch_queues = False
+
+    def __init__(self, session_id, audio_source=None, frame_source=None, on_audio=None, on_text=None,
+                 limits=None, uri=None):
+        super().__init__(asyncio.Queue(), display_text_callback=on_text, stall_threshold=None)
+        self.session_id = session_id
+        self.audio_source = audio_source
+        self.frame_source = frame_source
+        self.on_audio = on_audio
+        self.limits = limits or SessionLimits()
+        self.uri = uri
+        self._upload_limit = _RateLimit(self.limits.max_upload_rate) if self.limits.max_upload_rate else None
+        self.stats = {"audio_sent": 0, "frames_sent": 0, "audio_played": 0, "audio_dropped": 0}
+
+    def connect(self, model, config, client):
+        return connect_live(client, model, config, self.uri)
+
+    def stop(self):
+        """Ask the session to end; `run` returns once its tasks are torn down."""
+        self.user_input_queue.put_nowait("q")
+
+    async def _upload(self, nbytes):
+        if self._upload_limit is not None:
+            await self._upload_limit.acquire(nbytes)
+
+    async def listen_audio(self):
+        if self.audio_source is None:
+            return
+        async for chunk in self.audio_source.chunks():
+            await self._upload(len(chunk))
+            self.tracer.on_user_audio(chunk)
+            await self.out_queue.put({"data": chunk, "mime_type": "audio/pcm"})
+            self.stats["audio_sent"] += len(chunk)
+
+    async def get_frames(self):
+        if self.frame_source is None:
+            return
+        async for frame in self.frame_source.frames():
+            await self._upload(len(frame))
+            await self.out_queue.put({"data": frame, "mime_type": self.frame_source.mime_type})
+            self.stats["frames_sent"] += 1
+
+    get_screen = get_frames
+
+    async def play_audio(self):
+        """Virtual speaker: consumes model audio at 24 kHz and enforces `max_audio_queue`."""
+        loop = asyncio.get_running_loop()
+        playhead = loop.time()
+        max_queue = self.limits.max_audio_queue
+        while True:
+            if self.audio_in_queue.empty():
+                if self._turn_active:
+                    metrics.PLAYBACK_UNDERRUNS.inc()
+                self.tracer.on_playback_idle()
+            data = await self.audio_in_queue.get()
+            while max_queue and self.audio_in_queue.qsize() > max_queue:
+                self.stats["audio_dropped"] += len(self.audio_in_queue.get_nowait())
+                GATEWAY_LIMIT_EVENTS.labels("audio_queue").inc()
+            start = time.monotonic()
+            playhead = max(playhead, loop.time()) + len(data) / (2 * RECEIVE_SAMPLE_RATE)
+            if self.on_audio is not None:
+                self.on_audio(data)
+            self.stats["audio_played"] += len(data)
+            await asyncio.sleep(playhead - loop.time())
+            self.tracer.on_playback(start, time.monotonic())
+
+
+class GatewayFull(RuntimeError):
+    """Raised by `Gateway.start_session` when `max_sessions` sessions are running."""
+
+
+class Gateway:
+    """
+    Hosts many `HeadlessAudioLoop` sessions on the running event loop.
+
+    Args:
+        client (genai.Client): Client shared by all sessions.
+        model (str): Model every session connects to.
+        config (dict): Live session config.
+        mode (str): 'text', 'camera' or 'screen'; camera/screen send frames from the frame source.
+        uri (str, optional): Connect to this websocket URI (e.g. the mock server) instead of the API.
+        limits (SessionLimits, optional): Default limits for new sessions.
+        max_sessions (int): Upper bound on concurrent sessions.
+    """
+
+    def __init__(self, client, model=MODEL, config=AUDIO_CONFIG, mode="camera", uri=None, limits=None,
+                 max_sessions=500):
+        self.client = client
+        self.model = model
+        self.config = config
+        self.mode = mode
+        self.uri = uri
+        self.limits = limits or SessionLimits()
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self._tasks = {}
+        # Called with each session after it ends, e.g. to report back to a supervisor
+        self.on_session_end = None
+        self._ids = itertools.count(1)
+        metrics.QUEUE_DEPTH.labels("audio_in").set_function(
+            lambda: sum(s.audio_in_queue.qsize() for s in list(self.sessions.values()) if s.audio_in_queue)
+        )
+        metrics.QUEUE_DEPTH.labels("out").set_function(
+            lambda: sum(s.out_queue.qsize() for s in list(self.sessions.values()) if s.out_queue)
+        )
+        GATEWAY_SESSIONS.set_function(lambda: len(self.sessions))
+        metrics.register_command("sessions", self.describe)
+
+    def start_session(self, session_id=None, audio_source=None, frame_source=None, on_audio=None,
+                      on_text=None, limits=None):
+        """Create and start a session; returns the `HeadlessAudioLoop`."""
+        if len(self.sessions) >= self.max_sessions:
+            raise GatewayFull(f"Gateway is full ({self.max_sessions} sessions)")
+        session_id = session_id or f"s{next(self._ids)}"
+        if session_id in self.sessions:
+            raise ValueError(f"Session {session_id} already exists")
+        limits = limits or self.limits
+        session = HeadlessAudioLoop(
+            session_id,
+            audio_source=audio_source if audio_source is not None else ToneSource(),
+            frame_source=frame_source if frame_source is not None else FrameSource(),
+            on_audio=on_audio,
+            on_text=on_text,
+            limits=limits,
+            uri=self.uri,
+        )
+        self.sessions[session_id] = session
+        task = asyncio.create_task(self._run_session(session), name=f"session-{session_id}")
+        self._tasks[session_id] = task
+        if limits.max_duration:
+            asyncio.get_running_loop().call_later(limits.max_duration, self._expire, session)
+        logger.info(f"Session {session_id} started ({len(self.sessions)} running)")
+        return session
+
+    def stop_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.stop()
+
+    async def stop_all(self):
+        for session in list(self.sessions.values()):
+            session.stop()
+        await self.wait()
+
+    async def wait(self):
+        """Wait until every session has ended."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    def describe(self):
+        """Session summary for the `sessions` control command."""
+        return {sid: dict(s.stats) for sid, s in list(self.sessions.items())}
+
+    def _expire(self, session):
+        if session.session_id in self.sessions:
+            GATEWAY_LIMIT_EVENTS.labels("duration").inc()
+            logger.info(f"Session {session.session_id} reached its {session.limits.max_duration}s limit")
+            session.stop()
+
+    async def _run_session(self, session):
+        try:
+            await session.run(self.model, self.config, self.mode, self.client)
+        finally:
+            self.sessions.pop(session.session_id, None)
+            self._tasks.pop(session.session_id, None)
+            logger.info(f"Session {session.session_id} ended ({len(self.sessions)} running)")
+            if self.on_session_end is not None:
+                self.on_session_end(session)
+
+
+def make_client(uri=None):
+    """One genai client for the whole gateway; the mock server accepts any API key."""
+    from google import genai
+
+    api_key = "mock" if uri else os.environ.get("GEMINI_API_KEY")
+    return genai.Client(api_key=api_key, http_options={"api_version": "v1alpha"})
+
+
+# ---- benchmark -----------------------------------------------------------------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _mock_server_process(audio_turn_seconds=4.0):
+    """Run mock_server.py in a child process so its CPU time is not charged to the gateway."""
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py"),
+         "--port", str(port), "--audio-turn-seconds", str(audio_turn_seconds)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("mock_server.py did not start")
+                time.sleep(0.05)
+        yield f"ws://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+async def _measure(client, uri, mode, sessions, duration, warmup=1.0):
+    gateway = Gateway(client, uri=uri, mode=mode, max_sessions=sessions)
+    started = [gateway.start_session() for _ in range(sessions)]
+    await asyncio.sleep(warmup)
+
+    lags = []
+
+    async def probe():
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + 0.05
+            await asyncio.sleep(0.05)
+            lags.append(max(0.0, loop.time() - expected))
+
+    probe_task = asyncio.create_task(probe())
+    sent_before = sum(s.stats["audio_sent"] for s in started)
+    cpu_before, wall_before = time.process_time(), time.perf_counter()
+    await asyncio.sleep(duration)
+    cpu, wall = time.process_time() - cpu_before, time.perf_counter() - wall_before
+    sent = sum(s.stats["audio_sent"] for s in started) - sent_before
+    probe_task.cancel()
+    alive = len(gateway.sessions)
+    await gateway.stop_all()
+
+    utilization = cpu / wall
+    realtime = sent / (2 * SEND_SAMPLE_RATE) / (sessions * wall)
+    lag_p99 = statistics.quantiles(lags, n=100)[98] if len(lags) >= 2 else 0.0
+    return {
+        "sessions": sessions,
+        "alive": alive,
+        "cpu": utilization,
+        "cpu_ms_per_session_s": cpu * 1000 / (sessions * wall),
+        "sessions_per_core": sessions / utilization if utilization else math.inf,
+        "realtime": realtime,
+        "lag_p99_ms": lag_p99 * 1000,
+    }
+
+
+def bench(args):
+    """Scaling benchmark: sessions per core against the local mock server."""
+    counts = [int(n) for n in args.sessions.split(",")]
+    client = make_client(uri="mock")
+    results = []
+    with _mock_server_process() as uri:
+        print(f"mock server: {uri}; mode {args.mode}; {args.duration:.0f}s per step")
+        print(f"{'sessions':>8}{'alive':>7}{'cpu %':>8}{'ms/sess-s':>11}{'sess/core':>11}"
+              f"{'realtime':>10}{'lag p99 ms':>12}")
+        for n in counts:
+            r = asyncio.run(_measure(client, uri, args.mode, n, args.duration))
+            results.append(r)
+            print(f"{r['sessions']:>8}{r['alive']:>7}{r['cpu'] * 100:>8.1f}{r['cpu_ms_per_session_s']:>11.2f}"
+                  f"{r['sessions_per_core']:>11.0f}{r['realtime']:>10.3f}{r['lag_p99_ms']:>12.1f}")
+    # Only steps where every session stayed connected and streamed in real time count. Loop lag is
+    # reported but not used: on a machine with few cores it mostly measures the mock server.
+    healthy = [r for r in results if r["alive"] == r["sessions"] and r["realtime"] >= 0.95]
+    if healthy:
+        best = max(healthy, key=lambda r: r["sessions"])
+        print(f"\n~{best['sessions_per_core']:.0f} sessions per core "
+              f"({best['cpu_ms_per_session_s']:.2f} ms CPU per session-second at {best['sessions']} sessions, "
+              f"{os.cpu_count()} cores)")
+    else:
+        print("\nNo step kept every session real time; try fewer sessions.")
+
+
+def add_gateway_arguments(parser):
+    """Options shared by the gateway and the multi-process supervisor."""
+    parser.add_argument("--mode", default="camera", choices=["text", "camera", "screen"],
+                        help="camera/screen also stream frames from the frame source")
+    parser.add_argument("--uri", default=None, help="connect to this websocket URI, e.g. a mock_server.py")
+    parser.add_argument("--text", action="store_true", help="ask for TEXT instead of AUDIO responses")
+    parser.add_argument("--wav", default=None, help="16 kHz mono WAV file used as every session's microphone")
+    parser.add_argument("--frame", default=None, help="JPEG/PNG file used as every session's camera frame")
+    parser.add_argument("--max-sessions", type=int, default=500)
+    parser.add_argument("--max-duration", type=float, default=None, help="close sessions after this many seconds")
+    parser.add_argument("--max-upload-rate", type=float, default=None, help="bytes/s of realtime input per session")
+    parser.add_argument("--max-audio-queue", type=int, default=50, help="buffered playback chunks per session")
+    parser.add_argument("--stall-threshold", type=float, default=0.2,
+                        help="report event loop stalls longer than this many seconds (0 disables)")
+
+
+def gateway_from_args(args):
+    """Build a `Gateway` from the options added by `add_gateway_arguments`."""
+    limits = SessionLimits(args.max_duration, args.max_upload_rate, args.max_audio_queue)
+    return Gateway(make_client(args.uri), config=TEXT_CONFIG if args.text else AUDIO_CONFIG, mode=args.mode,
+                   uri=args.uri, limits=limits, max_sessions=args.max_sessions)
+
+
+_frame_sources = {}
+
+
+def session_sources(wav=None, frame=None):
+    """Keyword arguments for `Gateway.start_session`; frame files are read once and shared."""
+    if frame and frame not in _frame_sources:
+        _frame_sources[frame] = FrameSource.from_file(frame)
+    return {
+        "audio_source": WavSource(wav) if wav else ToneSource(),
+        "frame_source": _frame_sources.get(frame),
+    }
+
+
+async def serve(args):
+    gateway = gateway_from_args(args)
+    for _ in range(int(args.sessions)):
+        gateway.start_session(**session_sources(args.wav, args.frame))
+    watchdog = asyncio.create_task(LoopWatchdog(threshold=args.stall_threshold).run()) if args.stall_threshold else None
+    try:
+        await gateway.wait()
+    finally:
+        if watchdog:
+            watchdog.cancel()
+        await gateway.stop_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host many headless AudioLoop sessions in one process.")
+    parser.add_argument("--sessions", type=str, default="10",
+                        help="number of sessions (with --bench: comma-separated steps, e.g. 10,50,100)")
+    add_gateway_arguments(parser)
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics and the control channel on http://127.0.0.1:PORT")
+    parser.add_argument("--bench", action="store_true", help="run the scaling benchmark against a local mock server")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured per benchmark step")
+    args = parser.parse_args()
+
+    if args.bench:
+        logging.basicConfig(level=logging.WARNING)
+        bench(args)
+    else:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        setup_logging()
+        # Per-chunk debug logs from hundreds of sessions would dominate the gateway's CPU
+        logging.getLogger().setLevel(logging.INFO)
+        if args.metrics_port is not None:
+            metrics.start_http_server(args.metrics_port)
+        profiler.install_signal_handler()
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            profiler.PROFILER.stop()
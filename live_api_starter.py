@@ -43,50 +43,124 @@ The default is "camera". To share your screen run:
 ```
 python live_api_starter.py --mode screen
 ```
+
+Add `--metrics-port 9464` to scrape live metrics from http://127.0.0.1:9464/metrics,
+and `--metrics-json metrics.json` to dump them when the session ends.
+Event loop stalls longer than `--stall-threshold` seconds (default 0.2) are
+written with the blocking stack to `logs/stalls_*.log`. `--trace trace.json`
+records per-turn spans that open in Perfetto or chrome://tracing.
+Media chunks ready within `--batch-ms` milliseconds (default 50) share one
+realtime_input message.
+Video is speech-gated: frames go out while you talk (and for two seconds after), at
+each turn start, and when you type `/frame`. `--video-policy fixed` sends them every
+interval as before. Camera frames follow scene motion: one every 4 seconds for a
+still scene, up to four a second for a busy one (`--camera-min-interval`,
+`--camera-max-interval`). With `--mode screen --screen-focus` the screen goes out as a
+small overview plus a full-resolution crop around the cursor, each skipped while
+unchanged. `--capture-target` picks what is captured: `all` monitors as one image (the
+default), monitor `2`, `monitors` (each its own image, grabbed in parallel), a
+rectangle `L,T,W,H` or `window:ID`.
+
+To profile a sluggish session without restarting it, send `kill -USR1 <pid>`
+(or `curl -X POST http://127.0.0.1:9464/control/profile`) once to start the
+sampling profiler and again to write `logs/profile_*.folded` for flamegraphs.
+
+Importing this module has no side effects: the API key is only read when a session
+starts, and cv2, mss, PIL and pyaudio are imported when the selected mode needs them.
+Microphone and speaker streams come from the shared device manager in `audio_manager.py`.
 """
 
 import asyncio
-import base64
+import importlib
 import json
-import io
 import os
 import sys
+import time
 import traceback
 
-import cv2
-import pyaudio
-import PIL.Image
-import mss
 import argparse
 
 from websockets.asyncio.client import connect
 
+import audio_manager
+import audio_transcriber
+import bandwidth
+import frame_archive
+import frame_encoder
+import metrics
+import motion
+import profiler
+import screen_capture
+import video_gate
+import wire
+from loop_watchdog import LoopWatchdog
+from recorder import Recorder
+from tracing import TurnTracer
+
 if sys.version_info < (3, 11, 0):
     import taskgroup, exceptiongroup
 
     asyncio.TaskGroup = taskgroup.TaskGroup
     asyncio.ExceptionGroup = exceptiongroup.ExceptionGroup
 
-FORMAT = pyaudio.paInt16
+FORMAT = audio_manager.PA_INT16
 CHANNELS = 1
 SEND_SAMPLE_RATE = 16000
 RECEIVE_SAMPLE_RATE = 24000
 CHUNK_SIZE = 512
+# 100 ms of model audio per write to the speaker
+PLAYBACK_BLOCK = RECEIVE_SAMPLE_RATE * 2 // 10
+# Server messages at least this large are decoded off the event loop; smaller ones
+# cost less to decode than the hop to a worker thread
+OFFLOAD_BYTES = 8192
 
 host = "generativelanguage.googleapis.com"
 model = "gemini-2.0-flash-exp"
 DEFAULT_MODE="camera"
 
 
-api_key = os.environ["GOOGLE_API_KEY"]
-uri = f"wss://{host}/ws/google.ai.generativelanguage.v1alpha.GenerativeService.BidiGenerateContent?key={api_key}"
+def get_uri():
+    """Build the websocket URI; reads GOOGLE_API_KEY when a session starts, not at import."""
+    api_key = os.environ["GOOGLE_API_KEY"]
+    return f"wss://{host}/ws/google.ai.generativelanguage.v1alpha.GenerativeService.BidiGenerateContent?key={api_key}"
 
 
 class AudioLoop:
-    def __init__(self, video_mode=DEFAULT_MODE):
+    def __init__(self, video_mode=DEFAULT_MODE, metrics_json=None, stall_threshold=0.2, trace_path=None,
+                 record_path=None, transcript_path=None, upload_budget=None, max_frame_bytes=None,
+                 batch_window=wire.BATCH_WINDOW, video_policy=video_gate.DEFAULT_POLICY,
+                 camera_min_interval=motion.MIN_INTERVAL, camera_max_interval=motion.MAX_INTERVAL,
+                 focus_capture=False, capture_target=screen_capture.DEFAULT_TARGET, frame_archive_path=None,
+                 frame_archive_bytes=frame_archive.DEFAULT_MAX_BYTES):
         self.video_mode=video_mode
-        self.audio_in_queue = None
+        self.metrics_json = metrics_json
+        self.stall_threshold = stall_threshold
+        self.tracer = TurnTracer(trace_path)
+        self.recorder = Recorder(record_path, {"variant": "live_api_starter", "mode": video_mode,
+                                               "send_sample_rate": SEND_SAMPLE_RATE,
+                                               "receive_sample_rate": RECEIVE_SAMPLE_RATE})
+        self.transcript_path = transcript_path
+        self.transcript = audio_transcriber.Transcript()
+        # Sent frames, deduplicated by content, for audits
+        self.frame_archive_path = frame_archive_path
+        self.frame_archive_bytes = frame_archive_bytes
+        self.frame_archive = frame_archive.FrameArchive()
+        # Adapts video size, quality and interval to the upload budget and link throughput
+        self.governor = bandwidth.BandwidthGovernor(upload_budget)
+        # Keep each frame within max_frame_bytes; screen frames also pick their codec by content
+        self.camera_encoder = frame_encoder.JpegEncoder(max_frame_bytes)
+        # Camera interval follows scene motion
+        self.camera_pacer = motion.MotionPacer(camera_min_interval, camera_max_interval)
+        # A monitor, rectangle, window or every monitor in parallel; with focus_capture an
+        # overview plus a full-resolution crop around the cursor
+        self.screen_capture = screen_capture.ScreenCapture(capture_target, max_frame_bytes, focus_capture)
+        self.batch_window = batch_window
+        # Frames only while the user speaks, at turn starts and on request (or always)
+        self.video_gate = video_gate.VideoGate(video_policy)
+        self.playback = None
         self.out_queue = None
+        # True while the model is streaming audio for the current turn
+        self.turn_active = False
 
         self.ws = None
         self.audio_stream = None
@@ -102,6 +176,9 @@ class AudioLoop:
             text = await asyncio.to_thread(input, "message > ")
             if text.lower() == "q":
                 break
+            if text.strip() == video_gate.FRAME_COMMAND:
+                self.video_gate.request_frame()
+                continue
 
             msg = {
                 "client_content": {
@@ -109,31 +186,46 @@ class AudioLoop:
                     "turns": [{"role": "user", "parts": [{"text": text}]}],
                 }
             }
-            await self.ws.send(json.dumps(msg))
+            self.tracer.on_user_text(text)
+            self.recorder.text_out(text)
+            self.transcript.on_user_text(text)
+            send_start = time.monotonic()
+            with metrics.STAGE_SECONDS.labels("send").time():
+                await self.ws.send(json.dumps(msg))
+            self.tracer.on_upload(len(text), send_start)
+            metrics.MESSAGES_SENT.labels("text").inc()
+            metrics.BYTES_SENT.labels("text").inc(len(text))
+            self.video_gate.on_user_text(text)
 
     def _get_frame(self, cap):
+        import cv2
+        import PIL.Image
+
         # Read the frame
-        ret, frame = cap.read()
+        with metrics.STAGE_SECONDS.labels("capture_video").time():
+            ret, frame = cap.read()
         # Check if the frame was read successfully
         if not ret:
             return None
+        self.camera_pacer.update(frame)
+        encode_start = time.perf_counter()
 
         # Fix: Convert BGR to RGB color space
         # OpenCV captures in BGR but PIL expects RGB format
         # This prevents the blue tint in the video feed
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         img = PIL.Image.fromarray(frame_rgb)  # Now using RGB frame
-        img.thumbnail([1024, 1024])
-
-        image_io = io.BytesIO()
-        img.save(image_io, format="jpeg")
-        image_io.seek(0)
+        settings = self.governor.video_settings()
+        image_bytes = self.camera_encoder.encode(img, settings.max_size, settings.quality)
 
-        mime_type = "image/jpeg"
-        image_bytes = image_io.read()
-        return {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode()}
+        # Raw bytes; wire.realtime_input base64-encodes them into the message
+        frame = {"mime_type": self.camera_encoder.mime_type, "data": image_bytes}
+        metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+        return frame
 
     async def get_frames(self):
+        # Importing cv2 is slow too, and only camera mode needs it.
+        cv2 = await asyncio.to_thread(importlib.import_module, "cv2")
         # This takes about a second, and will block the whole program
         # causing the audio pipeline to overflow if you don't to_thread it.
         cap = await asyncio.to_thread(
@@ -141,90 +233,114 @@ class AudioLoop:
         )  # 0 represents the default camera
 
         while True:
+            await self.video_gate.wait(self.camera_pacer.interval)
             frame = await asyncio.to_thread(self._get_frame, cap)
             if frame is None:
                 break
-            await asyncio.sleep(1.0)
-
-            msg = {"realtime_input": {"media_chunks": [frame]}}
-            await self.out_queue.put(msg)
+            # Queue the frame as captured, then wait before the next one; motion seen while
+            # waiting, or a frame request, shortens the wait
+            await self.out_queue.put(frame)
+            delay = self.governor.frame_delay(bandwidth.wire_size(frame["data"]), self.camera_pacer.interval)
+            await self.camera_pacer.pace(delay, read=lambda: cap.read()[1], until=lambda: self.video_gate.requested)
 
         # Release the VideoCapture object
         cap.release()
 
-    def _get_screen(self):
-        sct = mss.mss()
-        monitor = sct.monitors[0]
-        
-        i = sct.grab(monitor)
-        mime_type = "image/jpeg"
-        image_bytes = mss.tools.to_png(i.rgb, i.size)
-        img = PIL.Image.open(io.BytesIO(image_bytes))
-        
-        image_io = io.BytesIO()
-        img.save(image_io, format="jpeg")
-        image_io.seek(0)
-        
-        image_bytes = image_io.read()
-        return {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode()}
+    def _get_screen(self, force=False):
+        return self.screen_capture.frames(self.governor.video_settings(), force)
 
     async def get_screen(self):
         while True:
-            frame = await asyncio.to_thread(self._get_screen)
-            if frame is None:
+            await self.video_gate.wait(self.governor.video_settings().interval)
+            # One frame per changed region, or with screen focus the overview and crop that changed (maybe none);
+            # all of them for a requested frame or the first of a turn
+            frames = await asyncio.to_thread(self._get_screen, self.video_gate.forced)
+            if frames is None:
                 break
-            
-            await asyncio.sleep(1.0)
 
-            msg = {"realtime_input": {"media_chunks": frame}}
-            await self.out_queue.put(msg)
+            for frame in frames:
+                await self.out_queue.put(frame)
+            nbytes = sum(bandwidth.wire_size(frame["data"]) for frame in frames)
+            await self.video_gate.pause(self.governor.frame_delay(nbytes))
 
     async def send_realtime(self):
+        encode_seconds = metrics.STAGE_SECONDS.labels("encode")
+        send_seconds = metrics.STAGE_SECONDS.labels("send")
+        # Packs the audio chunks and any frame queued within the window into one message
+        batcher = wire.Batcher(self.out_queue, self.batch_window)
         while True:
-            msg = await self.out_queue.get()
-            await self.ws.send(json.dumps(msg))
+            # Queued chunks are {"mime_type", "data"} dicts with raw data
+            chunks = await batcher.next()
+            with encode_seconds.time():
+                payload = wire.realtime_input(chunks)
+            send_start = time.monotonic()
+            with send_seconds.time():
+                # ASCII JSON bytes, sent as a text frame like json.dumps output was
+                await self.ws.send(payload, text=True)
+            self.tracer.on_upload(len(payload), send_start)
+            lane = "audio" if all(chunk["mime_type"] == "audio/pcm" for chunk in chunks) else "video"
+            self.governor.on_sent(lane, len(payload), time.monotonic() - send_start)
+            wire.REALTIME_MESSAGES.inc()
+            for chunk in chunks:
+                self.recorder.media_out(chunk["data"], chunk["mime_type"])
+                kind = "audio" if chunk["mime_type"] == "audio/pcm" else "video"
+                if kind == "video":
+                    self.frame_archive.frame(chunk["data"], chunk["mime_type"])
+                metrics.MESSAGES_SENT.labels(kind).inc()
+                metrics.BYTES_SENT.labels(kind).inc(len(chunk["data"]))
 
     async def listen_audio(self):
-        pya = pyaudio.PyAudio()
-
-        mic_info = pya.get_default_input_device_info()
-        self.audio_stream = pya.open(
+        # Opening a stream blocks for tens of milliseconds; keep it off the event loop.
+        self.audio_stream = await asyncio.to_thread(
+            audio_manager.get_manager().open_input,
             format=FORMAT,
             channels=CHANNELS,
             rate=SEND_SAMPLE_RATE,
-            input=True,
-            input_device_index=mic_info["index"],
             frames_per_buffer=CHUNK_SIZE,
         )
+        capture_seconds = metrics.STAGE_SECONDS.labels("capture_audio")
         while True:
-            data = await asyncio.to_thread(self.audio_stream.read, CHUNK_SIZE)
-            msg = {
-                "realtime_input": {
-                    "media_chunks": [
-                        {
-                            "data": base64.b64encode(data).decode(),
-                            "mime_type": "audio/pcm",
-                        }
-                    ]
-                }
-            }
-            await self.out_queue.put(msg)
+            with capture_seconds.time():
+                data = await asyncio.to_thread(self.audio_stream.read, CHUNK_SIZE)
+            self.tracer.on_user_audio(data)
+            self.video_gate.on_user_audio(data)
+            await self.out_queue.put({"mime_type": "audio/pcm", "data": data})
+
+    def _decode_response(self, raw_response):
+        decoded = wire.decode_server_message(raw_response)
+        for pcm_data in decoded.pcm:
+            self.playback.write(pcm_data)
+        return decoded
 
     async def receive_audio(self):
-        "Background task to reads from the websocket and write pcm chunks to the output queue"
+        "Background task to reads from the websocket and write pcm chunks to the playback buffer"
+        receive_seconds = metrics.STAGE_SECONDS.labels("receive")
         async for raw_response in self.ws:
-            # Other things could be returned here, but we'll ignore those for now.
-            response = json.loads(raw_response.decode("ascii"))
-
-            try:
-                b64data = response["serverContent"]["modelTurn"]["parts"][0][
-                    "inlineData"
-                ]["data"]
-            except KeyError:
-                pass
+            receive_start = time.perf_counter()
+            self.tracer.on_server_message()
+            # Decodes the audio into the playback buffer; large messages in a worker
+            if len(raw_response) >= OFFLOAD_BYTES:
+                decoded = await asyncio.to_thread(self._decode_response, raw_response)
+            else:
+                decoded = self._decode_response(raw_response)
+            response = decoded.message
+            receive_seconds.observe(time.perf_counter() - receive_start)
+
+            if decoded.pcm:
+                self.turn_active = True
+                for pcm_data in decoded.pcm:
+                    self.recorder.audio_in(pcm_data)
+                metrics.MESSAGES_RECEIVED.labels("audio").inc()
+                metrics.BYTES_RECEIVED.labels("audio").inc(sum(len(pcm_data) for pcm_data in decoded.pcm))
             else:
-                pcm_data = base64.b64decode(b64data)
-                self.audio_in_queue.put_nowait(pcm_data)
+                metrics.MESSAGES_RECEIVED.labels("other").inc()
+                metrics.BYTES_RECEIVED.labels("other").inc(len(raw_response))
+
+            for part in response.get("serverContent", {}).get("modelTurn", {}).get("parts", []):
+                if "text" in part:
+                    self.tracer.on_text_delta(part["text"])
+                    self.recorder.text_in(part["text"])
+                    self.transcript.on_text_delta(part["text"])
 
             try:
                 turn_complete = response["serverContent"]["turnComplete"]
@@ -236,17 +352,36 @@ class AudioLoop:
                     # For interruptions to work, we need to empty out the audio queue
                     # Because it may have loaded much more audio than has played yet.
                     print("\nEnd of turn")
-                    while not self.audio_in_queue.empty():
-                        self.audio_in_queue.get_nowait()
+                    self.turn_active = False
+                    metrics.TURNS_COMPLETED.inc()
+                    self.tracer.on_turn_complete()
+                    self.recorder.event("turn_complete")
+                    self.transcript.on_turn_complete()
+                    self.playback.clear()
 
     async def play_audio(self):
-        pya = pyaudio.PyAudio()
-        stream = pya.open(
-            format=FORMAT, channels=CHANNELS, rate=RECEIVE_SAMPLE_RATE, output=True
+        stream = await asyncio.to_thread(
+            audio_manager.get_manager().open_output,
+            format=FORMAT, channels=CHANNELS, rate=RECEIVE_SAMPLE_RATE
         )
-        while True:
-            bytestream = await self.audio_in_queue.get()
-            await asyncio.to_thread(stream.write, bytestream)
+        playback_seconds = metrics.STAGE_SECONDS.labels("playback")
+        try:
+            while True:
+                if not len(self.playback):
+                    if self.turn_active:
+                        metrics.PLAYBACK_UNDERRUNS.inc()
+                    self.tracer.on_playback_idle()
+                    await self.playback.wait()
+                bytestream = self.playback.read(PLAYBACK_BLOCK)
+                if not bytestream:
+                    # Cleared by an interruption after the wake-up
+                    continue
+                write_start = time.monotonic()
+                with playback_seconds.time():
+                    await asyncio.to_thread(stream.write, bytestream)
+                self.tracer.on_playback(write_start, time.monotonic())
+        finally:
+            stream.close()
 
     async def run(self):
         """Takes audio chunks off the input queue, and writes them to files.
@@ -256,15 +391,23 @@ class AudioLoop:
         try:
             async with (
                 await connect(
-                    uri, additional_headers={"Content-Type": "application/json"}
+                    get_uri(), additional_headers={"Content-Type": "application/json"}
                 ) as ws,
                 asyncio.TaskGroup() as tg,
             ):
                 self.ws = ws
                 await self.startup()
+                self.recorder.event("session_start", model=model, mode=self.video_mode)
+                self.transcript = audio_transcriber.open_transcript(self.transcript_path, "live_api_starter",
+                                                                    model, self.video_mode)
+                self.frame_archive = frame_archive.open_archive(self.frame_archive_path, "live_api_starter",
+                                                                self.frame_archive_bytes)
 
-                self.audio_in_queue = asyncio.Queue()
+                self.playback = audio_manager.PcmRingBuffer(block_size=PLAYBACK_BLOCK)
                 self.out_queue = asyncio.Queue(maxsize=5)
+                metrics.watch_queue("audio_in", self.playback)
+                metrics.watch_queue("out", self.out_queue)
+                metrics.register_command("frame", self.video_gate.request_frame)
 
                 send_text_task = tg.create_task(self.send_text())
 
@@ -276,6 +419,9 @@ class AudioLoop:
                     tg.create_task(self.get_screen())
                 tg.create_task(self.receive_audio())
                 tg.create_task(self.play_audio())
+                if self.stall_threshold:
+                    watchdog = LoopWatchdog(threshold=self.stall_threshold)
+                    tg.create_task(watchdog.run())
 
                 await send_text_task
                 raise asyncio.CancelledError("User requested exit")
@@ -283,8 +429,17 @@ class AudioLoop:
         except asyncio.CancelledError:
             pass
         except ExceptionGroup as EG:
-            self.audio_stream.close()
             traceback.print_exception(EG)
+        finally:
+            if self.audio_stream:
+                self.audio_stream.close()
+                self.audio_stream = None
+            if self.video_mode != "none":
+                print(self.video_gate.summary())
+            self.screen_capture.close()
+            metrics.dump_json(self.metrics_json)
+            self.tracer.close()
+            self.recorder.close()
 
 
 if __name__ == "__main__":
@@ -296,7 +451,127 @@ if __name__ == "__main__":
         help="pixels to stream from",
         choices=["camera", "screen", "none"],
     )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        default=None,
+        help="write a JSON dump of the metrics to this file when the session ends",
+    )
+    parser.add_argument(
+        "--stall-threshold",
+        type=float,
+        default=0.2,
+        help="report event loop stalls longer than this many seconds (0 disables)",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="append per-turn tracing spans (Chrome trace/Perfetto JSON) to this file",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="record the session (audio, frames, text and turn events) to this file",
+    )
+    parser.add_argument(
+        "--transcript",
+        type=str,
+        default=None,
+        help="store user turns and model text in this SQLite transcript database",
+    )
+    parser.add_argument(
+        "--upload-kbps",
+        type=float,
+        default=None,
+        help="upload budget in kilobits/s; video quality and frame rate adapt to stay within it",
+    )
+    parser.add_argument(
+        "--max-frame-kb",
+        type=float,
+        default=None,
+        help="largest encoded frame in kilobytes (at least 2); quality is lowered per frame to stay within it",
+    )
+    parser.add_argument(
+        "--batch-ms",
+        type=float,
+        default=wire.BATCH_WINDOW * 1000,
+        help="pack the media chunks ready within this many milliseconds into one message (0 packs only queued ones)",
+    )
+    parser.add_argument(
+        "--video-policy",
+        type=str,
+        default=video_gate.DEFAULT_POLICY,
+        choices=video_gate.POLICIES,
+        help="send frames only around user speech and on request (speech), or every interval (fixed)",
+    )
+    parser.add_argument(
+        "--camera-min-interval",
+        type=float,
+        default=motion.MIN_INTERVAL,
+        help="seconds between camera frames when the scene is busy",
+    )
+    parser.add_argument(
+        "--camera-max-interval",
+        type=float,
+        default=motion.MAX_INTERVAL,
+        help="seconds between camera frames when the scene is still",
+    )
+    parser.add_argument(
+        "--screen-focus",
+        action="store_true",
+        help="in screen mode, send a small overview plus a full-resolution crop around the cursor (cursor and window tracking on Windows only; elsewhere the crop follows screen changes)",
+    )
+    parser.add_argument(
+        "--capture-target",
+        type=str,
+        default=screen_capture.DEFAULT_TARGET,
+        help="screen area to capture: all, a monitor number, monitors (each in parallel), L,T,W,H or window:ID",
+    )
+    parser.add_argument(
+        "--frame-archive",
+        type=str,
+        default=None,
+        help="archive the frames sent to the model in this directory, deduplicated by content",
+    )
+    parser.add_argument(
+        "--frame-archive-mb",
+        type=float,
+        default=frame_archive.DEFAULT_MAX_BYTES / 1e6,
+        help="size in megabytes the frame archive is kept under; the least recently sent frames go first",
+    )
     args = parser.parse_args()
 
-    main = AudioLoop(video_mode=args.mode)
-    asyncio.run(main.run())
\ No newline at end of file
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    profiler.install_signal_handler()
+
+    main = AudioLoop(
+        video_mode=args.mode,
+        metrics_json=args.metrics_json,
+        stall_threshold=args.stall_threshold,
+        trace_path=args.trace,
+        record_path=args.record,
+        transcript_path=args.transcript,
+        upload_budget=args.upload_kbps * 1000 / 8 if args.upload_kbps else None,
+        max_frame_bytes=int(args.max_frame_kb * 1000) if args.max_frame_kb else None,
+        batch_window=args.batch_ms / 1000,
+        video_policy=args.video_policy,
+        camera_min_interval=args.camera_min_interval,
+        camera_max_interval=args.camera_max_interval,
+        focus_capture=args.screen_focus,
+        capture_target=args.capture_target,
+        frame_archive_path=args.frame_archive,
+        frame_archive_bytes=int(args.frame_archive_mb * 1e6),
+    )
+    try:
+        asyncio.run(main.run())
+    finally:
+        profiler.PROFILER.stop()
\ No newline at end of file
@@ -1,18 +1,28 @@
+# cv2, PIL, pyaudio and google.genai are imported on first use, not at module import.
 import asyncio
 import base64
-import io
+import importlib
 import os
-from dotenv import load_dotenv
 import sys
 import traceback
 import logging
+import time
 from datetime import datetime
 
-import cv2
-import pyaudio
-import PIL.Image
-
-from google import genai
+import audio_manager
+import audio_transcriber
+import bandwidth
+import frame_archive
+import frame_encoder
+import metrics
+import motion
+import profiler
+import video_gate
+from loop_watchdog import LoopWatchdog
+from recorder import Recorder
+from tracing import TurnTracer
+
+logger = logging.getLogger(__name__)
 
 # Set up logging
 # Set up logging
@@ -50,13 +60,7 @@ if sys.version_info < (3, 11, 0):
     asyncio.TaskGroup = taskgroup.TaskGroup
     asyncio.ExceptionGroup = exceptiongroup.ExceptionGroup
 
-# Configure Gemini API Key
-# Load environment variables from the .env file
-load_dotenv()
-# Access the API key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-FORMAT = pyaudio.paInt16
+FORMAT = audio_manager.PA_INT16
 CHANNELS = 1
 SEND_SAMPLE_RATE = 16000
 RECEIVE_SAMPLE_RATE = 24000
@@ -64,22 +68,58 @@ CHUNK_SIZE = 512
 
 MODEL = "models/gemini-2.0-flash-exp"
 
-client = genai.Client(
-    http_options={'api_version': 'v1alpha'},
-    api_key=GEMINI_API_KEY
-    )
-
 CONFIG={
     "generation_config": {"response_modalities": ["AUDIO"]}}
 
-pya = pyaudio.PyAudio()
+_client = None
+
+
+def get_client():
+    """Create the genai client on first use, so importing this module stays cheap."""
+    global _client
+    if _client is None:
+        from dotenv import load_dotenv
+        from google import genai
+
+        # Load environment variables from the .env file and access the API key
+        load_dotenv()
+        _client = genai.Client(
+            http_options={'api_version': 'v1alpha'},
+            api_key=os.getenv("GEMINI_API_KEY")
+            )
+    return _client
 
 class AudioLoop:
-    def __init__(self, webcam_enabled=True):
+    def __init__(self, webcam_enabled=True, metrics_json=None, stall_threshold=0.2, trace_path=None,
+                 record_path=None, transcript_path=None, upload_budget=None,
+                 max_frame_bytes=None, video_policy=video_gate.DEFAULT_POLICY,
+                 camera_min_interval=motion.MIN_INTERVAL, camera_max_interval=motion.MAX_INTERVAL,
+                 frame_archive_path=None, frame_archive_bytes=frame_archive.DEFAULT_MAX_BYTES):
         self.audio_in_queue = asyncio.Queue()
         self.audio_out_queue = asyncio.Queue()
         self.video_out_queue = asyncio.Queue()
         self.session = None
+        self.metrics_json = metrics_json
+        self.stall_threshold = stall_threshold
+        self.tracer = TurnTracer(trace_path)
+        self.recorder = Recorder(record_path, {"variant": "live_api_starter_cv", "webcam": webcam_enabled,
+                                               "send_sample_rate": SEND_SAMPLE_RATE,
+                                               "receive_sample_rate": RECEIVE_SAMPLE_RATE})
+        self.transcript_path = transcript_path
+        self.transcript = audio_transcriber.Transcript()
+        # Sent frames, deduplicated by content, for audits
+        self.frame_archive_path = frame_archive_path
+        self.frame_archive_bytes = frame_archive_bytes
+        self.frame_archive = frame_archive.FrameArchive()
+        # Adapts video size, quality and interval to the upload budget and link throughput
+        self.governor = bandwidth.BandwidthGovernor(upload_budget)
+        # Keeps each frame within max_frame_bytes by lowering JPEG quality
+        self.camera_encoder = frame_encoder.JpegEncoder(max_frame_bytes)
+        # Camera interval follows scene motion
+        self.camera_pacer = motion.MotionPacer(camera_min_interval, camera_max_interval)
+        # Frames only while the user speaks, at turn starts and on request (or always)
+        self.video_gate = video_gate.VideoGate(video_policy)
+        self.turn_active = False  # True while the model is streaming audio for a turn
         self.send_text_task = None
         self.receive_audio_task = None
         self.play_audio_task = None
@@ -91,9 +131,24 @@ class AudioLoop:
             text = await asyncio.to_thread(input, "message > ")
             if text.lower() == "q":
                 break
-            await self.session.send(text or ".", end_of_turn=True)
+            if text.strip() == video_gate.FRAME_COMMAND:
+                self.video_gate.request_frame()
+                continue
+            self.tracer.on_user_text(text)
+            self.recorder.text_out(text)
+            self.transcript.on_user_text(text)
+            send_start = time.monotonic()
+            with metrics.STAGE_SECONDS.labels("send").time():
+                await self.session.send(text or ".", end_of_turn=True)
+            self.tracer.on_upload(len(text), send_start)
+            metrics.MESSAGES_SENT.labels("text").inc()
+            metrics.BYTES_SENT.labels("text").inc(len(text))
+            self.video_gate.on_user_text(text)
 
     def _get_frame(self, cap):
+        import cv2
+        import PIL.Image
+
         try:
             # Log camera properties
             if cap.isOpened():
@@ -103,32 +158,32 @@ class AudioLoop:
                 return None
 
             # Read the frame
-            ret, frame = cap.read()
+            with metrics.STAGE_SECONDS.labels("capture_video").time():
+                ret, frame = cap.read()
             
             # Check if the frame was read successfully
             if not ret:
                 logger.error("Failed to read frame from camera")
                 return None
+            self.camera_pacer.update(frame)
+            encode_start = time.perf_counter()
 
             logger.debug(f"Frame captured - Shape: {frame.shape}")
 
             # Convert to PIL Image
             img = PIL.Image.fromarray(frame)
             original_size = img.size
-            img.thumbnail([1024, 1024])
-            logger.debug(f"Image resized from {original_size} to {img.size}")
-
-            # Convert to bytes
-            image_io = io.BytesIO()
-            img.save(image_io, format="jpeg")
-            image_io.seek(0)
+            settings = self.governor.video_settings()
+            image_bytes = self.camera_encoder.encode(img, settings.max_size, settings.quality)
+            logger.debug(f"Image resized from {original_size} to {self.camera_encoder.size}")
 
             mime_type = "image/jpeg"
-            image_bytes = image_io.read()
             encoded_size = len(image_bytes)
             logger.debug(f"Image encoded - Size: {encoded_size} bytes")
             
-            return {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode()}
+            frame_data = {"mime_type": mime_type, "data": base64.b64encode(image_bytes).decode()}
+            metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+            return frame_data
         except Exception as e:
             logger.error(f"Error in _get_frame: {str(e)}")
             logger.error(traceback.format_exc())
@@ -137,6 +192,7 @@ class AudioLoop:
     async def get_frames(self):
         try:
             logger.info("Attempting to open camera...")
+            cv2 = await asyncio.to_thread(importlib.import_module, "cv2")
             cap = await asyncio.to_thread(cv2.VideoCapture, 0)
             
             if not cap.isOpened():
@@ -147,6 +203,7 @@ class AudioLoop:
             frame_count = 0
 
             while True:
+                await self.video_gate.wait(self.camera_pacer.interval)
                 frame = await asyncio.to_thread(self._get_frame, cap)
                 if frame is None:
                     logger.error("Frame capture failed")
@@ -156,14 +213,18 @@ class AudioLoop:
                 if frame_count % 10 == 0:  # Log every 10th frame
                     logger.debug(f"Captured frame {frame_count}")
 
-                await asyncio.sleep(1.0)
-                
+                # Queue the frame as captured, then wait before the next one; motion seen while
+                # waiting, or a frame request, shortens the wait
                 try:
                     self.video_out_queue.put_nowait(frame)
                     logger.debug(f"Frame {frame_count} added to queue")
                 except Exception as e:
                     logger.error(f"Error adding frame to queue: {str(e)}")
 
+                delay = self.governor.frame_delay(len(frame["data"]), self.camera_pacer.interval)
+                await self.camera_pacer.pace(delay, read=lambda: cap.read()[1],
+                                             until=lambda: self.video_gate.requested)
+
             logger.info("Releasing camera...")
             cap.release()
             
@@ -180,7 +241,16 @@ class AudioLoop:
                 logger.debug(f"Sending frame {frame_count} to session")
                 
                 try:
-                    await self.session.send(frame)
+                    nbytes = len(frame["data"])
+                    self.recorder.media_out(frame["data"], frame["mime_type"])
+                    self.frame_archive.frame(frame["data"], frame["mime_type"])
+                    send_start = time.monotonic()
+                    with metrics.STAGE_SECONDS.labels("send").time():
+                        await self.session.send(frame)
+                    self.tracer.on_upload(nbytes, send_start)
+                    self.governor.on_sent("video", bandwidth.wire_size(frame["data"]), time.monotonic() - send_start)
+                    metrics.MESSAGES_SENT.labels("video").inc()
+                    metrics.BYTES_SENT.labels("video").inc(nbytes)
                     logger.debug(f"Frame {frame_count} sent successfully")
                 except Exception as e:
                     logger.error(f"Error sending frame {frame_count}: {str(e)}")
@@ -190,46 +260,64 @@ class AudioLoop:
 
     async def listen_audio(self):
         logger.info("Starting audio listening...")
+        stream = None
         try:
-            pya = pyaudio.PyAudio()
-            mic_info = pya.get_default_input_device_info()
-            logger.debug(f"Using microphone: {mic_info['name']}")
-            
             stream = await asyncio.to_thread(
-                pya.open,
+                audio_manager.get_manager().open_input,
                 format=FORMAT,
                 channels=CHANNELS,
                 rate=SEND_SAMPLE_RATE,
-                input=True,
-                input_device_index=mic_info["index"],
                 frames_per_buffer=CHUNK_SIZE,
             )
             logger.info("Audio stream opened successfully")
             
+            capture_seconds = metrics.STAGE_SECONDS.labels("capture_audio")
             while True:
-                data = await asyncio.to_thread(stream.read, CHUNK_SIZE)
+                with capture_seconds.time():
+                    data = await asyncio.to_thread(stream.read, CHUNK_SIZE)
+                self.tracer.on_user_audio(data)
+                self.video_gate.on_user_audio(data)
                 self.audio_out_queue.put_nowait(data)
         except Exception as e:
             logger.error(f"Error in listen_audio: {str(e)}")
             logger.error(traceback.format_exc())
+        finally:
+            if stream:
+                stream.close()
 
     async def send_audio(self):
         try:
             chunk_count = 0
+            send_seconds = metrics.STAGE_SECONDS.labels("send")
             while True:
                 chunk = await self.audio_out_queue.get()
                 chunk_count += 1
                 if chunk_count % 100 == 0:  # Log every 100th chunk
                     logger.debug(f"Sending audio chunk {chunk_count}")
-                await self.session.send({"data": chunk, "mime_type": "audio/pcm"})
+                self.recorder.media_out(chunk, "audio/pcm")
+                send_start = time.monotonic()
+                with send_seconds.time():
+                    await self.session.send({"data": chunk, "mime_type": "audio/pcm"})
+                self.tracer.on_upload(len(chunk), send_start)
+                self.governor.on_sent("audio", bandwidth.wire_size(chunk), time.monotonic() - send_start)
+                metrics.MESSAGES_SENT.labels("audio").inc()
+                metrics.BYTES_SENT.labels("audio").inc(len(chunk))
         except Exception as e:
             logger.error(f"Error in send_audio: {str(e)}")
             logger.error(traceback.format_exc())
 
     async def receive_audio(self):
         try:
+            receive_seconds = metrics.STAGE_SECONDS.labels("receive")
             while True:
+                last_message = None
                 async for response in self.session.receive():
+                    # Gap between consecutive messages of the same turn
+                    now = time.perf_counter()
+                    if last_message is not None:
+                        receive_seconds.observe(now - last_message)
+                    last_message = now
+                    self.tracer.on_server_message()
                     server_content = response.server_content
                     if server_content is not None:
                         model_turn = server_content.model_turn
@@ -239,13 +327,27 @@ class AudioLoop:
                             for part in parts:
                                 if part.text is not None:
                                     print(part.text, end="")
+                                    self.tracer.on_text_delta(part.text)
+                                    self.recorder.text_in(part.text)
+                                    self.transcript.on_text_delta(part.text)
+                                    metrics.MESSAGES_RECEIVED.labels("text").inc()
+                                    metrics.BYTES_RECEIVED.labels("text").inc(len(part.text))
                                 elif part.inline_data is not None:
+                                    self.turn_active = True
                                     self.audio_in_queue.put_nowait(part.inline_data.data)
+                                    self.recorder.audio_in(part.inline_data.data)
+                                    metrics.MESSAGES_RECEIVED.labels("audio").inc()
+                                    metrics.BYTES_RECEIVED.labels("audio").inc(len(part.inline_data.data))
 
                         server_content.model_turn = None
                         turn_complete = server_content.turn_complete
                         if turn_complete:
                             logger.debug("Turn complete received")
+                            self.turn_active = False
+                            metrics.TURNS_COMPLETED.inc()
+                            self.tracer.on_turn_complete()
+                            self.recorder.event("turn_complete")
+                            self.transcript.on_turn_complete()
                             while not self.audio_in_queue.empty():
                                 self.audio_in_queue.get_nowait()
         except Exception as e:
@@ -253,30 +355,52 @@ class AudioLoop:
             logger.error(traceback.format_exc())
 
     async def play_audio(self):
+        stream = None
         try:
             logger.info("Starting audio playback...")
-            pya = pyaudio.PyAudio()
             stream = await asyncio.to_thread(
-                pya.open, format=FORMAT, channels=CHANNELS, rate=RECEIVE_SAMPLE_RATE, output=True
+                audio_manager.get_manager().open_output,
+                format=FORMAT, channels=CHANNELS, rate=RECEIVE_SAMPLE_RATE
             )
             logger.info("Audio playback stream opened successfully")
             
+            playback_seconds = metrics.STAGE_SECONDS.labels("playback")
             while True:
+                if self.audio_in_queue.empty():
+                    if self.turn_active:
+                        metrics.PLAYBACK_UNDERRUNS.inc()
+                    self.tracer.on_playback_idle()
                 bytestream = await self.audio_in_queue.get()
-                await asyncio.to_thread(stream.write, bytestream)
+                write_start = time.monotonic()
+                with playback_seconds.time():
+                    await asyncio.to_thread(stream.write, bytestream)
+                self.tracer.on_playback(write_start, time.monotonic())
         except Exception as e:
             logger.error(f"Error in play_audio: {str(e)}")
             logger.error(traceback.format_exc())
+        finally:
+            if stream:
+                stream.close()
 
     async def run(self):
         logger.info("Starting AudioLoop.run()")
         try:
             async with (
-                client.aio.live.connect(model=MODEL, config=CONFIG) as session,
+                get_client().aio.live.connect(model=MODEL, config=CONFIG) as session,
                 asyncio.TaskGroup() as tg,
             ):
                 self.session = session
                 logger.info("Session connected successfully")
+                self.recorder.event("session_start", model=MODEL)
+                self.transcript = audio_transcriber.open_transcript(
+                    self.transcript_path, "live_api_starter_cv", MODEL, "camera" if self.webcam_enabled else "none"
+                )
+                self.frame_archive = frame_archive.open_archive(self.frame_archive_path, "live_api_starter_cv",
+                                                                self.frame_archive_bytes)
+                metrics.watch_queue("audio_in", self.audio_in_queue)
+                metrics.watch_queue("audio_out", self.audio_out_queue)
+                metrics.watch_queue("video_out", self.video_out_queue)
+                metrics.register_command("frame", self.video_gate.request_frame)
 
                 send_text_task = tg.create_task(self.send_text())
 
@@ -295,6 +419,9 @@ class AudioLoop:
                     tg.create_task(self.receive_audio()),
                     tg.create_task(self.play_audio())
                 ]
+                if self.stall_threshold:
+                    watchdog = LoopWatchdog(threshold=self.stall_threshold)
+                    tasks.append(tg.create_task(watchdog.run()))
 
                 # Add webcam tasks only if enabled
                 if self.webcam_enabled:
@@ -320,12 +447,63 @@ class AudioLoop:
         except Exception as e:
             logger.error(f"Error in run: {str(e)}")
             logger.error(traceback.format_exc())
+        finally:
+            if self.webcam_enabled:
+                logger.info(self.video_gate.summary())
+            metrics.dump_json(self.metrics_json)
+            self.tracer.close()
+            self.recorder.close()
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-json", type=str, default=None,
+                        help="write a JSON dump of the metrics to this file when the session ends")
+    parser.add_argument("--stall-threshold", type=float, default=0.2,
+                        help="report event loop stalls longer than this many seconds (0 disables)")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="append per-turn tracing spans (Chrome trace/Perfetto JSON) to this file")
+    parser.add_argument("--record", type=str, default=None,
+                        help="record the session (audio, frames, text and turn events) to this file")
+    parser.add_argument("--transcript", type=str, default=None,
+                        help="store user turns and model text in this SQLite transcript database")
+    parser.add_argument("--upload-kbps", type=float, default=None,
+                        help="upload budget in kilobits/s; video quality and frame rate adapt to stay within it")
+    parser.add_argument("--max-frame-kb", type=float, default=None,
+                        help="largest encoded frame in kilobytes (at least 2); quality is lowered per frame to stay within it")
+    parser.add_argument("--video-policy", type=str, default=video_gate.DEFAULT_POLICY, choices=video_gate.POLICIES,
+                        help="send frames only around user speech and on request (speech), or every interval (fixed)")
+    parser.add_argument("--camera-min-interval", type=float, default=motion.MIN_INTERVAL,
+                        help="seconds between camera frames when the scene is busy")
+    parser.add_argument("--camera-max-interval", type=float, default=motion.MAX_INTERVAL,
+                        help="seconds between camera frames when the scene is still")
+    parser.add_argument("--frame-archive", type=str, default=None,
+                        help="archive the frames sent to the model in this directory, deduplicated by content")
+    parser.add_argument("--frame-archive-mb", type=float, default=frame_archive.DEFAULT_MAX_BYTES / 1e6,
+                        help="size in megabytes the frame archive is kept under; the least recently sent go first")
+    args = parser.parse_args()
+
     logger = setup_logging()
     logger.info("Starting application...")
     print("Application started, type 'q' and press Enter to exit.")
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    # kill -USR1 <pid> toggles the sampling profiler
+    profiler.install_signal_handler()
     
     # Create AudioLoop with webcam disabled
-    loop = AudioLoop(webcam_enabled=False)
-    asyncio.run(loop.run())
\ No newline at end of file
+    loop = AudioLoop(webcam_enabled=False, metrics_json=args.metrics_json,
+                     stall_threshold=args.stall_threshold, trace_path=args.trace, record_path=args.record,
+                     transcript_path=args.transcript,
+                     upload_budget=args.upload_kbps * 1000 / 8 if args.upload_kbps else None,
+                     max_frame_bytes=int(args.max_frame_kb * 1000) if args.max_frame_kb else None,
+                     video_policy=args.video_policy, camera_min_interval=args.camera_min_interval,
+                     camera_max_interval=args.camera_max_interval, frame_archive_path=args.frame_archive,
+                     frame_archive_bytes=int(args.frame_archive_mb * 1e6))
+    try:
+        asyncio.run(loop.run())
+    finally:
+        profiler.PROFILER.stop()
\ No newline at end of file
@@ -1,18 +1,27 @@
+# PIL, pyaudio and google.genai are imported on first use: overlay.py imports this
+# module just to read CONFIG and must not pay for them.
 import asyncio
 import base64
-import io
 import sys
 import traceback
 import logging
-from dotenv import load_dotenv
+import time
 import os
 from datetime import datetime
 import signal
-import pyaudio
-import PIL.Image
-import PIL.ImageGrab
 
-from google import genai
+import audio_manager
+import audio_transcriber
+import bandwidth
+import frame_archive
+import frame_encoder
+import metrics
+import profiler
+import screen_focus
+import video_gate
+from loop_watchdog import LoopWatchdog
+from recorder import Recorder
+from tracing import TurnTracer
 
 # Set up logging
 def setup_logging():
@@ -47,13 +56,7 @@ if sys.version_info < (3, 11, 0):
     asyncio.TaskGroup = taskgroup.TaskGroup
     asyncio.ExceptionGroup = exceptiongroup.ExceptionGroup
 
-# Configure Gemini API Key
-# Load environment variables from the .env file
-load_dotenv()
-# Access the API key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-FORMAT = pyaudio.paInt16
+FORMAT = audio_manager.PA_INT16
 CHANNELS = 1
 SEND_SAMPLE_RATE = 16000
 RECEIVE_SAMPLE_RATE = 24000
@@ -84,11 +87,7 @@ Your Role:
 *   **Embrace the Unknown:** The world of computation is full of mysteries. Be prepared to explore the unfamiliar and embrace the inherent uncertainty.
 
 So, my friend, what shall we compute together today? What problem shall we attempt to solve? Let's begin this… 'processing cycle' with vigor!'''
-logger = setup_logging()
-client = genai.Client(
-    http_options={'api_version': 'v1alpha'},
-    api_key=GEMINI_API_KEY
-    )
+logger = logging.getLogger(__name__)
 
 voices = ["Puck", "Charon", "Kore", "Fenrir", "Aoede"]
 CONFIG={
@@ -98,12 +97,53 @@ CONFIG={
                             "temperature" : 0.7,
                             }
                             }
-pya = pyaudio.PyAudio()
+
+_client = None
+
+
+def get_client():
+    """Create the genai client on first use, so importing this module (e.g. from overlay.py for CONFIG) stays cheap."""
+    global _client
+    if _client is None:
+        from dotenv import load_dotenv
+        from google import genai
+
+        # Load environment variables from the .env file and access the API key
+        load_dotenv()
+        _client = genai.Client(
+            http_options={'api_version': 'v1alpha'},
+            api_key=os.getenv("GEMINI_API_KEY")
+            )
+    return _client
 
 
 class AudioLoop:
-    def __init__(self):
+    def __init__(self, metrics_json=None, stall_threshold=0.2, trace_path=None, record_path=None,
+                 transcript_path=audio_transcriber.DEFAULT_PATH, upload_budget=None,
+                 max_frame_bytes=None, video_policy=video_gate.DEFAULT_POLICY, focus_capture=False,
+                 frame_archive_path=None, frame_archive_bytes=frame_archive.DEFAULT_MAX_BYTES):
         self.session = None
+        self.metrics_json = metrics_json
+        self.stall_threshold = stall_threshold
+        self.tracer = TurnTracer(trace_path)
+        self.recorder = Recorder(record_path, {"variant": "live_api_starter_desk", "mode": "screen",
+                                               "send_sample_rate": SEND_SAMPLE_RATE,
+                                               "receive_sample_rate": RECEIVE_SAMPLE_RATE})
+        self.transcript_path = transcript_path
+        self.transcript = audio_transcriber.Transcript()
+        # Sent frames, deduplicated by content, for audits
+        self.frame_archive_path = frame_archive_path
+        self.frame_archive_bytes = frame_archive_bytes
+        self.frame_archive = frame_archive.FrameArchive()
+        # Adapts video size, quality and interval to the upload budget and link throughput
+        self.governor = bandwidth.BandwidthGovernor(upload_budget)
+        # Picks codec and resolution per frame by content, within max_frame_bytes
+        self.screen_encoder = frame_encoder.ScreenEncoder(max_frame_bytes)
+        # Overview plus a full-resolution crop around the cursor, instead of one downscaled screen
+        self.screen_focus = screen_focus.FocusCapture(max_frame_bytes) if focus_capture else None
+        # Frames only while the user speaks, at turn starts and on request (or always)
+        self.video_gate = video_gate.VideoGate(video_policy)
+        self.turn_active = False  # True while the model is streaming audio for a turn
         self.send_text_task = None
         self.receive_audio_task = None
         self.play_audio_task = None
@@ -129,10 +169,22 @@ class AudioLoop:
                             if message.lower() == "q":
                                 logger.info("Quitting session...")
                                 return
-                            
+                            if message == video_gate.FRAME_COMMAND:
+                                self.video_gate.request_frame()
+                                continue
+
                             try:
-                                await self.session.send(message, end_of_turn=True)
+                                self.tracer.on_user_text(message)
+                                self.recorder.text_out(message)
+                                self.transcript.on_user_text(message)
+                                send_start = time.monotonic()
+                                with metrics.STAGE_SECONDS.labels("send").time():
+                                    await self.session.send(message, end_of_turn=True)
+                                self.tracer.on_upload(len(message), send_start)
+                                metrics.MESSAGES_SENT.labels("text").inc()
+                                metrics.BYTES_SENT.labels("text").inc(len(message))
                                 logger.info("User message sent: %s", message)
+                                self.video_gate.on_user_text(message)
                             except Exception as e:
                                 logger.error(f"Error sending message: {e}")
                 
@@ -145,54 +197,68 @@ class AudioLoop:
 
     def _get_screen_frame(self):
         """Capture and process a single screen frame using PIL"""
-        try:
-            # Create screenshots directory if it doesn't exist
-            screenshots_dir = "screenshots"
-            if not os.path.exists(screenshots_dir):
-                os.makedirs(screenshots_dir)
+        import PIL.ImageGrab
 
+        try:
             # Capture the screen using PIL
-            screenshot = PIL.ImageGrab.grab()
+            with metrics.STAGE_SECONDS.labels("capture_video").time():
+                screenshot = PIL.ImageGrab.grab()
             logger.debug(f"Screenshot captured - Size: {screenshot.size}")
+            encode_start = time.perf_counter()
 
             # Convert to RGB if image is in RGBA mode
             if screenshot.mode == 'RGBA':
                 screenshot = screenshot.convert('RGB')
 
-            # Save only the first screenshot
-            if not self.first_screenshot_saved:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                screenshot_path = os.path.join(screenshots_dir, f"screenshot_{timestamp}.jpg")
-                screenshot.save(screenshot_path, format="jpeg", quality=80)
-                logger.info(f"First screenshot saved to: {screenshot_path}")
-                self.first_screenshot_saved = True
-
-            # Resize to stay within Gemini's limits
+            # Resize to stay within Gemini's limits and the upload budget
             original_size = screenshot.size
-            screenshot.thumbnail([1024, 1024])
-            logger.debug(f"Image resized from {original_size} to {screenshot.size}")
-
-            # Convert to base64 for Gemini
-            image_io = io.BytesIO()
-            screenshot.save(image_io, format="jpeg", quality=80)
-            image_io.seek(0)
+            settings = self.governor.video_settings()
+            image_bytes = self.screen_encoder.encode(screenshot, settings.max_size, settings.quality)
+            logger.debug(f"Image resized from {original_size} to {self.screen_encoder.size}")
 
             # Prepare frame data
-            mime_type = "image/jpeg"
-            image_bytes = image_io.read()
+            mime_type = self.screen_encoder.mime_type
             encoded_size = len(image_bytes)
             logger.debug(f"Image encoded - Size: {encoded_size} bytes")
             
-            return {
+            frame_data = {
                 "mime_type": mime_type,
                 "data": base64.b64encode(image_bytes).decode()
             }
+            metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+
+            # Save only the first screenshot: the encoded frame as sent, written from a background thread
+            if not self.first_screenshot_saved:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                frame_archive.save_frame(frame_data["data"], mime_type,
+                                         os.path.join("screenshots", f"screenshot_{timestamp}"))
+                self.first_screenshot_saved = True
+            return frame_data
 
         except Exception as e:
             logger.error(f"Error in _get_screen_frame: {str(e)}")
             logger.error(traceback.format_exc())
             return None
 
+    def _get_focus_frames(self, force=False):
+        """Capture the screen as an overview and a crop around the cursor (see screen_focus.py); `force` sends both"""
+        import PIL.ImageGrab
+
+        try:
+            with metrics.STAGE_SECONDS.labels("capture_video").time():
+                screenshot = PIL.ImageGrab.grab()
+            encode_start = time.perf_counter()
+            if screenshot.mode != "RGB":
+                screenshot = screenshot.convert("RGB")
+            # ImageGrab captures the primary monitor, whose top-left corner is the origin
+            frames = self.screen_focus.frames_from_image(screenshot, (0, 0), self.governor.video_settings(), force)
+            logger.debug(f"Screen focus: {len(frames)} images, crop at {self.screen_focus.box}")
+            metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+            return frames
+        except Exception as e:
+            logger.error(f"Error capturing screen: {str(e)}")
+            return None
+
     async def get_frames(self):
         """Capture frames asynchronously"""
         try:
@@ -200,9 +266,15 @@ class AudioLoop:
             frame_count = 0
 
             while True:
+                await self.video_gate.wait(self.governor.video_settings().interval)
                 try:
-                    frame = await asyncio.to_thread(self._get_screen_frame)
-                    if frame is None:
+                    if self.screen_focus:
+                        # A requested frame, or the first of a turn, sends both parts even if unchanged
+                        frames = await asyncio.to_thread(self._get_focus_frames, self.video_gate.forced)
+                    else:
+                        frame = await asyncio.to_thread(self._get_screen_frame)
+                        frames = None if frame is None else [frame]
+                    if frames is None:
                         logger.error("Screen capture failed")
                         await asyncio.sleep(1.0)  # Wait before retry
                         continue
@@ -211,14 +283,21 @@ class AudioLoop:
                     if frame_count % 10 == 0:  # Log every 10th frame
                         logger.debug(f"Captured screen frame {frame_count}")
 
-                    self.video_out_queue.put_nowait(frame)
-                    logger.debug(f"Frame {frame_count} added to queue")
+                    for frame in frames:
+                        self.video_out_queue.put_nowait(frame)
+                    logger.debug(f"Frame {frame_count} added to queue ({len(frames)} images)")
 
                 except Exception as e:
                     logger.error(f"Error in frame capture loop: {str(e)}")
                     logger.error(traceback.format_exc())
+                    frames = None
 
-                await asyncio.sleep(1.0)  # Capture rate: 1 frame per second
+                # One frame per second, or slower when the governor holds video back; a frame
+                # request ends the wait
+                if frames is not None:
+                    await self.video_gate.pause(self.governor.frame_delay(sum(len(frame["data"]) for frame in frames)))
+                else:
+                    await asyncio.sleep(1.0)
 
         except Exception as e:
             logger.error(f"Error in get_frames: {str(e)}")
@@ -234,7 +313,16 @@ class AudioLoop:
                 logger.debug(f"Sending frame {frame_count} to session")
                 
                 try:
-                    await self.session.send(frame)
+                    nbytes = len(frame["data"])
+                    self.recorder.media_out(frame["data"], frame["mime_type"])
+                    self.frame_archive.frame(frame["data"], frame["mime_type"])
+                    send_start = time.monotonic()
+                    with metrics.STAGE_SECONDS.labels("send").time():
+                        await self.session.send(frame)
+                    self.tracer.on_upload(nbytes, send_start)
+                    self.governor.on_sent("video", bandwidth.wire_size(frame["data"]), time.monotonic() - send_start)
+                    metrics.MESSAGES_SENT.labels("video").inc()
+                    metrics.BYTES_SENT.labels("video").inc(nbytes)
                     logger.debug(f"Frame {frame_count} sent successfully")
                 except Exception as e:
                     logger.error(f"Error sending frame {frame_count}: {str(e)}")
@@ -245,39 +333,49 @@ class AudioLoop:
     # [Previous audio-related methods remain unchanged]
     async def listen_audio(self):
         logger.info("Starting audio listening...")
+        stream = None
         try:
-            pya = pyaudio.PyAudio()
-            mic_info = pya.get_default_input_device_info()
-            logger.debug(f"Using microphone: {mic_info['name']}")
-            
             stream = await asyncio.to_thread(
-                pya.open,
+                audio_manager.get_manager().open_input,
                 format=FORMAT,
                 channels=CHANNELS,
                 rate=SEND_SAMPLE_RATE,
-                input=True,
-                input_device_index=mic_info["index"],
                 frames_per_buffer=CHUNK_SIZE,
             )
             logger.info("Audio stream opened successfully")
             
+            capture_seconds = metrics.STAGE_SECONDS.labels("capture_audio")
             while True:
-                data = await asyncio.to_thread(stream.read, CHUNK_SIZE)
+                with capture_seconds.time():
+                    data = await asyncio.to_thread(stream.read, CHUNK_SIZE)
+                self.tracer.on_user_audio(data)
+                self.video_gate.on_user_audio(data)
                 self.audio_out_queue.put_nowait(data)
         except Exception as e:
             logger.error(f"Error in listen_audio: {str(e)}")
             logger.error(traceback.format_exc())
             exit()
+        finally:
+            if stream:
+                stream.close()
 
     async def send_audio(self):
         try:
             chunk_count = 0
+            send_seconds = metrics.STAGE_SECONDS.labels("send")
             while True:
                 chunk = await self.audio_out_queue.get()
                 chunk_count += 1
                 if chunk_count % 100 == 0:  # Log every 100th chunk
                     logger.debug(f"Sending audio chunk {chunk_count}")
-                await self.session.send({"data": chunk, "mime_type": "audio/pcm"})
+                self.recorder.media_out(chunk, "audio/pcm")
+                send_start = time.monotonic()
+                with send_seconds.time():
+                    await self.session.send({"data": chunk, "mime_type": "audio/pcm"})
+                self.tracer.on_upload(len(chunk), send_start)
+                self.governor.on_sent("audio", bandwidth.wire_size(chunk), time.monotonic() - send_start)
+                metrics.MESSAGES_SENT.labels("audio").inc()
+                metrics.BYTES_SENT.labels("audio").inc(len(chunk))
         except Exception as e:
             logger.error(f"Error in send_audio: {str(e)}")
             logger.error(traceback.format_exc())
@@ -286,8 +384,16 @@ class AudioLoop:
 
     async def receive_audio(self):
         try:
+            receive_seconds = metrics.STAGE_SECONDS.labels("receive")
             while True:
+                    last_message = None
                     async for response in self.session.receive():
+                        # Gap between consecutive messages of the same turn
+                        now = time.perf_counter()
+                        if last_message is not None:
+                            receive_seconds.observe(now - last_message)
+                        last_message = now
+                        self.tracer.on_server_message()
                         server_content = response.server_content
                         if server_content is not None:
                             model_turn = server_content.model_turn
@@ -297,16 +403,30 @@ class AudioLoop:
                                 for part in parts:
                                     if part.text is not None:
                                         print(part.text, end="")
+                                        self.tracer.on_text_delta(part.text)
+                                        self.recorder.text_in(part.text)
+                                        self.transcript.on_text_delta(part.text)
                                         logger.info("Gemini Response: %s", part.text)
+                                        metrics.MESSAGES_RECEIVED.labels("text").inc()
+                                        metrics.BYTES_RECEIVED.labels("text").inc(len(part.text))
                                     elif part.inline_data is not None:
                                         audio_data = part.inline_data.data
+                                        self.turn_active = True
                                         self.audio_in_queue.put_nowait(audio_data)
+                                        self.recorder.audio_in(audio_data)
+                                        metrics.MESSAGES_RECEIVED.labels("audio").inc()
+                                        metrics.BYTES_RECEIVED.labels("audio").inc(len(audio_data))
                                         logger.info("Received audio data of size: %d bytes", len(audio_data))
 
                             server_content.model_turn = None
                             turn_complete = server_content.turn_complete
                             if turn_complete:
                                 logger.info("Audio response complete")
+                                self.turn_active = False
+                                metrics.TURNS_COMPLETED.inc()
+                                self.tracer.on_turn_complete()
+                                self.recorder.event("turn_complete")
+                                self.transcript.on_turn_complete()
                                 while not self.audio_in_queue.empty():
                                     self.audio_in_queue.get_nowait()
                
@@ -316,18 +436,24 @@ class AudioLoop:
             
              
     async def play_audio(self):
+        stream = None
         try:
             logger.info("Starting audio playback...")
-            pya = pyaudio.PyAudio()
             stream = await asyncio.to_thread(
-                pya.open, format=FORMAT, channels=CHANNELS, rate=RECEIVE_SAMPLE_RATE, output=True
+                audio_manager.get_manager().open_output,
+                format=FORMAT, channels=CHANNELS, rate=RECEIVE_SAMPLE_RATE
             )
             logger.info("Audio playback stream opened successfully")
         
             chunk_count = 0  # Track number of chunks played
             total_bytes_played = 0  # Track total bytes played
+            playback_seconds = metrics.STAGE_SECONDS.labels("playback")
             
             while True:
+                if self.audio_in_queue.empty():
+                    if self.turn_active:
+                        metrics.PLAYBACK_UNDERRUNS.inc()
+                    self.tracer.on_playback_idle()
                 bytestream = await self.audio_in_queue.get()
                 chunk_count += 1
                 total_bytes_played += len(bytestream)
@@ -336,7 +462,10 @@ class AudioLoop:
                 if chunk_count % 10 == 0:
                     logger.info(f"Playing audio chunk {chunk_count}, Total bytes played: {total_bytes_played}")
                 
-                await asyncio.to_thread(stream.write, bytestream)
+                write_start = time.monotonic()
+                with playback_seconds.time():
+                    await asyncio.to_thread(stream.write, bytestream)
+                self.tracer.on_playback(write_start, time.monotonic())
                 
                 # self.audio_in_queue.task_done()
            
@@ -346,6 +475,9 @@ class AudioLoop:
             logger.error(f"Error in play_audio: {str(e)}")
             logger.error(traceback.format_exc())
             os.kill(os.getpid(), signal.SIGTERM)
+        finally:
+            if stream:
+                stream.close()
 
         
 
@@ -362,8 +494,8 @@ class AudioLoop:
                 await task
             except asyncio.CancelledError:
                 logger.debug(f"Task {task.get_name()} cancelled successfully")
+        logger.info("Cleanup complete")
 
-    logger.info("Cleanup complete")
     async def run(self):
         logger.info("Starting AudioLoop.run()")
         try:
@@ -371,12 +503,21 @@ class AudioLoop:
             self.audio_in_queue = asyncio.Queue()
             self.audio_out_queue = asyncio.Queue()
             self.video_out_queue = asyncio.Queue()
+            metrics.watch_queue("audio_in", self.audio_in_queue)
+            metrics.watch_queue("audio_out", self.audio_out_queue)
+            metrics.watch_queue("video_out", self.video_out_queue)
+            metrics.register_command("frame", self.video_gate.request_frame)
             async with (
-                client.aio.live.connect(model=MODEL, config=CONFIG) as session,
+                get_client().aio.live.connect(model=MODEL, config=CONFIG) as session,
                 asyncio.TaskGroup() as tg,
             ):
                 self.session = session
                 logger.info("Session connected successfully")
+                self.recorder.event("session_start", model=MODEL)
+                self.transcript = audio_transcriber.open_transcript(self.transcript_path, "live_api_starter_desk",
+                                                                    MODEL, "screen")
+                self.frame_archive = frame_archive.open_archive(self.frame_archive_path, "live_api_starter_desk",
+                                                                self.frame_archive_bytes)
 
                 send_text_task = tg.create_task(self.send_text())
 
@@ -397,6 +538,9 @@ class AudioLoop:
                     tg.create_task(self.receive_audio()),
                     tg.create_task(self.play_audio())
                 ]
+                if self.stall_threshold:
+                    watchdog = LoopWatchdog(threshold=self.stall_threshold)
+                    tasks.append(tg.create_task(watchdog.run()))
 
                 def check_error(task):
                     if task.cancelled():
@@ -415,17 +559,71 @@ class AudioLoop:
         except Exception as e:
             logger.error(f"Error in run: {str(e)}")            
             logger.error(traceback.format_exc())
+            logger.info(self.video_gate.summary())
+            metrics.dump_json(self.metrics_json)
+            self.tracer.close()
+            self.recorder.close()
             os.kill(os.getpid(), signal.SIGTERM)
+        else:
+            logger.info(self.video_gate.summary())
+            metrics.dump_json(self.metrics_json)
+            self.tracer.close()
+            self.recorder.close()
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    # run_desk.sh passes --mode screen; screen capture is the only mode of this app
+    parser.add_argument("--mode", type=str, default="screen", choices=["screen"],
+                        help="pixels to stream from")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-json", type=str, default=None,
+                        help="write a JSON dump of the metrics to this file when the session ends")
+    parser.add_argument("--stall-threshold", type=float, default=0.2,
+                        help="report event loop stalls longer than this many seconds (0 disables)")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="append per-turn tracing spans (Chrome trace/Perfetto JSON) to this file")
+    parser.add_argument("--record", type=str, default=None,
+                        help="record the session (audio, frames, text and turn events) to this file")
+    # The overlay shows the conversation from this database
+    parser.add_argument("--transcript", type=str, default=audio_transcriber.DEFAULT_PATH,
+                        help="SQLite transcript database for user turns and model text ('' disables)")
+    parser.add_argument("--upload-kbps", type=float, default=None,
+                        help="upload budget in kilobits/s; video quality and frame rate adapt to stay within it")
+    parser.add_argument("--max-frame-kb", type=float, default=None,
+                        help="largest encoded frame in kilobytes (at least 2); quality is lowered per frame to stay within it")
+    parser.add_argument("--video-policy", type=str, default=video_gate.DEFAULT_POLICY, choices=video_gate.POLICIES,
+                        help="send frames only around user speech and on request (speech), or every interval (fixed)")
+    parser.add_argument("--screen-focus", action="store_true",
+                        help="send a small overview plus a full-resolution crop around the cursor (cursor and window tracking on Windows only; elsewhere the crop follows screen changes)")
+    parser.add_argument("--frame-archive", type=str, default=None,
+                        help="archive the frames sent to the model in this directory, deduplicated by content")
+    parser.add_argument("--frame-archive-mb", type=float, default=frame_archive.DEFAULT_MAX_BYTES / 1e6,
+                        help="size in megabytes the frame archive is kept under; the least recently sent go first")
+    args = parser.parse_args()
+
     logger = setup_logging()
     logger.info("Starting application...")
     print("Application started, type 'q' to exit the app.")
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port)
+    # kill -USR1 <pid> toggles the sampling profiler
+    profiler.install_signal_handler()
     try:
-        main = AudioLoop()
+        main = AudioLoop(metrics_json=args.metrics_json, stall_threshold=args.stall_threshold,
+                         trace_path=args.trace, record_path=args.record,
+                         transcript_path=args.transcript,
+                         upload_budget=args.upload_kbps * 1000 / 8 if args.upload_kbps else None,
+                         max_frame_bytes=int(args.max_frame_kb * 1000) if args.max_frame_kb else None,
+                         video_policy=args.video_policy, focus_capture=args.screen_focus,
+                         frame_archive_path=args.frame_archive,
+                         frame_archive_bytes=int(args.frame_archive_mb * 1e6))
         asyncio.run(main.run())
     except KeyboardInterrupt:
         logger.info("Application stopped by user")
+        profiler.PROFILER.stop()
     except Exception as e:
         logger.error(f"Application error: {str(e)}")
         logger.error(traceback.format_exc())
@@ -0,0 +1,134 @@
+# loop_watchdog.py
+
+"""
+Event-loop lag and stall detector for the AudioLoop variants.
+
+`LoopWatchdog.run()` is a small task that wakes up every `interval` seconds and
+measures how late it was scheduled. That lag feeds the `audioloop_loop_lag_seconds`
+histogram in the metrics registry.
+
+A monitor thread watches the task's heartbeat. When the loop has not run for
+longer than `threshold`, the monitor captures the stack of the event loop thread
+while it is still blocked, which points at the code that stalled the loop. When
+the loop recovers, a stall report with the duration and the captured stacks is
+appended to `logs/stalls_<timestamp>.log`.
+
+Usage:
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(LoopWatchdog(threshold=0.2).run(), name="loop_watchdog")
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = metrics.REGISTRY.histogram(
+    "audioloop_loop_lag_seconds", "How late the event loop ran a scheduled wake-up."
+)
+LOOP_STALLS = metrics.REGISTRY.counter(
+    "audioloop_loop_stalls_total", "Times the event loop was blocked longer than the stall threshold."
+)
+
+# Upper bound on distinct stacks kept for a single long stall.
+MAX_STACKS_PER_STALL = 5
+
+
+class LoopWatchdog:
+    """
+    Measures event loop scheduling lag and reports stalls with the blocking stack.
+
+    Attributes:
+        interval (float): Seconds between heartbeats.
+        threshold (float): Lag in seconds after which the loop counts as stalled.
+        report_path (str): File that stall reports are appended to.
+    """
+
+    def __init__(self, interval=0.05, threshold=0.2, logs_dir="logs"):
+        self.interval = interval
+        self.threshold = threshold
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.report_path = os.path.join(logs_dir, f"stalls_{timestamp}.log")
+        self.stall_count = 0
+
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+        self._monitor = None
+
+    async def run(self):
+        """Heartbeat task; runs until cancelled."""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._monitor = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._monitor.start()
+        logger.info(f"Loop watchdog started (threshold {self.threshold * 1000:.0f} ms)")
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                LOOP_LAG.observe(max(0.0, now - expected))
+                self._heartbeat = now
+        finally:
+            self._stop.set()
+            logger.info("Loop watchdog stopped.")
+
+    def _watch(self):
+        """Monitor thread: detect stalls and capture the blocked loop thread's stack."""
+        stall_start = None
+        stacks = []
+        while not self._stop.wait(self.interval / 2):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat
+            if blocked_for > self.interval + self.threshold:
+                if stall_start != heartbeat:
+                    stall_start = heartbeat
+                    stacks = []
+                # Capture once per threshold period while the stall lasts
+                if len(stacks) < MAX_STACKS_PER_STALL and blocked_for >= (len(stacks) + 1) * self.threshold:
+                    stack = self._loop_stack()
+                    if not stacks or stacks[-1][1] != stack:
+                        stacks.append((blocked_for, stack))
+            elif stall_start is not None and heartbeat != stall_start:
+                self._report(heartbeat - stall_start - self.interval, stacks)
+                stall_start = None
+                stacks = []
+
+    def _loop_stack(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return traceback.StackSummary()
+        return traceback.extract_stack(frame)
+
+    def _report(self, duration, stacks):
+        self.stall_count += 1
+        LOOP_STALLS.inc()
+        where = "unknown"
+        if stacks and stacks[0][1]:
+            innermost = stacks[0][1][-1]
+            where = f"{innermost.filename}:{innermost.lineno} in {innermost.name}"
+        logger.warning(f"Event loop stalled for {duration * 1000:.0f} ms at {where}; see {self.report_path}")
+        lines = [
+            f"=== Event loop stall at {datetime.now().isoformat(timespec='milliseconds')}: "
+            f"{duration * 1000:.0f} ms (threshold {self.threshold * 1000:.0f} ms) ===\n"
+        ]
+        for blocked_for, stack in stacks:
+            lines.append(f"--- Event loop thread stack after {blocked_for * 1000:.0f} ms ---\n")
+            lines.extend(stack.format())
+        lines.append("\n")
+        try:
+            os.makedirs(os.path.dirname(self.report_path) or ".", exist_ok=True)
+            with open(self.report_path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+        except OSError as e:
+            logger.error(f"Failed to write stall report: {e}")
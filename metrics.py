@@ -0,0 +1,466 @@
+# metrics.py
+
+"""
+In-process metrics registry for the AudioLoop variants.
+
+The registry holds counters, gauges and HDR-style latency histograms. The capture,
+encode, send, receive and playback paths of every AudioLoop variant update the
+module-level metrics defined at the bottom of this file.
+
+While a session is running the registry can be scraped in Prometheus text format
+through a small local HTTP server (`start_http_server`). When the session ends it can
+be dumped to a JSON file (`dump_json`).
+
+The same server doubles as the local control channel: functions registered with
+`register_command(name, fn)` run on `POST /control/<name>` and their result is
+returned as JSON.
+
+Only the standard library is used, so importing this module is cheap.
+
+Usage:
+    import metrics
+
+    metrics.start_http_server(9464)            # GET http://127.0.0.1:9464/metrics
+    with metrics.STAGE_SECONDS.labels("encode").time():
+        ...
+    metrics.BYTES_SENT.labels("audio").inc(len(data))
+    metrics.dump_json("logs/metrics.json")
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Histogram precision: 2**SUB_BUCKET_BITS linear sub-buckets per power of two,
+# which keeps the relative error of any recorded value below ~6%.
+SUB_BUCKET_BITS = 4
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+# Histograms record integer microseconds.
+HISTOGRAM_UNIT = 1e-6
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _bucket_index(value):
+    """Map a non-negative integer to its log-linear bucket index."""
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - (SUB_BUCKET_BITS + 1)
+    return (shift + 1) * SUB_BUCKET_COUNT + (value >> shift) - SUB_BUCKET_COUNT
+
+
+def _bucket_bounds(index):
+    """Return the [lower, upper) integer range covered by a bucket index."""
+    if index < SUB_BUCKET_COUNT:
+        return index, index + 1
+    shift = index // SUB_BUCKET_COUNT - 1
+    lower = (SUB_BUCKET_COUNT + index % SUB_BUCKET_COUNT) << shift
+    return lower, lower + (1 << shift)
+
+
+def _format_value(value):
+    if value is None or math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+    return "{" + body + "}"
+
+
+class _CounterChild:
+    """A monotonically increasing value."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+    def load(self, value):
+        with self._lock:
+            self.value += value
+
+
+class _GaugeChild:
+    """A value that can go up and down, or be computed at scrape time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """Evaluate `function()` whenever the gauge is collected, e.g. `queue.qsize`."""
+        self._function = function
+
+    def collect(self):
+        if self._function is None:
+            return self.value
+        try:
+            return float(self._function())
+        except Exception:
+            return math.nan
+
+    def load(self, value):
+        with self._lock:
+            self.value += value
+
+
+class _HistogramChild:
+    """
+    A latency histogram with HDR-style log-linear buckets.
+
+    Values are recorded in seconds and stored as integer microseconds in sparse
+    buckets, so recording is O(1) and memory only grows with the value range seen.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = _bucket_index(max(0, int(seconds / HISTOGRAM_UNIT)))
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self):
+        """Context manager that observes the duration of its block."""
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Return the value (in seconds) below which a fraction `q` of observations fall."""
+        with self._lock:
+            if not self.count:
+                return math.nan
+            target = max(1, math.ceil(q * self.count))
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= target:
+                    lower, upper = _bucket_bounds(index)
+                    return min((lower + upper - 1) / 2 * HISTOGRAM_UNIT, self.max)
+        return self.max
+
+    def collect(self):
+        with self._lock:
+            buckets = dict(self._buckets)
+            count, total, maximum = self.count, self.sum, self.max
+        return {
+            "count": count,
+            "sum": total,
+            "max": maximum,
+            "quantiles": {str(q): self.quantile(q) for q in DEFAULT_QUANTILES},
+            "buckets": {str(index): n for index, n in sorted(buckets.items())},
+        }
+
+    def load(self, value):
+        with self._lock:
+            for index, n in value.get("buckets", {}).items():
+                index = int(index)
+                self._buckets[index] = self._buckets.get(index, 0) + n
+            self.count += value.get("count", 0)
+            self.sum += value.get("sum", 0.0)
+            self.max = max(self.max, value.get("max", 0.0))
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _Metric:
+    """A named metric family; label combinations map to child values."""
+
+    type_name = None
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values, **kwargs):
+        """Return the child for the given label values, creating it on first use."""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self.child_class())
+        return child
+
+    def __getattr__(self, attr):
+        # Unlabelled metrics forward inc/set/observe/... to their single child.
+        if attr.startswith("_") or "_default" not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self._default, attr)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield dict(zip(self.labelnames, key)), child.collect()
+
+
+class Counter(_Metric):
+    type_name = "counter"
+    child_class = _CounterChild
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+    child_class = _GaugeChild
+
+
+class Histogram(_Metric):
+    type_name = "summary"
+    child_class = _HistogramChild
+
+
+class MetricsRegistry:
+    """Holds metric families and renders them for scraping or dumping."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labelnames):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as {metric.type_name}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=()):
+        return self._register(Histogram, name, documentation, labelnames)
+
+    def snapshot(self):
+        """Return all metrics as a JSON-serialisable dict."""
+        result = {}
+        for name, metric in list(self._metrics.items()):
+            result[name] = {
+                "type": metric.type_name,
+                "help": metric.documentation,
+                "labelnames": list(metric.labelnames),
+                "samples": [
+                    {"labels": labels, "value": value}
+                    for labels, value in metric.samples()
+                ],
+            }
+        return result
+
+    def merge(self, snapshot, gauges=True):
+        """
+        Add the samples of a `snapshot()`, e.g. from a worker process, into this registry.
+        Counters, gauges and histogram buckets are summed; `gauges=False` skips gauges.
+        """
+        factories = {"counter": self.counter, "gauge": self.gauge, "summary": self.histogram}
+        for name, family in snapshot.items():
+            if family["type"] == "gauge" and not gauges:
+                continue
+            metric = factories[family["type"]](name, family["help"], family["labelnames"])
+            for sample in family["samples"]:
+                metric.labels(**sample["labels"]).load(sample["value"])
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for name, metric in list(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type_name}")
+            for labels, value in metric.samples():
+                if isinstance(metric, Histogram):
+                    for q, qvalue in value["quantiles"].items():
+                        qlabels = dict(labels, quantile=q)
+                        lines.append(f"{name}{_format_labels(qlabels)} {_format_value(qvalue)}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Control channel commands, run on POST /control/<name>
+_COMMANDS = {}
+
+
+def register_command(name, function):
+    """Expose `function()` as `POST /control/<name>`; its return value is sent back as JSON."""
+    _COMMANDS[name] = function
+
+
+class _MetricsHandlerMixin:
+    """Request handling for the metrics server, mixed into `BaseHTTPRequestHandler`."""
+
+    registry = REGISTRY
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        name = path[len("/control/"):] if path.startswith("/control/") else None
+        function = _COMMANDS.get(name)
+        if function is None:
+            self.send_error(404)
+            return
+        try:
+            result = {"ok": True, "result": function()}
+            status = 200
+        except Exception as e:
+            logger.error(f"Control command {name} failed: {e}")
+            result = {"ok": False, "error": str(e)}
+            status = 500
+        self._send(status, "application/json", json.dumps(result, default=str).encode("utf-8"))
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path in ("/", "/metrics"):
+            body = self.registry.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.registry.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        elif path == "/control":
+            body = json.dumps(sorted(_COMMANDS)).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self._send(200, content_type, body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics endpoint: " + format, *args)
+
+
+def start_http_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """
+    Serve the registry on http://addr:port/metrics from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: call `shutdown()` on it to stop serving.
+    """
+    # http.server pulls in email/html parsing; only import it when serving
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    handler = type("MetricsHandler", (_MetricsHandlerMixin, BaseHTTPRequestHandler), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on http://{addr}:{server.server_port}/metrics")
+    return server
+
+
+def dump_json(path, registry=REGISTRY):
+    """Write a snapshot of the registry to `path`. Does nothing if `path` is falsy."""
+    if not path:
+        return
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.time(), "metrics": registry.snapshot()}, f, indent=2)
+        logger.info(f"Metrics written to {path}")
+    except OSError as e:
+        logger.error(f"Failed to write metrics to {path}: {e}")
+
+
+def watch_queue(name, queue):
+    """Report `queue.qsize()` as the `audioloop_queue_depth{queue=name}` gauge."""
+    QUEUE_DEPTH.labels(name).set_function(queue.qsize)
+
+
+# Metrics shared by all AudioLoop variants.
+STAGE_SECONDS = REGISTRY.histogram(
+    "audioloop_stage_seconds",
+    "Time spent in each pipeline stage (capture, encode, send, receive, playback).",
+    ["stage"],
+)
+MESSAGES_SENT = REGISTRY.counter(
+    "audioloop_messages_sent_total", "Messages sent to the model.", ["kind"]
+)
+BYTES_SENT = REGISTRY.counter(
+    "audioloop_bytes_sent_total", "Payload bytes sent to the model.", ["kind"]
+)
+MESSAGES_RECEIVED = REGISTRY.counter(
+    "audioloop_messages_received_total", "Messages received from the model.", ["kind"]
+)
+BYTES_RECEIVED = REGISTRY.counter(
+    "audioloop_bytes_received_total", "Payload bytes received from the model.", ["kind"]
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "audioloop_queue_depth", "Number of items waiting in each queue.", ["queue"]
+)
+PLAYBACK_UNDERRUNS = REGISTRY.counter(
+    "audioloop_playback_underruns_total",
+    "Times playback ran out of audio while the model was still sending a turn.",
+)
+TURNS_COMPLETED = REGISTRY.counter(
+    "audioloop_turns_completed_total", "Model turns completed."
+)
@@ -0,0 +1,204 @@
+# mock_server.py
+
+"""
+Local mock of the Gemini Live API (BidiGenerateContent) websocket endpoint.
+
+It speaks enough of the protocol for the AudioLoop variants, the gateway and the
+benchmarks to run without network access or an API key:
+
+    - the first message must be `setup`; it is answered with `setupComplete`;
+    - a client turn (`client_content` with `turn_complete`) is answered with one
+      model turn: audio chunks when the setup asked for AUDIO responses, otherwise
+      an echo of the text, followed by `turnComplete`;
+    - realtime input (`realtime_input.media_chunks`) is counted and otherwise
+      ignored, unless `audio_turn_seconds` is set: then every that many seconds of
+      received PCM is treated as the end of a spoken user turn and answered.
+
+Both the SDK's snake_case and camelCase client messages are accepted.
+
+Usage:
+    python mock_server.py --port 8765 --audio-turn-seconds 5
+
+    async with MockLiveServer(port=0) as server:
+        uri = server.uri   # ws://127.0.0.1:<port>/ws/...BidiGenerateContent
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import time
+
+from websockets.asyncio.server import serve
+
+logger = logging.getLogger(__name__)
+
+RECEIVE_SAMPLE_RATE = 24000
+SEND_SAMPLE_RATE = 16000
+WS_PATH = "/ws/google.ai.generativelanguage.v1alpha.GenerativeService.BidiGenerateContent"
+
+
+def _get(obj, snake, camel):
+    value = obj.get(snake)
+    return obj.get(camel) if value is None else value
+
+
+class MockLiveServer:
+    """
+    In-process mock Live API server.
+
+    Attributes:
+        reply_audio_seconds (float): Length of the audio answer to each turn.
+        reply_chunk_size (int): Bytes of PCM per audio message (24 kHz, 16-bit mono).
+        latency (float): Delay before the first message of an answer.
+        reply_pace (float): Audio is streamed at this multiple of real time, like the API
+            generating it; 0 sends the whole answer at once.
+        audio_turn_seconds (float): Answer after this many seconds of realtime PCM; 0 ignores audio.
+        stats (dict): Counters of connections, messages and bytes seen.
+        first_audio_at (list): `time.monotonic()` of the first PCM chunk on each connection,
+            used by startup benchmarks as "first audio sent".
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, reply_audio_seconds=1.0, reply_chunk_size=9600,
+                 latency=0.05, audio_turn_seconds=0.0, reply_pace=2.0):
+        self.host = host
+        self.port = port
+        self.reply_audio_seconds = reply_audio_seconds
+        self.reply_chunk_size = reply_chunk_size
+        self.latency = latency
+        self.audio_turn_seconds = audio_turn_seconds
+        self.reply_pace = reply_pace
+        self.stats = {"connections": 0, "active": 0, "turns": 0, "realtime_chunks": 0,
+                      "realtime_bytes": 0, "messages": 0}
+        self.first_audio_at = []
+        self._server = None
+        # A quiet 440 Hz-ish square wave, pre-encoded once for every answer
+        period = RECEIVE_SAMPLE_RATE // 440
+        wave = bytearray()
+        for i in range(reply_chunk_size // 2):
+            wave += (2000 if i % period < period // 2 else -2000).to_bytes(2, "little", signed=True)
+        self._audio_chunk_b64 = base64.b64encode(bytes(wave)).decode()
+
+    @property
+    def uri(self):
+        return f"ws://{self.host}:{self.port}{WS_PATH}"
+
+    async def start(self):
+        self._server = await serve(self._handle, self.host, self.port, max_size=None, compression=None)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Mock Live API server listening on {self.uri}")
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        await self._server.serve_forever()
+
+    async def _handle(self, ws):
+        self.stats["connections"] += 1
+        self.stats["active"] += 1
+        try:
+            setup = json.loads(await ws.recv())
+            setup = setup.get("setup") or {}
+            generation_config = _get(setup, "generation_config", "generationConfig") or {}
+            modalities = _get(generation_config, "response_modalities", "responseModalities") or ["AUDIO"]
+            audio_replies = "AUDIO" in [m.upper() for m in modalities]
+            await ws.send(json.dumps({"setupComplete": {}}))
+
+            pcm_bytes = 0
+            audio_seen = False
+            turn_bytes = self.audio_turn_seconds * SEND_SAMPLE_RATE * 2
+            async for raw in ws:
+                self.stats["messages"] += 1
+                message = json.loads(raw)
+                realtime = _get(message, "realtime_input", "realtimeInput")
+                if realtime is not None:
+                    chunks = _get(realtime, "media_chunks", "mediaChunks") or []
+                    if isinstance(chunks, dict):
+                        chunks = [chunks]
+                    for chunk in chunks:
+                        size = len(chunk.get("data", "")) * 3 // 4
+                        self.stats["realtime_chunks"] += 1
+                        self.stats["realtime_bytes"] += size
+                        if _get(chunk, "mime_type", "mimeType") == "audio/pcm":
+                            if not audio_seen:
+                                self.first_audio_at.append(time.monotonic())
+                                audio_seen = True
+                            pcm_bytes += size
+                    if turn_bytes and pcm_bytes >= turn_bytes:
+                        pcm_bytes = 0
+                        await self._answer(ws, audio_replies, "")
+                    continue
+                content = _get(message, "client_content", "clientContent")
+                if content is not None and _get(content, "turn_complete", "turnComplete"):
+                    text = " ".join(
+                        part.get("text", "")
+                        for turn in content.get("turns") or []
+                        for part in turn.get("parts") or []
+                    )
+                    await self._answer(ws, audio_replies, text)
+        except Exception as e:
+            if type(e).__name__ not in ("ConnectionClosedOK", "ConnectionClosedError"):
+                logger.error(f"Mock session failed: {e}")
+        finally:
+            self.stats["active"] -= 1
+
+    async def _answer(self, ws, audio_replies, text):
+        self.stats["turns"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if audio_replies:
+            chunks = max(1, int(self.reply_audio_seconds * RECEIVE_SAMPLE_RATE * 2 / self.reply_chunk_size))
+            part = {"inlineData": {"mimeType": f"audio/pcm;rate={RECEIVE_SAMPLE_RATE}",
+                                   "data": self._audio_chunk_b64}}
+            message = json.dumps({"serverContent": {"modelTurn": {"parts": [part]}}})
+            chunk_seconds = self.reply_chunk_size / (2 * RECEIVE_SAMPLE_RATE)
+            for i in range(chunks):
+                if i and self.reply_pace:
+                    await asyncio.sleep(chunk_seconds / self.reply_pace)
+                await ws.send(message)
+        else:
+            reply = f"echo: {text}" if text else "ok"
+            await ws.send(json.dumps({"serverContent": {"modelTurn": {"parts": [{"text": reply}]}}}))
+        await ws.send(json.dumps({"serverContent": {"turnComplete": True}}))
+
+
+async def _main(args):
+    server = MockLiveServer(args.host, args.port, reply_audio_seconds=args.reply_audio_seconds,
+                            latency=args.latency, audio_turn_seconds=args.audio_turn_seconds,
+                            reply_pace=args.reply_pace)
+    started = time.monotonic()
+    try:
+        await server.serve_forever()
+    finally:
+        logger.info(f"Mock server stopped after {time.monotonic() - started:.0f}s: {server.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the Gemini Live API websocket endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (0 picks a free port)")
+    parser.add_argument("--reply-audio-seconds", type=float, default=1.0, help="length of each audio answer")
+    parser.add_argument("--latency", type=float, default=0.05, help="delay before answering a turn")
+    parser.add_argument("--reply-pace", type=float, default=2.0,
+                        help="stream audio answers at this multiple of real time (0 sends them at once)")
+    parser.add_argument("--audio-turn-seconds", type=float, default=0.0,
+                        help="answer after this many seconds of streamed PCM (0 ignores realtime audio)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,155 @@
+# motion.py
+
+"""
+Motion-adaptive frame interval for the camera.
+
+A webcam pointed at someone sitting still sends the same picture every second, and
+a second is too slow when they hold something up to the camera. `MotionPacer`
+measures how much of the scene changes between frames and picks the camera interval
+from that, between `min_interval` and `max_interval`:
+
+    motion           changed share of a ~48-row luminance grid
+    <= STILL_SHARE   max_interval (4 s by default)
+    >= BUSY_SHARE    min_interval (0.25 s by default)
+    in between       interpolated on a log scale
+
+Each BGR frame (as cv2 reads it) is box-filtered into the grid with numpy. A cell
+counts as changed when its luminance moved by more than `NOISE_LEVEL` after taking
+out the frame-wide mean shift, so auto-exposure drift does not look like motion.
+The interval drops at once when motion appears and, when the scene settles, grows
+by a factor of up to `RELAX` per second.
+
+While the pacer waits for the next frame it keeps reading the camera every
+`min_interval`, so motion that starts during a long wait cuts it short:
+
+    pacer.update(bgr)                                   # from the frame that was sent
+    delay = governor.frame_delay(size, pacer.interval)  # the governor may stretch it
+    await pacer.pace(delay, read=lambda: cap.read()[1], until=lambda: gate.requested)
+
+`until` ends the wait early too, e.g. when a frame was requested.
+
+numpy is imported on first use, so importing this module stays cheap.
+"""
+
+import asyncio
+import logging
+import math
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 0.25
+MAX_INTERVAL = 4.0
+# Rows in the luminance grid motion is measured on
+GRID_ROWS = 48
+# Luminance change (0-255) a grid cell needs to count as changed
+NOISE_LEVEL = 10
+# Changed share of the grid at or below which the scene is still...
+STILL_SHARE = 0.005
+# ...and at or above which it is busy
+BUSY_SHARE = 0.15
+# Factor the interval may grow by per second while the scene settles
+RELAX = 1.5
+
+CAMERA_INTERVAL = metrics.REGISTRY.gauge(
+    "audioloop_camera_interval_seconds", "Camera frame interval chosen from scene motion."
+)
+CAMERA_MOTION = metrics.REGISTRY.gauge(
+    "audioloop_camera_motion", "Share of the camera picture that changed since the last frame."
+)
+
+
+def luma_grid(bgr, rows=GRID_ROWS):
+    """Mean luminance of `bgr` (an HxWx3 uint8 array) over a grid of about `rows` rows, as float32."""
+    import numpy as np
+
+    height, width = bgr.shape[:2]
+    step = max(1, height // rows)
+    h, w = height - height % step, width - width % step
+    # Sum bands of `step` rows (contiguous, so no copy of the frame), then blocks of
+    # `step` columns per channel, then weight the channels (BT.601)
+    bands = bgr[:h].reshape(h // step, step, width * 3).sum(axis=1, dtype=np.uint32)
+    blocks = bands[:, :w * 3].reshape(h // step, w // step, step, 3).sum(axis=2)
+    return blocks @ np.array([0.114, 0.587, 0.299], dtype=np.float32) / (step * step)
+
+
+class MotionPacer:
+    """
+    Chooses the camera interval from scene motion.
+
+    Args:
+        min_interval (float): Interval for a busy scene, in seconds.
+        max_interval (float): Interval for a still scene, in seconds.
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(f"Need 0 < min_interval <= max_interval, got {min_interval} and {max_interval}")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.motion = None
+        self._previous = None
+        self._updated_at = None
+
+    def update(self, bgr):
+        """Measure motion against the previous frame and update `interval`. Returns the changed share."""
+        import numpy as np
+
+        grid = luma_grid(bgr)
+        now = time.monotonic()
+        previous, self._previous = self._previous, grid
+        elapsed = now - self._updated_at if self._updated_at is not None else 0.0
+        self._updated_at = now
+        if previous is None or previous.shape != grid.shape:
+            return None
+        diff = grid - previous
+        diff -= diff.mean()
+        self.motion = float(np.count_nonzero(np.abs(diff) > NOISE_LEVEL)) / diff.size
+        target = self._target(self.motion)
+        interval = target if target < self.interval else min(target, self.interval * RELAX ** elapsed)
+        if interval != self.interval:
+            logger.debug(f"Camera interval {self.interval:.2f} -> {interval:.2f} s (motion {self.motion:.3f})")
+        self.interval = interval
+        CAMERA_MOTION.set(self.motion)
+        CAMERA_INTERVAL.set(interval)
+        return self.motion
+
+    def _target(self, motion):
+        if motion <= STILL_SHARE:
+            return self.max_interval
+        if motion >= BUSY_SHARE:
+            return self.min_interval
+        # Log-log interpolation: each doubling of motion takes off the same factor of interval
+        t = math.log(motion / STILL_SHARE) / math.log(BUSY_SHARE / STILL_SHARE)
+        return self.max_interval * (self.min_interval / self.max_interval) ** t
+
+    async def pace(self, delay, read, until=None):
+        """
+        Wait up to `delay` seconds before the next frame.
+
+        `delay` was computed from the current `interval`. Every `min_interval` the
+        scene is sampled with `read()` (a blocking call returning a BGR array or
+        None, run in a thread). If motion shortens the interval, the wait ends once
+        the shortened interval (stretched like `delay` was) has passed. It also ends
+        as soon as `until()` returns true (checked every `min_interval` at most).
+        """
+        if delay <= 0:
+            return
+        stretch = delay / self.interval
+        start = time.monotonic()
+        while True:
+            remaining = start + delay - time.monotonic()
+            if remaining <= 0 or (until is not None and until()):
+                return
+            await asyncio.sleep(min(remaining, self.min_interval))
+            if start + delay - time.monotonic() < self.min_interval:
+                # The frame is due before another sample would be
+                continue
+            frame = await asyncio.to_thread(read)
+            if frame is not None:
+                self.update(frame)
+            if time.monotonic() - start >= self.interval * stretch:
+                return
@@ -3,16 +3,19 @@ from PyQt5.QtCore import Qt, QPoint, QTimer, QSize, QRect
 from PyQt5.QtGui import QPalette, QColor, QCursor
 import sys
 import os
-import glob
+import time
+import audio_transcriber
 from live_api_starter_desk import CONFIG
 
+# Entries loaded at start and each time the view is scrolled to the top
+HISTORY_PAGE = 50
+
 class Overlay(QMainWindow):
     def __init__(self):
         super().__init__()
         self.dragging = False
         self.resizing = False
         self.offset = QPoint()
-        self.last_position = 0
         
         # Set window flags and attributes
         self.setWindowFlags(
@@ -275,42 +278,63 @@ class Overlay(QMainWindow):
         # Set minimum size for the window
         self.setMinimumSize(300, 400)
 
-        # Set up log file monitoring
-        self.logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+        # The conversation comes from the transcript database the desk app writes to:
+        # the newest page is loaded now, older pages when scrolling to the top
+        self.store = audio_transcriber.get_store()
+        self.entries = {}  # entry id -> Entry, for the loaded pages
+        self.history_done = False
+        page = self.store.history(limit=HISTORY_PAGE)
+        self.last_update = max((entry.updated for entry in page), default=time.time())
+        self.add_entries(page)
+        self.render_entries(scroll_to_bottom=True)
+        self.chat_display.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_chat_display)
-        self.timer.start(1000)  # Check for updates every second
+        self.timer.start(500)  # Check for new text twice a second
 
-    def get_latest_log_file(self):
-        log_files = glob.glob(os.path.join(self.logs_dir, '*.log'))
-        if not log_files:
-            return None
-        return max(log_files, key=os.path.getctime)
+    def add_entries(self, entries):
+        for entry in entries:
+            self.entries[entry.id] = entry
+        self.entries = dict(sorted(self.entries.items()))
 
-    def update_chat_display(self):
-        log_file = self.get_latest_log_file()
-        if not log_file:
-            return
+    def render_entries(self, scroll_to_bottom=False):
+        scrollbar = self.chat_display.verticalScrollBar()
+        at_bottom = scroll_to_bottom or scrollbar.value() >= scrollbar.maximum() - 5
+        self.chat_display.setPlainText("\n\n".join(
+            ("You: " if entry.role == "user" else "Gemini: ") + entry.text.strip()
+            for entry in self.entries.values()
+        ))
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
+    def update_chat_display(self):
         try:
-            with open(log_file, 'r') as f:
-                # Read all lines and get the last 50
-                lines = f.readlines()
-                recent_lines = lines[-50:] if len(lines) > 50 else lines
-                
-                # Update the display with the recent lines
-                self.chat_display.clear()
-                self.chat_display.setText(''.join(recent_lines))
-                
-                # Scroll to bottom
-                self.chat_display.verticalScrollBar().setValue(
-                    self.chat_display.verticalScrollBar().maximum()
-                )
-                
-                # Update position to end of file
-                self.last_position = f.tell()
+            changed = self.store.updated_since(self.last_update)
         except Exception as e:
-            print(f"Error reading log file: {e}")
+            print(f"Error reading transcripts: {e}")
+            return
+        oldest = next(iter(self.entries), None)
+        # Rows older than the loaded pages are picked up when those pages are loaded
+        changed = [entry for entry in changed if oldest is None or entry.id >= oldest]
+        if changed:
+            self.last_update = max(entry.updated for entry in changed)
+            self.add_entries(changed)
+            self.render_entries()
+
+    def on_scroll(self, value):
+        if value != 0 or self.history_done or not self.entries:
+            return
+        older = self.store.history(limit=HISTORY_PAGE, before=next(iter(self.entries)))
+        if not older:
+            self.history_done = True
+            return
+        scrollbar = self.chat_display.verticalScrollBar()
+        height = scrollbar.maximum()
+        self.add_entries(older)
+        self.render_entries()
+        # Keep the entry that was at the top in view
+        scrollbar.setValue(scrollbar.maximum() - height)
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
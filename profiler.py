@@ -0,0 +1,174 @@
+# profiler.py
+
+"""
+On-demand sampling profiler for a running AudioLoop process.
+
+`SamplingProfiler` runs a daemon thread that samples the stacks of every thread
+in the process, including the `asyncio.to_thread` workers that do JPEG encoding
+and PyAudio reads/writes. It uses `sys._current_frames()` at a fixed interval, so
+there is no tracing overhead and nothing to attach from outside. When it stops,
+the samples are written in collapsed-stack format (one `thread;frame;frame count`
+line per unique stack), ready for `flamegraph.pl` or https://www.speedscope.app.
+
+The profiler can be toggled without restarting the session:
+    - by a signal: `kill -USR1 <pid>` (see `install_signal_handler`);
+    - over the local control channel: `curl -X POST http://127.0.0.1:PORT/control/profile`
+      when the metrics endpoint is enabled with `--metrics-port`.
+"""
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.01  # 100 Hz
+
+
+class SamplingProfiler:
+    """
+    Samples all thread stacks at a fixed interval and writes collapsed stacks on stop.
+
+    Attributes:
+        interval (float): Seconds between samples.
+        logs_dir (str): Directory the `profile_<timestamp>.folded` files are written to.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, logs_dir="logs"):
+        self.interval = interval
+        self.logs_dir = logs_dir
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._samples = collections.Counter()
+        self._sample_count = 0
+        self._started_at = None
+        self._frame_names = {}
+        self._thread_names = {}
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._samples.clear()
+            self._sample_count = 0
+            self._started_at = time.monotonic()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_loop, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        logger.info(f"Sampling profiler started ({1 / self.interval:.0f} Hz)")
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks. Returns the output path, or None."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return None
+            self._stop.set()
+            thread.join()
+            self._thread = None
+        return self._write()
+
+    def toggle(self):
+        """Start if stopped, stop (and write the profile) if running."""
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        next_sample = time.monotonic()
+        while not self._stop.is_set():
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                stack = [self._thread_name(ident)]
+                while frame is not None:
+                    stack.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                # Root first, leaf last
+                stack[1:] = stack[:0:-1]
+                self._samples[tuple(stack)] += 1
+            frames = frame = None
+            self._sample_count += 1
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_sample = time.monotonic()
+
+    def _frame_name(self, code):
+        name = self._frame_names.get(code)
+        if name is None:
+            name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            # Semicolons separate frames in the collapsed format
+            name = self._frame_names[code] = name.replace(";", ":")
+        return name
+
+    def _thread_name(self, ident):
+        name = self._thread_names.get(ident)
+        if name is None:
+            self._thread_names = {t.ident: t.name for t in threading.enumerate()}
+            name = self._thread_names.setdefault(ident, f"thread-{ident}")
+        return name
+
+    def _write(self):
+        duration = time.monotonic() - self._started_at
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(self.logs_dir, f"profile_{timestamp}.folded")
+        try:
+            os.makedirs(self.logs_dir, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self._samples.most_common():
+                    f.write(";".join(stack) + f" {count}\n")
+        except OSError as e:
+            logger.error(f"Failed to write profile: {e}")
+            return None
+        logger.info(f"Sampling profiler stopped after {duration:.1f}s "
+                    f"({self._sample_count} samples); collapsed stacks written to {path}")
+        return path
+
+
+PROFILER = SamplingProfiler()
+
+
+def install_signal_handler(signum=getattr(signal, "SIGUSR1", None), profiler=PROFILER):
+    """
+    Toggle `profiler` whenever the process receives `signum` (SIGUSR1 by default).
+
+    Does nothing on platforms without the signal (e.g. Windows). Must be called from
+    the main thread.
+    """
+    if signum is None:
+        logger.debug("SIGUSR1 is not available on this platform; profiler signal not installed.")
+        return False
+
+    def handle(signum, frame):
+        # Stopping joins the sampler and writes a file; keep that off the interrupted frame.
+        threading.Thread(target=profiler.toggle, name="profiler-toggle", daemon=True).start()
+
+    signal.signal(signum, handle)
+    logger.info(f"Send signal {signal.Signals(signum).name} to pid {os.getpid()} to toggle the sampling profiler.")
+    return True
+
+
+def _profile_command(profiler=PROFILER):
+    path = profiler.toggle()
+    return {"running": profiler.running, "output": path}
+
+
+metrics.register_command("profile", _profile_command)
@@ -0,0 +1,392 @@
+# recorder.py
+
+"""
+Session recorder: everything that crosses the session boundary, in one append-only file.
+
+A recording captures, with monotonic timestamps:
+
+    AUDIO_OUT   PCM sent to the model (16 kHz, 16-bit mono)
+    FRAME_OUT   camera/screen frames sent to the model (JPEG/PNG/...)
+    TEXT_OUT    user text turns
+    AUDIO_IN    PCM received from the model (24 kHz)
+    TEXT_IN     text received from the model
+    EVENT       session and turn events (session_start, turn_complete, session_end, ...)
+
+File layout (little endian):
+
+    header   b"ALREC\\x00\\x01\\x00" | u32 length | JSON metadata
+    records  u32 payload length | u8 kind | u8 flags | i64 t_ns | payload
+    footer   an INDEX record: (i64 t_ns, u64 offset) pairs, one per `index_interval` seconds
+    trailer  b"ALRECIDX" | u64 offset of the INDEX record
+
+`t_ns` is nanoseconds since the recording started. Frames that were already base64
+encoded by the variant are stored as they are, with the FLAG_BASE64 flag, so the
+hot path never decodes them. A recording whose process died before `close()` has
+no footer; `RecordingReader` then rebuilds the index by walking the records.
+
+Recording runs off the hot path: the hooks only timestamp the data and put a
+reference on a bounded queue. A background thread packs and writes the records.
+When the writer falls behind, records are dropped and counted, so the session
+itself is never slowed down.
+
+Usage:
+    recorder = Recorder("logs/session.alrec", {"variant": "audio_loop"})
+    recorder.media_out(pcm, "audio/pcm")
+    recorder.close()
+
+    python recorder.py info logs/session.alrec
+    python recorder.py dump logs/session.alrec --kind text_in
+"""
+
+import argparse
+import atexit
+import base64
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ALREC\x00\x01\x00"
+TRAILER_MAGIC = b"ALRECIDX"
+RECORD_HEADER = struct.Struct("<IBBq")
+INDEX_ENTRY = struct.Struct("<qQ")
+TRAILER = struct.Struct("<8sQ")
+
+AUDIO_OUT, FRAME_OUT, TEXT_OUT, AUDIO_IN, TEXT_IN, EVENT = range(1, 7)
+INDEX = 0xFF
+KIND_NAMES = {AUDIO_OUT: "audio_out", FRAME_OUT: "frame_out", TEXT_OUT: "text_out", AUDIO_IN: "audio_in",
+              TEXT_IN: "text_in", EVENT: "event", INDEX: "index"}
+
+# flags: low bits index MIME_TYPES, FLAG_BASE64 marks payloads stored base64-encoded
+MIME_TYPES = ("", "audio/pcm", "image/jpeg", "image/png", "image/webp")
+FLAG_BASE64 = 0x80
+MIME_MASK = 0x7F
+MIME_INLINE = 0x7F  # unknown MIME type: payload is b"<mime>\0<data>"
+
+RECORDER_RECORDS = metrics.REGISTRY.counter(
+    "audioloop_recorder_records_total", "Records written by the session recorder.", ["kind"]
+)
+RECORDER_BYTES = metrics.REGISTRY.counter(
+    "audioloop_recorder_bytes_total", "Bytes written to recordings."
+)
+RECORDER_DROPPED = metrics.REGISTRY.counter(
+    "audioloop_recorder_dropped_total", "Records dropped because the recorder's writer fell behind."
+)
+
+
+def _mime_flags(mime_type):
+    try:
+        return MIME_TYPES.index(mime_type)
+    except ValueError:
+        return MIME_INLINE
+
+
+class Recorder:
+    """
+    Writes a session recording from a background thread.
+
+    All hooks are no-ops when `path` is None, so the AudioLoop variants can call
+    them unconditionally.
+
+    Args:
+        path (str): Recording file to create.
+        metadata (dict, optional): Stored in the header, e.g. variant, mode and sample rates.
+        index_interval (float): Seconds between seek index entries.
+        max_pending (int): Records that may wait for the writer before new ones are dropped.
+    """
+
+    def __init__(self, path=None, metadata=None, index_interval=1.0, max_pending=4096):
+        self.path = path
+        self._queue = None
+        if not path:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._start_ns = time.monotonic_ns()
+        header = dict(metadata or {})
+        header.setdefault("created", time.time())
+        header.setdefault("pid", os.getpid())
+        header_bytes = json.dumps(header).encode("utf-8")
+        self._file = open(path, "wb", buffering=1 << 20)
+        self._file.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        self._offset = self._file.tell()
+        self._index = []
+        self._index_interval_ns = int(index_interval * 1e9)
+        self._next_index_ns = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._write_loop, name="session-recorder", daemon=True)
+        self._thread.start()
+        # Sessions that end by cancellation skip their cleanup; still write the index at exit
+        atexit.register(self.close)
+        logger.info(f"Recording session to {path}")
+
+    @property
+    def enabled(self):
+        return self._queue is not None
+
+    # ---- hooks ----------------------------------------------------------------
+
+    def media_out(self, data, mime_type):
+        """Record realtime input: PCM or a frame, as raw bytes or a base64 str."""
+        if self._queue is None:
+            return
+        kind = AUDIO_OUT if mime_type.startswith("audio/") else FRAME_OUT
+        self._put(kind, _mime_flags(mime_type), data, mime_type)
+
+    def text_out(self, text):
+        if self._queue is not None:
+            self._put(TEXT_OUT, 0, text, None)
+
+    def audio_in(self, pcm):
+        if self._queue is not None:
+            self._put(AUDIO_IN, _mime_flags("audio/pcm"), pcm, None)
+
+    def text_in(self, text):
+        if self._queue is not None:
+            self._put(TEXT_IN, 0, text, None)
+
+    def event(self, name, **fields):
+        """Record a session or turn event, e.g. `event("turn_complete")`."""
+        if self._queue is not None:
+            fields["event"] = name
+            self._put(EVENT, 0, fields, None)
+
+    def close(self):
+        """Flush pending records, write the seek index and close the file."""
+        if self._queue is None:
+            return
+        self.event("session_end")
+        self._queue.put(None)
+        self._thread.join()
+        self._queue = None
+        atexit.unregister(self.close)
+        logger.info(f"Recording closed: {self.path} ({self._offset} bytes)")
+
+    # ---- writer ---------------------------------------------------------------
+
+    def _put(self, kind, flags, data, mime_type):
+        try:
+            self._queue.put_nowait((kind, flags, time.monotonic_ns() - self._start_ns, data, mime_type))
+        except queue.Full:
+            RECORDER_DROPPED.inc()
+
+    def _write_loop(self):
+        write = self._file.write
+        last_flush = time.monotonic()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            kind, flags, t_ns, data, mime_type = item
+            if isinstance(data, str):
+                if kind == FRAME_OUT or kind == AUDIO_OUT:
+                    flags |= FLAG_BASE64
+                data = data.encode("utf-8" if not flags & FLAG_BASE64 else "ascii")
+            elif isinstance(data, dict):
+                data = json.dumps(data).encode("utf-8")
+            if flags & MIME_MASK == MIME_INLINE:
+                data = mime_type.encode("utf-8") + b"\0" + data
+            if t_ns >= self._next_index_ns:
+                self._index.append((t_ns, self._offset))
+                self._next_index_ns = t_ns + self._index_interval_ns
+            write(RECORD_HEADER.pack(len(data), kind, flags, t_ns))
+            write(data)
+            self._offset += RECORD_HEADER.size + len(data)
+            RECORDER_RECORDS.labels(KIND_NAMES[kind]).inc()
+            RECORDER_BYTES.inc(RECORD_HEADER.size + len(data))
+            # Keep a crash from losing more than about a second of data
+            if self._queue.empty() and time.monotonic() - last_flush > 1.0:
+                self._file.flush()
+                last_flush = time.monotonic()
+        index = b"".join(INDEX_ENTRY.pack(t_ns, offset) for t_ns, offset in self._index)
+        index_offset = self._offset
+        write(RECORD_HEADER.pack(len(index), INDEX, 0, 0))
+        write(index)
+        write(TRAILER.pack(TRAILER_MAGIC, index_offset))
+        self._offset += RECORD_HEADER.size + len(index) + TRAILER.size
+        self._file.close()
+
+
+class Record:
+    """One record of a recording; `payload` is a memoryview into the mapped file."""
+
+    __slots__ = ("kind", "flags", "t_ns", "payload", "offset")
+
+    def __init__(self, kind, flags, t_ns, payload, offset):
+        self.kind = kind
+        self.flags = flags
+        self.t_ns = t_ns
+        self.payload = payload
+        self.offset = offset
+
+    @property
+    def kind_name(self):
+        return KIND_NAMES.get(self.kind, str(self.kind))
+
+    @property
+    def mime_type(self):
+        index = self.flags & MIME_MASK
+        if index == MIME_INLINE:
+            return bytes(self.payload[: bytes(self.payload[:256]).index(b"\0")]).decode("utf-8")
+        return MIME_TYPES[index] if index < len(MIME_TYPES) else ""
+
+    @property
+    def is_base64(self):
+        return bool(self.flags & FLAG_BASE64)
+
+    def data(self):
+        """Payload bytes, base64-decoded if they were stored encoded."""
+        payload = self.payload
+        if self.flags & MIME_MASK == MIME_INLINE:
+            payload = payload[bytes(payload[:256]).index(b"\0") + 1:]
+        return base64.b64decode(payload) if self.is_base64 else bytes(payload)
+
+    def text(self):
+        return bytes(self.payload).decode("utf-8")
+
+    def json(self):
+        return json.loads(bytes(self.payload))
+
+
+class RecordingReader:
+    """
+    Memory-maps a recording and iterates over its records without copying payloads.
+
+    Usage:
+        with RecordingReader("session.alrec") as rec:
+            for record in rec.records(start_ns=rec.seek(60e9)):
+                ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if self._view[: len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a session recording")
+        (header_len,) = struct.unpack_from("<I", self._mmap, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.metadata = json.loads(bytes(self._view[start:start + header_len]))
+        self.data_offset = start + header_len
+        self.data_end, self.index = self._load_index()
+
+    def _load_index(self):
+        size = len(self._mmap)
+        if size >= self.data_offset + TRAILER.size:
+            magic, index_offset = TRAILER.unpack_from(self._mmap, size - TRAILER.size)
+            if magic == TRAILER_MAGIC:
+                length, kind, _, _ = RECORD_HEADER.unpack_from(self._mmap, index_offset)
+                start = index_offset + RECORD_HEADER.size
+                entries = [INDEX_ENTRY.unpack_from(self._mmap, start + i)
+                           for i in range(0, length, INDEX_ENTRY.size)]
+                return index_offset, entries
+        # No footer: the recording was not closed. Walk the records and keep the complete ones.
+        logger.warning(f"{self.path} has no index (not closed cleanly); rebuilding it")
+        entries, offset, next_ns = [], self.data_offset, 0
+        while offset + RECORD_HEADER.size <= size:
+            length, kind, _, t_ns = RECORD_HEADER.unpack_from(self._mmap, offset)
+            if offset + RECORD_HEADER.size + length > size:
+                break
+            if t_ns >= next_ns:
+                entries.append((t_ns, offset))
+                next_ns = t_ns + 1_000_000_000
+            offset += RECORD_HEADER.size + length
+        return offset, entries
+
+    @property
+    def duration(self):
+        """Timestamp of the last record, in seconds."""
+        last = 0
+        for record in self.records(start_offset=self.index[-1][1] if self.index else None):
+            last = record.t_ns
+        return last / 1e9
+
+    def seek(self, t_ns):
+        """File offset of the last indexed record at or before `t_ns`."""
+        offset = self.data_offset
+        for entry_ns, entry_offset in self.index:
+            if entry_ns > t_ns:
+                break
+            offset = entry_offset
+        return offset
+
+    def records(self, kinds=None, start_offset=None, start_ns=None):
+        """Yield `Record`s in file order, optionally filtered by kind and starting at a time."""
+        offset = self.data_offset if start_offset is None else start_offset
+        if start_ns is not None:
+            offset = self.seek(start_ns)
+        header, view, end = RECORD_HEADER, self._view, self.data_end
+        while offset + header.size <= end:
+            length, kind, flags, t_ns = header.unpack_from(self._mmap, offset)
+            payload_start = offset + header.size
+            if (kinds is None or kind in kinds) and (start_ns is None or t_ns >= start_ns):
+                yield Record(kind, flags, t_ns, view[payload_start:payload_start + length], offset)
+            offset = payload_start + length
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # Records still reference the mapping; it is unmapped when they are collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _info(path):
+    with RecordingReader(path) as rec:
+        counts, sizes, last = {}, {}, 0
+        for record in rec.records():
+            name = record.kind_name
+            counts[name] = counts.get(name, 0) + 1
+            sizes[name] = sizes.get(name, 0) + len(record.payload)
+            last = record.t_ns
+        print(f"{path}: {os.path.getsize(path)} bytes, {last / 1e9:.1f}s, {len(rec.index)} index entries")
+        print(f"metadata: {json.dumps(rec.metadata)}")
+        for name in sorted(counts):
+            print(f"  {name:<10}{counts[name]:>8} records{sizes[name]:>12} bytes")
+
+
+def _dump(path, kind):
+    kinds = None
+    if kind:
+        kinds = {code for code, name in KIND_NAMES.items() if name == kind}
+    with RecordingReader(path) as rec:
+        for record in rec.records(kinds):
+            if record.kind in (TEXT_OUT, TEXT_IN):
+                detail = repr(record.text())
+            elif record.kind == EVENT:
+                detail = json.dumps(record.json())
+            else:
+                detail = f"{record.mime_type} {len(record.payload)} bytes{' (base64)' if record.is_base64 else ''}"
+            print(f"{record.t_ns / 1e9:10.3f}  {record.kind_name:<10}{detail}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect session recordings.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    info = sub.add_parser("info", help="summarize a recording")
+    info.add_argument("path")
+    dump = sub.add_parser("dump", help="list the records of a recording")
+    dump.add_argument("path")
+    dump.add_argument("--kind", choices=sorted(n for n in KIND_NAMES.values() if n != "index"))
+    args = parser.parse_args()
+    if args.command == "info":
+        _info(args.path)
+    else:
+        _dump(args.path, args.kind)
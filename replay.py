@@ -0,0 +1,250 @@
+# replay.py
+
+"""
+Replay recorded sessions through the AudioLoop pipeline against the mock server.
+
+A recording from `--record` (see `recorder.py`) holds everything a session sent:
+microphone PCM, frames and text turns, with their timestamps. `ReplayAudioLoop`
+is a headless `audio_loop.AudioLoop` whose microphone, camera and keyboard are
+replaced by the recording. The recorded media goes through the same `out_queue`,
+`send_realtime` (SDK encode and send) and `send_text` path as live input, and the
+answers go through `receive_audio` and a virtual speaker.
+
+Pacing:
+
+    --speed 1     recorded timing (real time)
+    --speed 10    ten times faster, same relative timing
+    --speed 0     as fast as the pipeline accepts input (backpressure from `out_queue`)
+
+A single task feeds all records in file order, and a text turn is handed to the
+sender only after the media queued before it. A replay therefore sends the same
+sequence of messages every time; only the timing varies.
+
+Each run prints a report: recorded vs replay seconds, bytes and messages per second,
+schedule slip (how late records were sent against the pacing; 0 at --speed 0),
+text-turn latency (from sending a turn to the first message of the next answer),
+turns completed and CPU time. `--json` writes the same numbers for comparing runs.
+
+    python replay.py logs/session.alrec --speed 1
+    python replay.py logs/*.alrec --speed 0 --concurrency 20 --repeat 10 --json replay.json
+
+Without `--uri`, a local `mock_server.py` is started for the run.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import statistics
+import time
+
+import metrics
+import recorder
+from gateway import AUDIO_CONFIG, MODEL, TEXT_CONFIG, HeadlessAudioLoop, _mock_server_process, make_client
+from recorder import RecordingReader
+from tracing import TurnTracer
+
+logger = logging.getLogger(__name__)
+
+OUTGOING = {recorder.AUDIO_OUT, recorder.FRAME_OUT, recorder.TEXT_OUT}
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+class _ReplayTracer(TurnTracer):
+    """Turn tracer that also tells the replay when an answer starts, at receive time."""
+
+    def __init__(self, session, path=None):
+        super().__init__(path)
+        self.session = session
+        self._answering = False
+
+    def on_server_message(self):
+        if not self._answering:
+            self._answering = True
+            self.session._on_answer_start()
+        super().on_server_message()
+
+    def on_turn_complete(self):
+        self._answering = False
+        super().on_turn_complete()
+
+
+class ReplayAudioLoop(HeadlessAudioLoop):
+    """
+    A headless session whose input is a recording.
+
+    Args:
+        path (str): Recording to replay.
+        speed (float): Pacing as a multiple of the recorded timing; 0 replays as fast as possible.
+        session_id (str, optional): Name used in logs; defaults to the file name.
+        tail (float): Seconds to keep the session open after the last record, for the last answer.
+        trace_path (str, optional): File per-turn tracing spans of the replay are appended to.
+        uri, limits, on_audio, on_text: As for `HeadlessAudioLoop`.
+    """
+
+    def __init__(self, path, speed=1.0, session_id=None, tail=1.0, trace_path=None, uri=None, limits=None,
+                 on_audio=None, on_text=None):
+        super().__init__(session_id or os.path.basename(path), on_audio=on_audio, on_text=on_text,
+                         limits=limits, uri=uri)
+        self.tracer = _ReplayTracer(self, trace_path)
+        self.path = path
+        self.speed = speed
+        self.tail = tail
+        # Send times of text turns still waiting for the start of an answer
+        self._pending_turns = collections.deque()
+        self.recorded_seconds = 0.0
+        self.replay_seconds = 0.0
+        self.slips = []
+        self.latencies = []
+        self.stats.update({"records": 0, "text_sent": 0, "bytes_sent": 0})
+
+    def _on_answer_start(self):
+        if self._pending_turns:
+            self.latencies.append(time.perf_counter() - self._pending_turns.popleft())
+
+    async def listen_audio(self):
+        """Feed the recording's outgoing records, paced by their timestamps, then end the session."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with RecordingReader(self.path) as reader:
+            for record in reader.records(OUTGOING):
+                self.recorded_seconds = record.t_ns / 1e9
+                if self.speed:
+                    delay = start + self.recorded_seconds / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    else:
+                        self.slips.append(-delay)
+                if record.kind == recorder.TEXT_OUT:
+                    # Keep the recorded order: media queued before the turn is sent first
+                    while not self.out_queue.empty():
+                        await asyncio.sleep(0)
+                    self._pending_turns.append(time.perf_counter())
+                    await self.user_input_queue.put(record.text())
+                    self.stats["text_sent"] += 1
+                else:
+                    # The SDK sends base64 str payloads as they are and encodes bytes itself
+                    data = bytes(record.payload)
+                    if record.is_base64:
+                        data = data.decode("ascii")
+                    elif record.kind == recorder.AUDIO_OUT:
+                        self.tracer.on_user_audio(data)
+                    await self._upload(len(data))
+                    await self.out_queue.put({"data": data, "mime_type": record.mime_type})
+                    self.stats["audio_sent" if record.kind == recorder.AUDIO_OUT else "frames_sent"] += 1
+                    self.stats["bytes_sent"] += len(data)
+                self.stats["records"] += 1
+                del record  # release the memoryview so the mapping can be closed
+        self.replay_seconds = loop.time() - start
+        await asyncio.sleep(self.tail)
+        self.stop()
+
+    async def get_frames(self):
+        # Frames are replayed by listen_audio, in order with the audio
+        return
+
+    get_screen = get_frames
+
+
+async def replay(paths, uri, speed=1.0, concurrency=1, repeat=1, config=AUDIO_CONFIG, tail=1.0, trace_path=None):
+    """Replay `paths` (each `repeat` times), at most `concurrency` sessions at once; returns the report."""
+    client = make_client(uri)
+    jobs = [path for _ in range(repeat) for path in paths]
+    semaphore = asyncio.Semaphore(concurrency)
+    sessions = []
+    turns_before = metrics.TURNS_COMPLETED.value
+
+    async def run_one(number, path):
+        async with semaphore:
+            session = ReplayAudioLoop(path, speed, session_id=f"{os.path.basename(path)}#{number}", tail=tail,
+                                      trace_path=trace_path, uri=uri)
+            sessions.append(session)
+            await session.run(MODEL, config, "text", client)
+
+    cpu_before, wall_before = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(run_one(i, path) for i, path in enumerate(jobs)))
+    cpu, wall = time.process_time() - cpu_before, time.perf_counter() - wall_before
+
+    slips = [s for session in sessions for s in session.slips]
+    latencies = [s for session in sessions for s in session.latencies]
+    recorded = sum(session.recorded_seconds for session in sessions)
+    # Time spent feeding records, summed like `recorded`; excludes connecting and the tail
+    replayed = sum(session.replay_seconds for session in sessions)
+    sent = sum(session.stats["bytes_sent"] for session in sessions)
+    records = sum(session.stats["records"] for session in sessions)
+    return {
+        "sessions": len(sessions),
+        "speed": speed,
+        "recorded_seconds": recorded,
+        "wall_seconds": wall,
+        "replay_seconds": replayed,
+        "effective_speed": recorded / replayed if replayed else 0.0,
+        "records": records,
+        "records_per_second": records / wall if wall else 0.0,
+        "bytes_sent": sent,
+        "mb_per_second": sent / wall / 1e6 if wall else 0.0,
+        "slip_p50_ms": _percentile(slips, 50) * 1000,
+        "slip_p99_ms": _percentile(slips, 99) * 1000,
+        "slip_max_ms": max(slips, default=0.0) * 1000,
+        "text_turns": len(latencies),
+        "latency_p50_ms": _percentile(latencies, 50) * 1000,
+        "latency_p95_ms": _percentile(latencies, 95) * 1000,
+        "turns_completed": metrics.TURNS_COMPLETED.value - turns_before,
+        "audio_received": sum(session.stats["audio_played"] for session in sessions),
+        "cpu_seconds": cpu,
+    }
+
+
+def print_report(r):
+    pace = "as fast as possible" if not r["speed"] else f"{r['speed']:g}x"
+    print(f"{r['sessions']} sessions at {pace}: {r['recorded_seconds']:.1f}s recorded, replayed in "
+          f"{r['replay_seconds']:.2f}s ({r['effective_speed']:.1f}x); {r['wall_seconds']:.1f}s wall, "
+          f"{r['cpu_seconds']:.2f}s CPU")
+    print(f"  sent        {r['records']} records ({r['records_per_second']:.0f}/s), "
+          f"{r['bytes_sent'] / 1e6:.1f} MB ({r['mb_per_second']:.2f} MB/s)")
+    print(f"  slip        p50 {r['slip_p50_ms']:.1f} ms, p99 {r['slip_p99_ms']:.1f} ms, max {r['slip_max_ms']:.1f} ms")
+    print(f"  text turns  {r['text_turns']} answered, latency p50 {r['latency_p50_ms']:.1f} ms, "
+          f"p95 {r['latency_p95_ms']:.1f} ms")
+    print(f"  received    {r['turns_completed']:.0f} turns, {r['audio_received'] / 1e6:.1f} MB of audio")
+
+
+async def _main(args, uri):
+    config = TEXT_CONFIG if args.text else AUDIO_CONFIG
+    report = await replay(args.paths, uri, args.speed, args.concurrency, args.repeat, config, args.tail, args.trace)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded sessions against the mock Live API server.")
+    parser.add_argument("paths", nargs="+", help="recordings made with --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="multiple of the recorded pace (0 replays as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=1, help="sessions replayed at the same time")
+    parser.add_argument("--repeat", type=int, default=1, help="replay every recording this many times")
+    parser.add_argument("--uri", default=None, help="server to replay against (default: a local mock_server.py)")
+    parser.add_argument("--text", action="store_true", help="ask for TEXT instead of AUDIO responses")
+    parser.add_argument("--tail", type=float, default=1.0, help="seconds to wait for answers after the last record")
+    parser.add_argument("--audio-turn-seconds", type=float, default=4.0,
+                        help="the local mock answers after this many seconds of streamed audio")
+    parser.add_argument("--trace", default=None, help="append per-turn tracing spans of the replay to this file")
+    parser.add_argument("--json", default=None, help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if args.uri:
+        asyncio.run(_main(args, args.uri))
+    else:
+        with _mock_server_process(args.audio_turn_seconds) as uri:
+            asyncio.run(_main(args, uri))
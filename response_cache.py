@@ -0,0 +1,234 @@
+# response_cache.py
+
+"""
+Local cache of model answers to repeated text prompts.
+
+A kiosk in text mode (`audio_loop.py --mode text` with a TEXT response modality) gets
+the same handful of questions all day, and each one is a full model round-trip.
+With `--response-cache`, `AudioLoop` answers a prompt it has seen before from
+`ResponseCache` without sending it to the session:
+
+    cache = ResponseCache(path="logs/response_cache.json")
+    key = cache_key(text, model, config)       # normalized prompt + model + config
+    deltas = cache.get(key)                    # the text deltas of the earlier answer, or None
+    if deltas is None:
+        ...                                    # send the prompt; collect the answer's deltas
+        cache.put(key, deltas)
+
+Prompts are normalized before hashing (Unicode NFKC, case, runs of whitespace,
+trailing punctuation), so "What's the Wi-Fi password?" and "what's the wi-fi
+password" share an entry. The key also covers the model and the whole session
+config, system instruction included, so changing either starts afresh.
+
+Entries are kept in LRU order, expire `ttl` seconds after they were stored, and
+the least recently used ones are evicted beyond `max_entries` or `max_bytes` of
+text. With `path`, the cache is loaded from that JSON file on start and written
+back by `save()` (and at exit).
+
+A cached answer ignores the conversation so far: the same prompt gets the same
+answer whatever was said before it. That is the point for a kiosk, and why the
+cache is opt-in. Lookups are counted in `audioloop_response_cache_lookups_total{outcome}`.
+
+`python response_cache.py` replays a simulated kiosk day against the cache.
+"""
+
+import atexit
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 256
+MAX_BYTES = 1000 * 1000
+TTL = 24 * 3600.0
+
+_SPACE = re.compile(r"\s+")
+_TRAILING = re.compile(r"[\s.!?;:,]+$")
+
+CACHE_LOOKUPS = metrics.REGISTRY.counter(
+    "audioloop_response_cache_lookups_total", "Response cache lookups by outcome (hit, miss or expired).",
+    ["outcome"],
+)
+CACHE_BYTES = metrics.REGISTRY.gauge(
+    "audioloop_response_cache_bytes", "UTF-8 bytes of cached response text."
+)
+
+
+def normalize(prompt):
+    """`prompt` with Unicode compatibility forms, case, whitespace runs and trailing punctuation folded."""
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    return _TRAILING.sub("", _SPACE.sub(" ", text).strip())
+
+
+def cache_key(prompt, model=None, config=None):
+    """Key of `prompt` for a session on `model` with `config` (a JSON-like dict, system instruction included)."""
+    scope = json.dumps({"model": model, "config": config}, sort_keys=True, default=str)
+    return hashlib.sha256(f"{scope}\0{normalize(prompt)}".encode("utf-8")).hexdigest()
+
+
+def _size(deltas):
+    return sum(len(delta.encode("utf-8")) for delta in deltas)
+
+
+class ResponseCache:
+    """
+    An LRU of answers with a TTL and a byte cap, optionally persisted to a JSON file.
+
+    Not thread-safe: use it from the event loop.
+
+    Args:
+        max_entries (int): Answers kept at most.
+        max_bytes (int): UTF-8 bytes of answer text kept at most.
+        ttl (float): Seconds an answer stays valid after it was stored.
+        path (str, optional): JSON file the cache is loaded from and saved to.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, ttl=TTL, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        # key -> (stored_at, deltas); wall-clock times, so the TTL holds across restarts
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._dirty = False
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, key):
+        """The text deltas stored under `key`, or None if there are none or they expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        stored_at, deltas = entry
+        if time.time() - stored_at > self.ttl:
+            self._remove(key)
+            CACHE_LOOKUPS.labels("expired").inc()
+            return None
+        self._entries.move_to_end(key)
+        CACHE_LOOKUPS.labels("hit").inc()
+        return deltas
+
+    def put(self, key, deltas):
+        """Store an answer as the text deltas it arrived in; answers over `max_bytes` are not kept."""
+        deltas = tuple(deltas)
+        size = _size(deltas)
+        if not deltas or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time(), deltas)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        self._dirty = True
+        CACHE_BYTES.set(self._bytes)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._dirty = True
+        CACHE_BYTES.set(0)
+        return {"entries": 0}
+
+    def save(self):
+        """Write the cache to `path` (atomically) if it changed since it was loaded or saved."""
+        if not self.path or not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "entries": [[key, stored_at, list(deltas)]
+                                                 for key, (stored_at, deltas) in self._entries.items()]}, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+        logger.debug(f"Saved {len(self._entries)} cached responses to {self.path}")
+
+    def _remove(self, key):
+        _, deltas = self._entries.pop(key)
+        self._bytes -= _size(deltas)
+        self._dirty = True
+        CACHE_BYTES.set(self._bytes)
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable response cache {self.path}: {e}")
+            return
+        now = time.time()
+        for key, stored_at, deltas in data.get("entries", []):
+            if now - stored_at <= self.ttl:
+                self._entries[key] = (stored_at, tuple(deltas))
+                self._bytes += _size(deltas)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        self._dirty = False
+        CACHE_BYTES.set(self._bytes)
+        logger.info(f"Loaded {len(self._entries)} cached responses from {self.path}")
+
+
+def _bench(prompts=5000, questions=40, seed=1):
+    """Hit rate and lookup cost for kiosk traffic: Zipf-distributed questions, typed with variations."""
+    import random
+
+    rng = random.Random(seed)
+    base = [f"Where is the {topic} desk on floor {i % 5}?" for i, topic in
+            enumerate(["help", "ticket", "lost property", "information", "exchange", "print", "tax", "parking"] * 5)]
+    base = base[:questions]
+    weights = [1 / (rank + 1) for rank in range(len(base))]
+    answer = tuple(f"word{i} " for i in range(60))
+    config = {"generation_config": {"response_modalities": ["TEXT"]}}
+
+    def typed(question):
+        text = question if rng.random() < 0.5 else question.lower()
+        text = text.rstrip("?") if rng.random() < 0.3 else text
+        return "  " + text.replace(" ", "  ", 1) if rng.random() < 0.2 else text
+
+    cache = ResponseCache(max_entries=MAX_ENTRIES)
+    hits = 0
+    start = time.perf_counter()
+    for _ in range(prompts):
+        key = cache_key(typed(rng.choices(base, weights)[0]), "models/gemini-2.0-flash-exp", config)
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.put(key, answer)
+    elapsed = time.perf_counter() - start
+
+    exact = set()
+    exact_hits = 0
+    rng.seed(seed)
+    for _ in range(prompts):
+        text = typed(rng.choices(base, weights)[0])
+        exact_hits += text in exact
+        exact.add(text)
+
+    print(f"{prompts} prompts over {len(base)} questions (Zipf), typed with case/space/punctuation variations")
+    print(f"hit rate {hits / prompts:.1%} (exact-text matching would give {exact_hits / prompts:.1%})")
+    print(f"lookup + store: {elapsed / prompts * 1e6:.1f} us per prompt, {len(cache)} entries, "
+          f"{cache.nbytes / 1000:.1f} KB")
+
+
+if __name__ == "__main__":
+    _bench()
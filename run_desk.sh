@@ -1,5 +1,9 @@
 #!/bin/bash
 
+# Desktop launcher: one desk session plus the overlay, restarted if either dies.
+# For headless server deployments use `python supervisor.py` instead, which runs
+# sessions in worker processes and restarts crashed workers without dropping the others.
+
 # Activate virtual environment
 source venv/bin/activate
 
@@ -8,8 +12,10 @@ echo -n > message_queue.txt
 
 echo "Starting desk app loop..."
 
-# Start the Python script with stdin redirected to /dev/null to prevent tty input
-python3 live_api_starter_desk.py --mode screen < /dev/null &
+# Start the desk app through the fork server, with stdin redirected to /dev/null to prevent
+# tty input. The fork server imports genai/PIL/numpy once and restarts the app with a warm
+# fork() whenever it exits; `kill -HUP $PYTHON_PID` restarts it on demand.
+python3 forkserver.py live_api_starter_desk --mode screen < /dev/null &
 PYTHON_PID=$!
 
 # Start the overlay application
@@ -44,10 +50,10 @@ while true; do
     # Process any pending messages
     process_messages
     
-    # Check if Python script is still running
+    # The fork server restarts the app itself; only restart the fork server if it died
     if ! kill -0 $PYTHON_PID 2>/dev/null; then
-        echo "Python script stopped, restarting..."
-        python3 live_api_starter_desk.py --mode screen < /dev/null &
+        echo "Fork server stopped, restarting..."
+        python3 forkserver.py live_api_starter_desk --mode screen < /dev/null &
         PYTHON_PID=$!
     fi
     
@@ -0,0 +1,325 @@
+# screen_capture.py
+
+"""
+Configurable screen capture targets, with parallel capture of several monitors.
+
+The screen paths used to grab `sct.monitors[0]`, the bounding box of all monitors.
+On a three-monitor desk that is a capture of 7680x1440 pixels or more every second,
+downscaled to a 1024px strip in which nothing is legible. `ScreenCapture` grabs a
+chosen target instead (`--capture-target`):
+
+    all            the bounding box of all monitors (the old behaviour, the default)
+    N              monitor N as mss numbers them (1 is the first monitor)
+    monitors       every monitor as its own image
+    L,T,W,H        a rectangle on the virtual desktop: left, top, width, height
+    window:ID      a window by handle (decimal or 0x hex), followed as it moves (Windows)
+    window:active  whichever window has focus at each capture (Windows)
+
+With `monitors`, the monitors are grabbed and encoded in parallel in a thread pool
+(mss, numpy and PIL's encoders release the GIL). Every mss call runs on the
+capture's own pool threads (one thread for the other targets), since mss handles
+belong to the thread that opened them; `close()` closes each on its thread. A monitor whose pixels have not
+changed since its last image is neither re-encoded nor resent until `REFRESH_SECONDS`
+have passed. That goes for single targets too, except for a frame that was asked for
+(`force=True`, e.g. `VideoGate.forced` after a /frame request or at a turn start).
+
+    capture = ScreenCapture("monitors", max_frame_bytes)
+    frames = capture.frames(governor.video_settings())    # blocking; run it in a thread
+    for frame in frames:                                  # one {"mime_type", "data"} per changed region
+        queue(frame)
+
+With `focus=True` the single region goes through `screen_focus.FocusCapture` (an
+overview plus a sharp crop around the cursor).
+
+`python screen_capture.py` benchmarks the targets on synthetic monitors.
+"""
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import zlib
+
+import frame_encoder
+import metrics
+import screen_focus
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGET = "all"
+# Pool threads at most for `monitors` without `workers`; threads start as regions need them
+MAX_WORKERS = 8
+# Seconds `close()` waits for the pool threads to close their mss handles
+CLOSE_TIMEOUT = 5.0
+# An unchanged region is sent again after this many seconds
+REFRESH_SECONDS = screen_focus.REFRESH_SECONDS
+
+SCREEN_REGIONS = metrics.REGISTRY.counter(
+    "audioloop_screen_regions_total", "Captured screen regions per outcome (sent or unchanged).", ["outcome"]
+)
+
+
+def parse_target(spec):
+    """
+    Parse a `--capture-target` value into ("all" | "monitor" | "monitors" | "rect" | "window", argument).
+
+    Raises ValueError for a malformed target.
+    """
+    spec = (spec or DEFAULT_TARGET).strip().lower()
+    if spec in ("all", "monitors"):
+        return spec, None
+    if spec.isdigit():
+        return "monitor", int(spec)
+    if spec.startswith("window:"):
+        handle = spec[len("window:"):]
+        if handle == "active":
+            return "window", None
+        try:
+            return "window", int(handle, 0)
+        except ValueError:
+            raise ValueError(f"Bad window handle {handle!r} in capture target {spec!r}") from None
+    parts = spec.split(",")
+    if len(parts) == 4:
+        try:
+            left, top, width, height = (int(part) for part in parts)
+        except ValueError:
+            raise ValueError(f"Bad rectangle in capture target {spec!r}") from None
+        if width > 0 and height > 0:
+            return "rect", {"left": left, "top": top, "width": width, "height": height}
+    raise ValueError(f"Unknown capture target {spec!r}; expected all, monitors, N, L,T,W,H or window:ID")
+
+
+def _clip(region, bounds):
+    """`region` clipped to `bounds` (both mss monitor dicts), or None if nothing is left."""
+    left = max(region["left"], bounds["left"])
+    top = max(region["top"], bounds["top"])
+    right = min(region["left"] + region["width"], bounds["left"] + bounds["width"])
+    bottom = min(region["top"] + region["height"], bounds["top"] + bounds["height"])
+    if right <= left or bottom <= top:
+        return None
+    return {"left": left, "top": top, "width": right - left, "height": bottom - top}
+
+
+class _Stream:
+    """Downscaling buffer, encoder and change tracking for one captured region."""
+
+    def __init__(self, max_frame_bytes):
+        self.buffer = frame_encoder.FrameBuffer()
+        self.encoder = frame_encoder.ScreenEncoder(max_frame_bytes)
+        self.size = None
+        self.digest = None
+        self.sent_at = None
+
+
+class ScreenCapture:
+    """
+    Grabs a capture target and encodes each of its regions.
+
+    Args:
+        target (str): Capture target (see the module docstring).
+        max_frame_bytes (int, optional): Largest encoded image in bytes, per region.
+        focus (bool): Send an overview plus a crop around the cursor (single-region targets only).
+        workers (int, optional): Threads for multi-region targets; 1 captures them one after another.
+            Defaults to one per region, up to `MAX_WORKERS`.
+
+    Call `close()` when done, to release the mss handles.
+    """
+
+    def __init__(self, target=DEFAULT_TARGET, max_frame_bytes=None, focus=False, workers=None):
+        self.kind, self.argument = parse_target(target)
+        if focus and self.kind == "monitors":
+            raise ValueError("Screen focus needs a single-region capture target, not 'monitors'")
+        self.max_frame_bytes = max_frame_bytes
+        self.workers = workers
+        self.focus = screen_focus.FocusCapture(max_frame_bytes) if focus else None
+        self._streams = {}
+        self._local = threading.local()
+        self._pool = None
+        self._pool_size = workers or (MAX_WORKERS if self.kind == "monitors" else 1)
+        self._missing = False
+
+    def regions(self, monitors):
+        """The regions (mss monitor dicts) to grab now, given mss's `monitors` list."""
+        if self.kind == "all":
+            return [monitors[0]]
+        if self.kind == "monitors":
+            return monitors[1:] or [monitors[0]]
+        if self.kind == "monitor":
+            if not 0 <= self.argument < len(monitors):
+                raise ValueError(f"Monitor {self.argument} does not exist; there are {len(monitors) - 1}")
+            return [monitors[self.argument]]
+        if self.kind == "rect":
+            region = _clip(self.argument, monitors[0])
+            return [region] if region else []
+        rect = screen_focus.focused_window() if self.argument is None else screen_focus.window_rect(self.argument)
+        region = rect and _clip({"left": rect[0], "top": rect[1], "width": rect[2] - rect[0],
+                                 "height": rect[3] - rect[1]}, monitors[0])
+        if not region:
+            if not self._missing:
+                logger.warning(f"Capture window {self.argument or 'active'} not found or off screen")
+            self._missing = True
+            return []
+        self._missing = False
+        return [region]
+
+    def frames(self, settings, force=False):
+        """
+        Grab and encode the target with `settings` (`bandwidth.VideoSettings`); returns the frames to send.
+
+        `force` sends every region, changed or not.
+        """
+        pool = self._executor()
+        regions = self.regions(pool.submit(lambda: self._mss().monitors).result())
+        if self.focus is not None:
+            if not regions:
+                return []
+            raw, size = pool.submit(self._grab, regions[0]).result()
+            encode_start = time.perf_counter()
+            frames = self.focus.frames_from_bgra(raw, size, (regions[0]["left"], regions[0]["top"]), settings, force)
+            metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+            return frames
+        # A monitor that went away takes its buffers with it
+        for index in [index for index in self._streams if index >= len(regions)]:
+            del self._streams[index]
+        results = pool.map(self._capture, range(len(regions)), regions, [settings] * len(regions),
+                           [force] * len(regions))
+        return [frame for frame in results if frame is not None]
+
+    def close(self):
+        """Close the mss handles, each on the pool thread that opened it, and stop the pool."""
+        if self._pool is None:
+            return
+        # One task per pool thread: none returns until all have started, so each runs on its own thread
+        barrier = threading.Barrier(self._pool_size, timeout=CLOSE_TIMEOUT)
+        for future in [self._pool.submit(self._close_local, barrier) for _ in range(self._pool_size)]:
+            future.result()
+        self._pool.shutdown(wait=True)
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self._pool_size, thread_name_prefix="screen")
+        return self._pool
+
+    def _close_local(self, barrier):
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            logger.warning("Timed out closing screen capture handles; some may stay open")
+        sct = getattr(self._local, "sct", None)
+        if sct is not None:
+            sct.close()
+            self._local.sct = None
+
+    def _mss(self):
+        # mss handles belong to the thread that created them; only pool threads call this
+        sct = getattr(self._local, "sct", None)
+        if sct is None:
+            import mss
+
+            sct = self._local.sct = mss.mss()
+        return sct
+
+    def _grab(self, region):
+        with metrics.STAGE_SECONDS.labels("capture_video").time():
+            shot = self._mss().grab(region)
+        return shot.raw, shot.size
+
+    def _capture(self, index, region, settings, force=False):
+        """Grab, and if it changed (or `force`) encode, one region; returns its frame or None."""
+        raw, size = self._grab(region)
+        return self._encode(index, raw, size, settings, force)
+
+    def _encode(self, index, raw, size, settings, force=False):
+        # One stream per region, whatever its size: the buffer reallocates when a window is resized
+        stream = self._streams.get(index)
+        if stream is None:
+            stream = self._streams[index] = _Stream(self.max_frame_bytes)
+        if size != stream.size:
+            # The first frame at a new size is always sent
+            stream.size, stream.digest, stream.sent_at = size, None, None
+        now = time.monotonic()
+        digest = zlib.crc32(raw)
+        if not force and digest == stream.digest and now - stream.sent_at < REFRESH_SECONDS:
+            SCREEN_REGIONS.labels("unchanged").inc()
+            return None
+        encode_start = time.perf_counter()
+        image = stream.buffer.from_bgra(raw, size, settings.max_size)
+        data = stream.encoder.encode(image, settings.max_size, settings.quality)
+        metrics.STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_start)
+        stream.digest = digest
+        stream.sent_at = now
+        SCREEN_REGIONS.labels("sent").inc()
+        return {"mime_type": stream.encoder.mime_type, "data": data}
+
+
+class _SyntheticCapture(ScreenCapture):
+    """`ScreenCapture` over in-memory BGRA monitors, for the benchmark."""
+
+    def __init__(self, screens, target, **kwargs):
+        super().__init__(target, **kwargs)
+        self.screens = screens
+
+    def _mss(self):
+        class Monitors:
+            monitors = self._monitors()
+        return Monitors
+
+    def _monitors(self):
+        left, monitors = 0, []
+        for raw, (width, height) in self.screens:
+            monitors.append({"left": left, "top": 0, "width": width, "height": height})
+            left += width
+        bounds = {"left": 0, "top": 0, "width": left, "height": max(m["height"] for m in monitors)}
+        return [bounds] + monitors
+
+    def _grab(self, region):
+        import numpy as np
+
+        # Slices of the side-by-side desktop, copied like a real grab
+        desktop = getattr(self, "_desktop", None)
+        if desktop is None:
+            desktop = self._desktop = np.concatenate(
+                [np.frombuffer(raw, np.uint8).reshape(size[1], size[0], 4) for raw, size in self.screens], axis=1)
+        pixels = desktop[region["top"]:region["top"] + region["height"], region["left"]:region["left"] + region["width"]]
+        return bytearray(pixels.tobytes()), (region["width"], region["height"])
+
+
+def _bench(captures=10):
+    import bandwidth
+
+    settings = bandwidth.LADDER[0]
+    size = (2560, 1440)
+    kinds = ("screen", "mixed", "screen")
+    screens = [[img.convert("RGBX").tobytes("raw", "BGRX") for img in frame_encoder._synthetic_frames(kind, 2, size)]
+               for kind in kinds]
+
+    def run(target, changing, workers):
+        """Seconds per capture and KB sent per capture; monitors in `changing` alternate between two frames."""
+        seconds = nbytes = 0
+        capture = None
+        for i in range(captures + 1):
+            current = [(frames[i % 2 if m in changing else 0], size) for m, frames in enumerate(screens)]
+            if capture is None:
+                capture = _SyntheticCapture(current, target, workers=workers)
+            capture.screens, capture._desktop = current, None
+            start = time.perf_counter()
+            frames = capture.frames(settings)
+            if i:
+                seconds += time.perf_counter() - start
+                nbytes += sum(len(frame["data"]) for frame in frames)
+        capture.close()
+        return seconds / captures, nbytes / captures
+
+    print(f"3 monitors of {size[0]}x{size[1]}, {captures} captures each, {os.cpu_count()} CPUs")
+    print(f"{'target':10} {'workers':>8} {'changing':>9} {'ms/capture':>11} {'KB/capture':>11}")
+    cases = (("all", 1, (0, 1, 2)), ("2", 1, (1,)), ("monitors", 1, (0, 1, 2)), ("monitors", 3, (0, 1, 2)),
+             ("monitors", 3, (1,)))
+    for target, workers, changing in cases:
+        ms, nbytes = run(target, changing, workers)
+        print(f"{target:10} {workers:8} {len(changing):9} {ms * 1000:11.1f} {nbytes / 1000:11.1f}")
+
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,352 @@
+# screen_focus.py
+
+"""
+Focus-aware screen capture: a low-resolution overview plus a sharp crop where the user works.
+
+Shrinking a whole desktop (often several monitors side by side) to 1024px makes the
+text the user is reading unreadable. Raising the resolution of the whole screen would
+multiply the upload. `FocusCapture` sends two images per capture instead:
+
+    overview   the whole capture at half the governor's size (512px at full quality);
+    crop       a `crop_size` square (512 capture pixels) at full resolution, around
+               the point of interest.
+
+The point of interest is, in order of preference:
+
+    1. the mouse cursor;
+    2. the centre of the focused window;
+    3. the centre of the area that changed since the last overview.
+
+The cursor and focused-window lookups are Windows only (Win32 API). On other
+platforms the crop always follows screen changes.
+
+The crop is tracked across frames. It only moves when the point of interest leaves
+its central area (`RECENTER_MARGIN`), so small cursor movements do not shift the
+picture. The crop is skipped when its pixels have not changed since it was last
+sent. The overview is skipped while every change since it was last sent lies inside
+the crop, which already shows it. Both are resent after `REFRESH_SECONDS` regardless,
+and whenever the caller passes `force=True` (a requested frame). Each part has its own `ScreenEncoder`, so a crop
+of text is sent as sharp PNG while the overview can be a photo-like JPEG.
+
+The two images go out as separate media chunks, so each one labels itself: a
+`CAPTION_HEIGHT` band across its top reads "OVERVIEW (red box: DETAIL)" or
+"DETAIL x <left>-<right>, y <top>-<bottom>" (capture pixels), and the crop box
+is outlined in red on the overview.
+
+    focus = FocusCapture(max_frame_bytes)
+    for frame in focus.frames_from_bgra(shot.raw, shot.size, (monitor["left"], monitor["top"]), settings):
+        queue(frame)                          # 0, 1 or 2 {"mime_type", "data"} dicts
+
+`frames_from_image` does the same for a PIL image (PIL.ImageGrab captures).
+"""
+
+import logging
+import sys
+import time
+import zlib
+
+import frame_encoder
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Side of the crop in capture pixels; it is sent at this resolution
+CROP_SIZE = 512
+# The crop moves only when the point of interest comes within this share of its edge
+RECENTER_MARGIN = 0.2
+# An unchanged part is sent again after this many seconds
+REFRESH_SECONDS = 10.0
+# Summed RGB change of an overview pixel that counts as a screen change
+CHANGE_LEVEL = 48
+# Caption band drawn above each image, in pixels
+CAPTION_HEIGHT = 14
+CAPTION_COLORS = ((32, 32, 32), (255, 255, 255))
+OUTLINE_COLOR = (255, 0, 0)
+
+FOCUS_PARTS = metrics.REGISTRY.counter(
+    "audioloop_screen_focus_parts_total", "Overview and crop images per outcome (sent or unchanged).",
+    ["part", "outcome"],
+)
+
+
+def cursor_position():
+    """The mouse cursor in virtual-desktop coordinates, or None where it cannot be read (always, off Windows)."""
+    if sys.platform != "win32":
+        return None
+    import ctypes
+    import ctypes.wintypes
+
+    point = ctypes.wintypes.POINT()
+    if not ctypes.windll.user32.GetCursorPos(ctypes.byref(point)):
+        return None
+    return point.x, point.y
+
+
+def window_rect(hwnd):
+    """(left, top, right, bottom) of window `hwnd` in virtual-desktop coordinates, or None (always, off Windows)."""
+    if sys.platform != "win32" or not hwnd:
+        return None
+    import ctypes
+    import ctypes.wintypes
+
+    rect = ctypes.wintypes.RECT()
+    if not ctypes.windll.user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+        return None
+    return rect.left, rect.top, rect.right, rect.bottom
+
+
+def focused_window():
+    """(left, top, right, bottom) of the foreground window in virtual-desktop coordinates, or None (always, off Windows)."""
+    if sys.platform != "win32":
+        return None
+    import ctypes
+
+    return window_rect(ctypes.windll.user32.GetForegroundWindow())
+
+
+class _Part:
+    """Encoder and refresh tracking for one of the two images."""
+
+    def __init__(self, name, max_frame_bytes):
+        self.name = name
+        self.encoder = frame_encoder.ScreenEncoder(max_frame_bytes)
+        self.digest = None
+        self.sent_at = None
+
+    def stale(self, now):
+        return self.sent_at is None or now - self.sent_at >= REFRESH_SECONDS
+
+    def frame(self, img, max_size, quality, now, caption, outline=None):
+        self.sent_at = now
+        FOCUS_PARTS.labels(self.name, "sent").inc()
+        img = _labeled(img, max_size, caption, outline)
+        # The caption band adds to max_size; the image is not shrunk again for it
+        data = self.encoder.encode(img, max(img.size), quality)
+        return {"mime_type": self.encoder.mime_type, "data": data}
+
+    def skip(self):
+        FOCUS_PARTS.labels(self.name, "unchanged").inc()
+        return None
+
+
+def _labeled(img, max_size, caption, outline=None):
+    """A new image: `img` within `max_size` px under a caption band, with `outline` (box in `img` pixels) drawn."""
+    import PIL.Image
+    import PIL.ImageDraw
+    import PIL.ImageFont
+
+    if max(img.size) > max_size:
+        scale = max_size / max(img.size)
+        outline = outline and tuple(round(v * scale) for v in outline)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), reducing_gap=2.0)
+    canvas = PIL.Image.new("RGB", (img.width, img.height + CAPTION_HEIGHT), CAPTION_COLORS[0])
+    canvas.paste(img, (0, CAPTION_HEIGHT))
+    draw = PIL.ImageDraw.Draw(canvas)
+    draw.text((2, 1), caption, fill=CAPTION_COLORS[1], font=PIL.ImageFont.load_default(size=CAPTION_HEIGHT - 3))
+    if outline:
+        left, top, right, bottom = outline
+        draw.rectangle((left, top + CAPTION_HEIGHT, right - 1, bottom - 1 + CAPTION_HEIGHT), outline=OUTLINE_COLOR,
+                       width=2)
+    return canvas
+
+
+def _inside(inner, outer):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+class FocusCapture:
+    """
+    Turns screen captures into an overview and a crop around the point of interest.
+
+    Args:
+        max_frame_bytes (int, optional): Largest encoded image in bytes, per part.
+        crop_size (int): Side of the crop in capture pixels.
+    """
+
+    def __init__(self, max_frame_bytes=None, crop_size=CROP_SIZE):
+        self.crop_size = crop_size
+        self.box = None
+        self._overview = _Part("overview", max_frame_bytes)
+        self._crop = _Part("crop", max_frame_bytes)
+        self._overview_buffer = frame_encoder.FrameBuffer()
+        self._crop_buffer = frame_encoder.FrameBuffer()
+        self._previous = None
+        # Area (capture pixels) that changed since the overview was last sent
+        self._unsent = None
+
+    def frames_from_bgra(self, raw, size, origin, settings, force=False):
+        """
+        Frames for a BGRA capture (mss's `ScreenShot.raw`) of `size` whose top-left corner
+        is at `origin` on the virtual desktop, sized by `settings` (`bandwidth.VideoSettings`).
+        `force` sends both parts, changed or not.
+        """
+        overview_size = max(1, settings.max_size // 2)
+        overview = self._overview_buffer.from_bgra(raw, size, overview_size)
+        changed = self._changes(overview, size)
+        box = self._track(changed, size, origin)
+        crop = self._crop_buffer.from_bgra(raw, size, min(self.crop_size, settings.max_size), box=box)
+        return self._frames(overview, overview_size, changed, crop, box, size, settings, force)
+
+    def frames_from_image(self, img, origin, settings, force=False):
+        """Frames for a PIL image of the screen whose top-left corner is at `origin`."""
+        overview_size = max(1, settings.max_size // 2)
+        overview = img.copy()
+        overview.thumbnail((overview_size, overview_size))
+        changed = self._changes(overview, img.size)
+        box = self._track(changed, img.size, origin)
+        crop = img.crop(box)
+        crop.thumbnail((min(self.crop_size, settings.max_size),) * 2)
+        return self._frames(overview, overview_size, changed, crop, box, img.size, settings, force)
+
+    def _frames(self, overview, overview_size, changed, crop, box, size, settings, force=False):
+        now = time.monotonic()
+        frames = []
+        # The overview only needs resending for changes the crop does not show
+        if changed is not None:
+            self._unsent = _union(self._unsent, changed)
+        if force or self._overview.stale(now) or (self._unsent is not None and not _inside(self._unsent, box)):
+            # The crop box in overview pixels
+            scale = overview.width / size[0]
+            caption = "OVERVIEW (red box: DETAIL)"
+            frames.append(self._overview.frame(overview, overview_size, settings.quality, now, caption,
+                                               tuple(int(v * scale) for v in box)))
+            self._unsent = None
+        else:
+            self._overview.skip()
+        digest = (box, zlib.crc32(crop.tobytes()))
+        if force or digest != self._crop.digest or self._crop.stale(now):
+            self._crop.digest = digest
+            caption = f"DETAIL x {box[0]}-{box[2]}, y {box[1]}-{box[3]}"
+            frames.append(self._crop.frame(crop, min(self.crop_size, settings.max_size), settings.quality, now,
+                                           caption))
+        else:
+            self._crop.skip()
+        return frames
+
+    def _track(self, changed, size, origin):
+        """Update and return the crop box (capture pixels) for this capture."""
+        width, height = size
+        side_x, side_y = min(self.crop_size, width), min(self.crop_size, height)
+        point = self._point_of_interest(changed, size, origin)
+        if point is not None:
+            x, y = point
+            box = self.box
+            inside = box is not None and (
+                box[0] + RECENTER_MARGIN * side_x <= x <= box[2] - RECENTER_MARGIN * side_x
+                and box[1] + RECENTER_MARGIN * side_y <= y <= box[3] - RECENTER_MARGIN * side_y
+            )
+            if not inside:
+                left = min(max(0, x - side_x // 2), width - side_x)
+                top = min(max(0, y - side_y // 2), height - side_y)
+                self.box = (left, top, left + side_x, top + side_y)
+                logger.debug(f"Screen focus crop moved to {self.box}")
+        if self.box is None or self.box[2] > width or self.box[3] > height:
+            # Nothing to follow yet: start at the centre
+            left, top = (width - side_x) // 2, (height - side_y) // 2
+            self.box = (left, top, left + side_x, top + side_y)
+        return self.box
+
+    def _point_of_interest(self, changed, size, origin):
+        """The point to centre the crop on, in capture pixels, or None to keep the crop where it is."""
+        width, height = size
+        cursor = cursor_position()
+        if cursor is not None:
+            x, y = cursor[0] - origin[0], cursor[1] - origin[1]
+            if 0 <= x < width and 0 <= y < height:
+                return x, y
+        window = focused_window()
+        if window is not None:
+            x = (max(window[0], origin[0]) + min(window[2], origin[0] + width)) // 2 - origin[0]
+            y = (max(window[1], origin[1]) + min(window[3], origin[1] + height)) // 2 - origin[1]
+            if 0 <= x < width and 0 <= y < height:
+                return x, y
+        if changed is not None:
+            return (changed[0] + changed[2]) // 2, (changed[1] + changed[3]) // 2
+        return None
+
+    def _changes(self, overview, size):
+        """Bounding box (capture pixels) of what changed since the previous capture, or None."""
+        import numpy as np
+
+        pixels = np.asarray(overview, dtype=np.int16)
+        previous, self._previous = self._previous, pixels
+        if previous is None or previous.shape != pixels.shape:
+            return None
+        changed = np.abs(pixels - previous).sum(axis=2) > CHANGE_LEVEL
+        rows = np.flatnonzero(changed.any(axis=1))
+        if not rows.size:
+            return None
+        cols = np.flatnonzero(changed.any(axis=0))
+        scale_x, scale_y = size[0] / pixels.shape[1], size[1] / pixels.shape[0]
+        # Widened by an overview pixel, which covers the box filter's reach
+        return (max(0, int((cols[0] - 1) * scale_x)), max(0, int((rows[0] - 1) * scale_y)),
+                min(size[0], int((cols[-1] + 2) * scale_x)), min(size[1], int((rows[-1] + 2) * scale_y)))
+
+
+def _bench(frames=20):
+    """Payload of FocusCapture vs one downscaled screenshot on a simulated dual-monitor desktop."""
+    import PIL.Image
+    import PIL.ImageDraw
+    import PIL.ImageFont
+
+    import bandwidth
+
+    settings = bandwidth.LADDER[0]
+    editors = frame_encoder._synthetic_frames("screen", frames)
+    width, height = editors[0].size
+    desktop = PIL.Image.new("RGB", (width * 2, height))
+    desktop.paste(frame_encoder._synthetic_frames("mixed", 1)[0], (width, 0))
+    font = PIL.ImageFont.load_default(size=15)
+
+    def reading():
+        desktop.paste(editors[0], (0, 0))
+        for _ in range(frames):
+            yield desktop
+
+    def typing():
+        # A word per frame typed into the editor on the first monitor
+        img = desktop.copy()
+        img.paste(editors[0], (0, 0))
+        draw = PIL.ImageDraw.Draw(img)
+        for i in range(frames):
+            draw.rectangle((300 + i * 40, 598, 340 + i * 40, 616), fill=(255, 255, 255))
+            draw.text((300 + i * 40, 600), "word", fill=(20, 20, 20), font=font)
+            yield img
+
+    def scrolling():
+        for editor in editors:
+            desktop.paste(editor, (0, 0))
+            yield desktop
+
+    def to_bgra(img):
+        return img.convert("RGBX").tobytes("raw", "BGRX")
+
+    print(f"{frames} frames of a {desktop.width}x{desktop.height} desktop (editor on the first monitor)")
+    print(f"{'scenario':10} {'capture':8} {'KB/frame':>9} {'images':>7} {'editor scale':>13}")
+    for scenario in (reading, typing, scrolling):
+        buffer, encoder = frame_encoder.FrameBuffer(), frame_encoder.ScreenEncoder()
+        total = 0
+        for img in scenario():
+            img = buffer.from_bgra(to_bgra(img), img.size, settings.max_size)
+            total += len(encoder.encode(img, settings.max_size, settings.quality))
+        scale = encoder.size[0] / desktop.width
+        print(f"{scenario.__name__:10} {'whole':8} {total / frames / 1000:9.1f} {frames:7} {scale:13.2f}")
+
+        focus = FocusCapture()
+        total = images = 0
+        for img in scenario():
+            sent = focus.frames_from_bgra(to_bgra(img), img.size, (0, 0), settings)
+            images += len(sent)
+            total += sum(len(frame["data"]) for frame in sent)
+        scale = focus._crop.encoder.size[0] / (focus.box[2] - focus.box[0])
+        print(f"{scenario.__name__:10} {'focus':8} {total / frames / 1000:9.1f} {images:7} {scale:13.2f}")
+
+
+if __name__ == "__main__":
+    _bench()
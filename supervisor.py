@@ -0,0 +1,413 @@
+# supervisor.py
+
+"""
+Multi-process session supervisor: one gateway worker process per core.
+
+A single gateway process hits the GIL long before the network limit: base64,
+JSON and JPEG work all run on one core. The supervisor spreads sessions over
+worker processes, each hosting a `gateway.Gateway`:
+
+    - one worker per core by default (`--workers`);
+    - every new session goes to the least-loaded worker. Load is the worker's
+      CPU use from its last heartbeat plus an estimate for sessions assigned
+      since then;
+    - workers send a heartbeat with their session count, CPU use and a metrics
+      snapshot every second. A worker that exits or misses heartbeats for
+      `--heartbeat-timeout` seconds is restarted (with backoff if it keeps
+      crashing). Its sessions are started again on the least-loaded workers,
+      and sessions on the other workers are not touched;
+    - the metrics endpoint (`--metrics-port`) serves the sum of all workers'
+      metrics. Counters from crashed workers are kept, so totals never go backwards.
+
+For server deployments this replaces the restart loop in `run_desk.sh`.
+
+Usage:
+    python supervisor.py --workers 4 --sessions 200 --uri ws://127.0.0.1:8765 --metrics-port 9100
+
+Control channel (with --metrics-port):
+    curl -X POST http://127.0.0.1:9100/control/workers        # per-worker status
+    curl -X POST http://127.0.0.1:9100/control/add_session    # start one more session
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from datetime import datetime
+from multiprocessing.connection import wait
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 1.0
+# CPU share of one core assumed per session until a worker reports real numbers
+DEFAULT_SESSION_COST = 0.005
+RESTART_BACKOFF = (0.5, 1, 2, 5, 10, 30)
+# A worker that lived this long before exiting is considered healthy again
+STABLE_AFTER = 30.0
+
+WORKER_RESTARTS = metrics.REGISTRY.counter(
+    "audioloop_supervisor_worker_restarts_total", "Worker processes restarted after a crash or hang.", ["reason"]
+)
+SESSIONS_REASSIGNED = metrics.REGISTRY.counter(
+    "audioloop_supervisor_sessions_reassigned_total", "Sessions restarted on another worker after a crash."
+)
+
+
+# ---- worker process ----------------------------------------------------------
+
+def worker_main(conn, worker_id, args):
+    """Entry point of a worker process: run a gateway and follow the supervisor's commands."""
+    os.makedirs("logs", exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - worker {worker_id} - %(levelname)s - %(message)s",
+        handlers=[logging.FileHandler(os.path.join("logs", f"worker_{worker_id}_{timestamp}.log"), encoding="utf-8")],
+        force=True,
+    )
+    try:
+        asyncio.run(_worker(conn, worker_id, args))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker(conn, worker_id, args):
+    import gateway
+    from loop_watchdog import LoopWatchdog
+
+    gw = gateway.gateway_from_args(args)
+    loop = asyncio.get_running_loop()
+    commands = asyncio.Queue()
+    send_lock = threading.Lock()
+
+    def send(message):
+        try:
+            with send_lock:
+                conn.send(message)
+        except OSError:
+            pass  # supervisor is gone; the command reader shuts the worker down
+
+    def read_commands():
+        # Connection.recv blocks, so it gets its own thread; EOF means the supervisor is gone
+        try:
+            while True:
+                loop.call_soon_threadsafe(commands.put_nowait, conn.recv())
+        except (EOFError, OSError):
+            loop.call_soon_threadsafe(commands.put_nowait, ("shutdown",))
+
+    gw.on_session_end = lambda session: send(("ended", session.session_id))
+    threading.Thread(target=read_commands, name="supervisor-commands", daemon=True).start()
+
+    async def heartbeat():
+        cpu_before, wall_before = time.process_time(), time.monotonic()
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            cpu, wall = time.process_time(), time.monotonic()
+            send(("heartbeat", {
+                "sessions": len(gw.sessions),
+                "cpu": (cpu - cpu_before) / (wall - wall_before),
+                "metrics": metrics.REGISTRY.snapshot(),
+            }))
+            cpu_before, wall_before = cpu, wall
+
+    tasks = [asyncio.create_task(heartbeat())]
+    if args.stall_threshold:
+        tasks.append(asyncio.create_task(LoopWatchdog(threshold=args.stall_threshold).run()))
+    logger.info(f"Worker {worker_id} ready (pid {os.getpid()})")
+    try:
+        while True:
+            command, *params = await commands.get()
+            if command == "start":
+                session_id, spec = params
+                try:
+                    gw.start_session(session_id, **gateway.session_sources(**spec))
+                except Exception as e:
+                    logger.error(f"Could not start session {session_id}: {e}")
+                    send(("ended", session_id))
+            elif command == "stop":
+                gw.stop_session(params[0])
+            elif command == "shutdown":
+                break
+    finally:
+        gw.on_session_end = None
+        await gw.stop_all()
+        for task in tasks:
+            task.cancel()
+        send(("heartbeat", {"sessions": 0, "cpu": 0.0, "metrics": metrics.REGISTRY.snapshot()}))
+        logger.info(f"Worker {worker_id} stopped")
+
+
+# ---- supervisor ----------------------------------------------------------------
+
+class WorkerHandle:
+    """Supervisor-side state of one worker process."""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.conn = None
+        self.sessions = set()
+        self.cpu = 0.0
+        self.assigned_since_heartbeat = 0
+        self.last_heartbeat = None
+        self.started_at = None
+        self.snapshot = {}
+        self.crashes = 0
+        self.restart_at = 0.0
+
+    def load(self):
+        """Estimated CPU share of one core this worker will use."""
+        reported = max(1, len(self.sessions) - self.assigned_since_heartbeat)
+        per_session = self.cpu / reported if self.cpu and self.sessions else DEFAULT_SESSION_COST
+        return self.cpu + self.assigned_since_heartbeat * per_session
+
+
+class _AggregatedRegistry:
+    """What the metrics endpoint serves: all workers' metrics plus the supervisor's own."""
+
+    def __init__(self, supervisor):
+        self._supervisor = supervisor
+
+    def snapshot(self):
+        return self._supervisor.aggregate().snapshot()
+
+    def render_prometheus(self):
+        return self._supervisor.aggregate().render_prometheus()
+
+
+class Supervisor:
+    """
+    Spawns worker processes and distributes sessions over them.
+
+    Args:
+        args (argparse.Namespace): Gateway options passed to every worker (see `gateway.add_gateway_arguments`).
+        workers (int): Number of worker processes.
+        heartbeat_timeout (float): Seconds without a heartbeat after which a worker is restarted.
+    """
+
+    def __init__(self, args, workers=None, heartbeat_timeout=10.0):
+        self.args = args
+        self.heartbeat_timeout = heartbeat_timeout
+        self.workers = [WorkerHandle(i) for i in range(workers or os.cpu_count() or 1)]
+        self.sessions = {}  # session_id -> (spec, worker_id)
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        # Metrics of crashed or stopped workers, so counters never go backwards
+        self._retired = metrics.MetricsRegistry()
+        # spawn: the supervisor has threads (metrics server), which fork does not carry over safely
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = False
+        metrics.register_command("workers", self.describe)
+        metrics.register_command("add_session", self.add_session)
+
+    # ---- sessions ------------------------------------------------------------
+
+    def add_session(self, spec=None, session_id=None):
+        """Start a session on the least-loaded worker; returns its id."""
+        with self._lock:
+            session_id = session_id or f"s{next(self._ids)}"
+            spec = spec or {"wav": self.args.wav, "frame": self.args.frame}
+            self._assign(session_id, spec)
+            return session_id
+
+    def remove_session(self, session_id):
+        with self._lock:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                self._send(self.workers[entry[1]], ("stop", session_id))
+
+    def _assign(self, session_id, spec):
+        alive = [w for w in self.workers if w.conn is not None]
+        worker = min(alive or self.workers, key=lambda w: (w.load(), len(w.sessions)))
+        self.sessions[session_id] = (spec, worker.worker_id)
+        worker.sessions.add(session_id)
+        worker.assigned_since_heartbeat += 1
+        if worker.conn is not None:
+            self._send(worker, ("start", session_id, spec))
+        # Otherwise the worker is restarting; its sessions are sent once it is back
+
+    # ---- workers -------------------------------------------------------------
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=worker_main, args=(child_conn, worker.worker_id, self.args),
+            name=f"gateway-worker-{worker.worker_id}", daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        worker.process = process
+        worker.conn = parent_conn
+        worker.started_at = worker.last_heartbeat = time.monotonic()
+        worker.cpu = 0.0
+        worker.assigned_since_heartbeat = len(worker.sessions)
+        logger.info(f"Worker {worker.worker_id} started (pid {process.pid})")
+        for session_id in sorted(worker.sessions):
+            self._send(worker, ("start", session_id, self.sessions[session_id][0]))
+
+    def _send(self, worker, message):
+        try:
+            worker.conn.send(message)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not reach worker {worker.worker_id}: {e}")
+
+    def _retire(self, worker, reason):
+        """Handle a dead or hung worker: keep its metrics, move its sessions, restart it."""
+        with self._lock:
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.process.join(timeout=5)
+            logger.log(logging.INFO if reason == "stopped" else logging.ERROR,
+                       f"Worker {worker.worker_id} {reason} (exit code {worker.process.exitcode}); "
+                       f"{len(worker.sessions)} sessions on it")
+            self._retired.merge(worker.snapshot, gauges=False)
+            worker.snapshot = {}
+            worker.conn.close()
+            worker.conn = None
+            orphans = [(sid, self.sessions[sid][0]) for sid in sorted(worker.sessions)]
+            worker.sessions.clear()
+            if self._stopping:
+                for session_id, _ in orphans:
+                    self.sessions.pop(session_id, None)
+                return
+            WORKER_RESTARTS.labels(reason).inc()
+            lived = time.monotonic() - worker.started_at
+            worker.crashes = 0 if lived > STABLE_AFTER else worker.crashes + 1
+            delay = RESTART_BACKOFF[min(worker.crashes, len(RESTART_BACKOFF)) - 1] if worker.crashes else 0
+            worker.restart_at = time.monotonic() + delay
+            for session_id, spec in orphans:
+                SESSIONS_REASSIGNED.inc()
+                self._assign(session_id, spec)
+
+    def poll(self, timeout=HEARTBEAT_INTERVAL):
+        """Handle worker messages and crashes for up to `timeout` seconds."""
+        with self._lock:
+            running = [w for w in self.workers if w.conn is not None]
+        ready = wait([w.conn for w in running] + [w.process.sentinel for w in running], timeout)
+        now = time.monotonic()
+        with self._lock:
+            for worker in running:
+                if worker.conn in ready:
+                    try:
+                        while worker.conn.poll():
+                            self._handle(worker, worker.conn.recv())
+                    except (EOFError, OSError):
+                        pass
+                if worker.process.sentinel in ready or not worker.process.is_alive():
+                    self._retire(worker, "exited")
+                elif now - worker.last_heartbeat > self.heartbeat_timeout:
+                    self._retire(worker, "hung")
+            for worker in self.workers:
+                if worker.conn is None and not self._stopping and now >= worker.restart_at:
+                    self._spawn(worker)
+
+    def _handle(self, worker, message):
+        kind, payload = message[0], message[1]
+        if kind == "heartbeat":
+            worker.last_heartbeat = time.monotonic()
+            worker.cpu = payload["cpu"]
+            worker.snapshot = payload["metrics"]
+            worker.assigned_since_heartbeat = 0
+        elif kind == "ended":
+            worker.sessions.discard(payload)
+            if self.sessions.get(payload, (None, None))[1] == worker.worker_id:
+                del self.sessions[payload]
+
+    def run_forever(self):
+        try:
+            while True:
+                self.poll()
+        except KeyboardInterrupt:
+            logger.info("Interrupted; stopping workers...")
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10.0):
+        """Ask every worker to finish its sessions and exit; kill the ones that do not."""
+        with self._lock:
+            self._stopping = True
+            for worker in self.workers:
+                if worker.conn is not None:
+                    self._send(worker, ("shutdown",))
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.conn is not None:
+                try:
+                    while worker.conn.poll():
+                        self._handle(worker, worker.conn.recv())
+                except (EOFError, OSError):
+                    pass
+                self._retire(worker, "stopped")
+
+    # ---- reporting -------------------------------------------------------------
+
+    def aggregate(self):
+        """A registry holding the sum of every worker's metrics and the supervisor's own."""
+        registry = metrics.MetricsRegistry()
+        with self._lock:
+            registry.merge(self._retired.snapshot())
+            for worker in self.workers:
+                registry.merge(worker.snapshot)
+        registry.merge(metrics.REGISTRY.snapshot())
+        return registry
+
+    def describe(self):
+        with self._lock:
+            return [
+                {
+                    "worker": w.worker_id,
+                    "pid": w.process.pid if w.conn is not None else None,
+                    "sessions": len(w.sessions),
+                    "cpu": round(w.cpu, 3),
+                    "crashes": w.crashes,
+                }
+                for w in self.workers
+            ]
+
+
+if __name__ == "__main__":
+    import gateway
+
+    parser = argparse.ArgumentParser(description="Spread headless AudioLoop sessions over worker processes.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per core)")
+    parser.add_argument("--sessions", type=int, default=10, help="sessions to start")
+    parser.add_argument("--heartbeat-timeout", type=float, default=10.0,
+                        help="restart a worker that sends no heartbeat for this many seconds")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve aggregated metrics and the control channel on http://127.0.0.1:PORT")
+    gateway.add_gateway_arguments(parser)
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    os.makedirs("logs", exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - supervisor - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(os.path.join("logs", f"supervisor_{datetime.now():%Y%m%d_%H%M%S}.log"),
+                                encoding="utf-8"),
+            logging.StreamHandler(),
+        ],
+    )
+    supervisor = Supervisor(args, workers=args.workers, heartbeat_timeout=args.heartbeat_timeout)
+    if args.metrics_port is not None:
+        metrics.start_http_server(args.metrics_port, registry=_AggregatedRegistry(supervisor))
+    supervisor.start()
+    for _ in range(args.sessions):
+        supervisor.add_session()
+    supervisor.run_forever()
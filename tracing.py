@@ -0,0 +1,299 @@
+# tracing.py
+
+"""
+Per-turn tracing for the AudioLoop variants.
+
+Every conversational turn gets a trace ID and a set of spans:
+
+    turn                 turn start (user speech or text) until the model's turn_complete
+    user_speech          the user's speech window detected on the microphone stream
+    upload               first to last send of user input before the model answered
+    first_server_byte    end of user input until the first server message of the turn
+    text_delta           one instant event per text chunk received
+    audio_playback       first to last audio chunk written to the speaker for the turn
+
+Spans carry monotonic timestamps and are appended to a trace file in the Chrome
+trace event format (JSON array), which opens directly in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing. Each turn is drawn on its own
+track. The file is append-only: events are written as soon as a span closes and
+the closing bracket is never written, which both viewers accept. No external
+collector is needed.
+
+Usage:
+    tracer = TurnTracer("logs/trace.json")
+    tracer.on_user_audio(pcm_chunk)
+    tracer.on_server_message()
+    tracer.on_turn_complete()
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Peak amplitude (int16) above which a PCM chunk counts as speech.
+SPEECH_THRESHOLD = 500
+# Silence after speech that still belongs to the same speech window.
+SPEECH_HANGOVER = 0.5
+
+
+def _now_us():
+    return time.monotonic_ns() // 1000
+
+
+def pcm_peak(data):
+    """Return the peak absolute amplitude of a 16-bit little-endian PCM chunk."""
+    if len(data) < 2:
+        return 0
+    samples = memoryview(data)[: len(data) & ~1].cast("h")
+    return max(max(samples), -min(samples))
+
+
+class SpeechWindow:
+    """
+    Tracks whether the user is speaking from the microphone PCM stream.
+
+    A chunk whose peak amplitude exceeds `threshold` is speech; the window stays
+    open until `hangover` seconds pass without speech.
+    """
+
+    def __init__(self, threshold=SPEECH_THRESHOLD, hangover=SPEECH_HANGOVER):
+        self.threshold = threshold
+        self.hangover = hangover
+        self.active = False
+        self.started_at = None
+        self.last_speech_at = None
+
+    def update(self, pcm, now=None):
+        """
+        Feed one chunk. Returns "start" when speech begins, "end" when the window
+        closes, and None otherwise.
+        """
+        now = time.monotonic() if now is None else now
+        if pcm_peak(pcm) >= self.threshold:
+            self.last_speech_at = now
+            if not self.active:
+                self.active = True
+                self.started_at = now
+                return "start"
+        elif self.active and now - self.last_speech_at > self.hangover:
+            self.active = False
+            return "end"
+        return None
+
+
+class TraceWriter:
+    """Appends Chrome trace events to a JSON array file."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        if new_file:
+            self._file.write("[\n")
+
+    def write(self, event):
+        line = json.dumps(event, separators=(",", ":")) + ",\n"
+        with self._lock:
+            self._file.write(line)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _Turn:
+    __slots__ = ("number", "trace_id", "start_us", "input_end_us", "upload_start_us",
+                 "upload_end_us", "upload_bytes", "first_byte_us", "playback_start_us",
+                 "playback_end_us", "text_chars", "completed")
+
+    def __init__(self, number, start_us):
+        self.number = number
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.start_us = start_us
+        self.input_end_us = None
+        self.upload_start_us = None
+        self.upload_end_us = None
+        self.upload_bytes = 0
+        self.first_byte_us = None
+        self.playback_start_us = None
+        self.playback_end_us = None
+        self.text_chars = 0
+        self.completed = False
+
+
+class TurnTracer:
+    """
+    Records the spans of each conversational turn into a trace file.
+
+    All hooks are cheap no-ops when `path` is None, so the AudioLoop variants can
+    call them unconditionally.
+    """
+
+    def __init__(self, path=None, speech_threshold=SPEECH_THRESHOLD, speech_hangover=SPEECH_HANGOVER):
+        self._writer = TraceWriter(path) if path else None
+        self._pid = os.getpid()
+        self._speech = SpeechWindow(speech_threshold, speech_hangover)
+        self._turn_count = 0
+        self.turn = None        # turn waiting for / receiving the model's answer
+        self._playing = None    # turn whose audio is being played back
+        if self._writer:
+            logger.info(f"Tracing turns to {path}")
+
+    @property
+    def enabled(self):
+        return self._writer is not None
+
+    @property
+    def trace_id(self):
+        """Trace ID of the current turn, or None."""
+        return self.turn.trace_id if self.turn else None
+
+    # ---- user input ---------------------------------------------------------
+
+    def on_user_audio(self, pcm):
+        """Feed every microphone chunk; opens a turn when speech starts."""
+        if self._writer is None:
+            return
+        edge = self._speech.update(pcm)
+        if edge == "start":
+            self._begin_turn(int(self._speech.started_at * 1e6))
+        elif edge == "end" and self.turn is not None:
+            start_us = int(self._speech.started_at * 1e6)
+            end_us = int(self._speech.last_speech_at * 1e6)
+            self.turn.input_end_us = end_us
+            self._span(self.turn, "user_speech", start_us, end_us)
+
+    def on_user_text(self, text):
+        """Call when a text message is sent; opens a turn."""
+        if self._writer is None:
+            return
+        now = _now_us()
+        turn = self._begin_turn(now)
+        turn.input_end_us = now
+        self._instant(turn, "user_text", now, {"chars": len(text)})
+
+    def on_upload(self, nbytes, start):
+        """Call after each send with the payload size and the `time.monotonic()` before sending."""
+        turn = self.turn
+        if turn is None or turn.first_byte_us is not None:
+            return
+        if turn.upload_start_us is None:
+            turn.upload_start_us = int(start * 1e6)
+        turn.upload_end_us = _now_us()
+        turn.upload_bytes += nbytes
+
+    # ---- model output -------------------------------------------------------
+
+    def on_server_message(self):
+        """Call for every message received from the model."""
+        turn = self.turn
+        if turn is None or turn.first_byte_us is not None:
+            return
+        now = _now_us()
+        turn.first_byte_us = now
+        if turn.upload_start_us is not None:
+            self._span(turn, "upload", turn.upload_start_us, turn.upload_end_us,
+                       {"bytes": turn.upload_bytes})
+        self._span(turn, "first_server_byte", turn.input_end_us or turn.start_us, now)
+
+    def on_text_delta(self, text):
+        turn = self.turn
+        if turn is None:
+            return
+        turn.text_chars += len(text)
+        self._instant(turn, "text_delta", _now_us(), {"chars": len(text)})
+
+    def on_playback(self, start, end):
+        """Call after each chunk is written to the speaker, with `time.monotonic()` stamps."""
+        turn = self.turn or self._playing
+        if turn is None:
+            return
+        if turn is not self._playing:
+            self._finish_playback()
+            self._playing = turn
+        if turn.playback_start_us is None:
+            turn.playback_start_us = int(start * 1e6)
+            self._instant(turn, "audio_playback_start", turn.playback_start_us)
+        turn.playback_end_us = int(end * 1e6)
+
+    def on_playback_idle(self):
+        """Call when the playback queue runs dry; ends the playback span of a completed turn."""
+        if self._playing is not None and self._playing.completed:
+            self._finish_playback()
+
+    def on_turn_complete(self):
+        turn = self.turn
+        if turn is None:
+            return
+        now = _now_us()
+        turn.completed = True
+        self._span(turn, "turn", turn.start_us, now,
+                   {"text_chars": turn.text_chars, "upload_bytes": turn.upload_bytes})
+        self.turn = None
+        if self._playing is not turn:
+            self._finish_playback()
+            self._playing = turn
+        self._writer.flush()
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._finish_playback()
+        if self.turn is not None:
+            self._span(self.turn, "turn", self.turn.start_us, _now_us(), {"incomplete": True})
+        self._writer.close()
+        self._writer = None
+
+    # ---- internals ----------------------------------------------------------
+
+    def _begin_turn(self, start_us):
+        if self.turn is None:
+            self._turn_count += 1
+            self.turn = _Turn(self._turn_count, start_us)
+            self._writer.write({
+                "name": "thread_name", "ph": "M", "pid": self._pid, "tid": self.turn.number,
+                "args": {"name": f"turn {self.turn.number} ({self.turn.trace_id})"},
+            })
+        return self.turn
+
+    def _finish_playback(self):
+        turn = self._playing
+        if turn is None or turn.playback_start_us is None:
+            return
+        self._span(turn, "audio_playback", turn.playback_start_us, turn.playback_end_us)
+        self._instant(turn, "audio_playback_end", turn.playback_end_us)
+        turn.playback_start_us = None
+        self._playing = None
+
+    def _span(self, turn, name, start_us, end_us, args=None):
+        if self._writer is None:
+            return
+        event_args = {"trace_id": turn.trace_id}
+        if args:
+            event_args.update(args)
+        self._writer.write({
+            "name": name, "ph": "X", "pid": self._pid, "tid": turn.number,
+            "ts": start_us, "dur": max(0, end_us - start_us), "args": event_args,
+        })
+
+    def _instant(self, turn, name, ts_us, args=None):
+        if self._writer is None:
+            return
+        event_args = {"trace_id": turn.trace_id}
+        if args:
+            event_args.update(args)
+        self._writer.write({
+            "name": name, "ph": "i", "s": "t", "pid": self._pid, "tid": turn.number,
+            "ts": ts_us, "args": event_args,
+        })
@@ -0,0 +1,171 @@
+# video_gate.py
+
+"""
+Speech-gated video: send frames while the user is talking, not for the whole session.
+
+The capture loops send a frame every second (or as often as the bandwidth governor
+allows) for as long as the session runs. That includes long silences in which the
+user says nothing and the model is idle. `VideoGate` ties the video lane to the
+microphone. It has two policies:
+
+    speech   frames flow while the user speaks and for `tail` seconds after;
+             one frame goes out at each turn start (speech or typed text) and
+             one on each explicit request;
+    fixed    the old behaviour: frames flow all the time.
+
+Request a frame by typing /frame at the message prompt. When the metrics server
+runs, `curl -X POST http://127.0.0.1:9464/control/frame` does the same.
+
+In a capture loop:
+
+    await gate.wait(settings.interval)           # returns at once while the gate is open
+    frame = capture(force=gate.forced)           # sent even if the screen is unchanged
+    queue(frame)                                 # straight away, so the frame is current
+    await gate.pause(governor.frame_delay(size)) # spacing before the next; a request ends it
+
+and from the audio and text loops:
+
+    gate.on_user_audio(pcm)
+    gate.on_user_text(text)
+
+Frames that the fixed policy would have sent while the gate was closed are counted
+in `audioloop_video_frames_saved_total`. `summary()` reports them per session.
+"""
+
+import asyncio
+import logging
+import time
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("speech", "fixed")
+DEFAULT_POLICY = "speech"
+# Seconds after the user stops speaking that frames keep flowing
+SPEECH_TAIL = 2.0
+# Typed at the message prompt to request a frame instead of sending text
+FRAME_COMMAND = "/frame"
+
+FRAMES_SAVED = metrics.REGISTRY.counter(
+    "audioloop_video_frames_saved_total",
+    "Frames the fixed one-per-interval policy would have sent while speech-gated video was closed.",
+)
+FRAME_REQUESTS = metrics.REGISTRY.counter(
+    "audioloop_video_frame_requests_total", "Frames requested explicitly or at a typed turn start."
+)
+
+
+class VideoGate:
+    """
+    Decides when the capture loops may take a frame.
+
+    Args:
+        policy (str): "speech" or "fixed" (see the module docstring).
+        tail (float): Seconds after speech that frames keep flowing.
+        speech_threshold (int): Peak PCM amplitude that counts as speech.
+    """
+
+    def __init__(self, policy=DEFAULT_POLICY, tail=SPEECH_TAIL, speech_threshold=tracing.SPEECH_THRESHOLD):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown video policy {policy!r}; expected one of {POLICIES}")
+        self.policy = policy
+        self._speech = tracing.SpeechWindow(speech_threshold, hangover=tail)
+        self._requests = 0
+        self._loop = None
+        self._wake = None
+        self.frames = 0
+        self.saved = 0.0
+        # Whether the last `wait` opened for a request or a turn start, whose frame must be sent
+        self.forced = False
+
+    @property
+    def is_open(self):
+        return self.policy == "fixed" or self._speech.active or self._requests > 0
+
+    @property
+    def requested(self):
+        """Whether a requested frame is waiting to be captured."""
+        return self._requests > 0
+
+    def on_user_audio(self, pcm):
+        """Feed every microphone chunk; speech opens the gate at once."""
+        if self.policy == "fixed":
+            return
+        edge = self._speech.update(pcm)
+        if edge == "start":
+            logger.debug("Speech started; sending video")
+            self._notify()
+        elif edge == "end":
+            logger.debug("Speech tail over; holding video")
+
+    def on_user_text(self, text):
+        """Call when a text turn is sent; it gets one frame."""
+        self.request_frame()
+
+    def request_frame(self):
+        """Ask for one frame now. Safe to call from any thread (e.g. the control channel)."""
+        if self.policy != "fixed":
+            FRAME_REQUESTS.inc()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._add_request)
+            else:
+                self._requests += 1
+        return {"policy": self.policy, "frames": self.frames, "saved": round(self.saved)}
+
+    async def wait(self, interval):
+        """
+        Wait until a frame may be captured.
+
+        Returns the seconds the gate was closed (0.0 if it was open). `interval` is
+        the current frame interval, used to count the frames that were saved. Sets
+        `forced` when the frame answers a request or starts a turn (the gate was
+        closed), so the capture paths send it even if nothing changed on screen.
+        """
+        self._bind()
+        start = time.monotonic()
+        self.forced = self._requests > 0 or not self.is_open
+        while not self.is_open:
+            self._wake.clear()
+            await self._wake.wait()
+        idle = time.monotonic() - start
+        if self._requests:
+            self._requests -= 1
+        self.frames += 1
+        if idle and interval:
+            self.saved += idle / interval
+            FRAMES_SAVED.inc(idle / interval)
+        return idle
+
+    async def pause(self, seconds):
+        """Sleep up to `seconds` between frames; a frame request ends the pause at once."""
+        self._bind()
+        deadline = time.monotonic() + seconds
+        while not self._requests:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    def summary(self):
+        total = self.frames + self.saved
+        share = self.saved / total * 100 if total else 0.0
+        return f"Video ({self.policy}): {self.frames} frames captured, {self.saved:.0f} saved ({share:.0f}%)"
+
+    def _bind(self):
+        if self._wake is None:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+
+    def _add_request(self):
+        self._requests += 1
+        self._notify()
+
+    def _notify(self):
+        if self._wake is not None:
+            self._wake.set()
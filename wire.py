@@ -0,0 +1,337 @@
+# wire.py
+
+"""
+Wire encoding for the raw websocket client (`live_api_starter.py`).
+
+A microphone chunk is 512 frames of 16-bit PCM, so the client sends about 31
+realtime messages a second. Building each one as nested dicts and running
+`json.dumps` over it costs more than the base64 of the audio itself. The messages
+have a fixed shape, so the JSON is spliced from prebuilt byte templates instead:
+
+    {"realtime_input":{"media_chunks":[{"mime_type":"audio/pcm","data":"<base64>"}]}}
+    \\_________________ prefix ______/ \\______ chunk head ______/          \\ tail /
+
+The base64 comes straight from the chunk's buffer (bytes, bytearray or memoryview)
+through `binascii.b2a_base64`, and `b"".join` assembles the message in a single
+allocation. The result is ASCII bytes; send it as a text frame:
+
+    await ws.send(wire.realtime_input([{"mime_type": "audio/pcm", "data": pcm}]), text=True)
+
+A chunk whose data is a str is taken to be base64 already and is spliced as is.
+
+Server messages go the other way. Most of them carry nothing but a base64 audio
+part. `decode_server_message` cuts the base64 spans out of the raw message, parses
+the small JSON skeleton that remains, and decodes the audio straight from the
+spans. The document is never materialised with its payload as Python strs. Messages
+it cannot split safely (escapes in a span, "data" keys outside inlineData parts) are
+parsed in full instead.
+
+Each realtime_input message can carry several media chunks. `Batcher` sits between
+the capture queue and the websocket. It packs the chunks that become ready within a
+short window into one message, up to a byte cap:
+
+    batcher = wire.Batcher(out_queue, window=0.05, max_bytes=128 * 1024)
+    while True:
+        chunks = await batcher.next()
+        await ws.send(wire.realtime_input(chunks), text=True)
+
+At 512-frame microphone chunks (one every 32 ms), a 50 ms window halves the number
+of messages, and with it the per-message framing, JSON and send overhead. Each chunk
+waits at most `window` seconds longer.
+
+`python wire.py` benchmarks both directions against plain `json.dumps`/`json.loads`
+and `base64`: messages/second and CPU per second of audio. It then replays a
+simulated microphone and screen through `Batcher` at several windows, reporting
+messages per second of audio and the delay added to each chunk.
+"""
+
+import asyncio
+import binascii
+import collections
+import json
+import re
+
+import bandwidth
+import metrics
+
+_PREFIX = b'{"realtime_input":{"media_chunks":['
+_SUFFIX = b"]}}"
+_CHUNK_TAIL = b'"}'
+_SEPARATOR = b","
+# b'{"mime_type":"audio/pcm","data":"' per MIME type
+_chunk_heads = {}
+
+
+def _chunk_head(mime_type):
+    head = _chunk_heads.get(mime_type)
+    if head is None:
+        head = _chunk_heads[mime_type] = b'{"mime_type":' + json.dumps(mime_type).encode() + b',"data":"'
+    return head
+
+
+def b64(data):
+    """Base64 of `data` as ASCII bytes; str data is taken to be base64 already."""
+    if isinstance(data, str):
+        return data.encode("ascii")
+    return binascii.b2a_base64(data, newline=False)
+
+
+def realtime_input(chunks):
+    """
+    JSON (as ASCII bytes) for a realtime_input message carrying `chunks`.
+
+    Each chunk is a {"mime_type": ..., "data": ...} dict, with raw data in any buffer
+    (bytes, bytearray, memoryview) or a base64 str.
+    """
+    parts = [_PREFIX]
+    for i, chunk in enumerate(chunks):
+        if i:
+            parts.append(_SEPARATOR)
+        parts += (_chunk_head(chunk["mime_type"]), b64(chunk["data"]), _CHUNK_TAIL)
+    parts.append(_SUFFIX)
+    return b"".join(parts)
+
+
+# Seconds to wait for more chunks once the first one of a batch is ready
+BATCH_WINDOW = 0.05
+# Largest batch in bytes on the wire; a chunk that does not fit starts the next one
+BATCH_MAX_BYTES = 128 * 1024
+
+REALTIME_MESSAGES = metrics.REGISTRY.counter(
+    "audioloop_realtime_messages_total",
+    "realtime_input messages sent (each carries one or more of the chunks in audioloop_messages_sent_total).",
+)
+
+
+def chunk_size(chunk):
+    """Bytes `chunk` takes in a realtime_input message."""
+    return len(_chunk_head(chunk["mime_type"])) + bandwidth.wire_size(chunk["data"]) + len(_CHUNK_TAIL)
+
+
+class Batcher:
+    """
+    Packs media chunks from a queue into realtime_input batches.
+
+    Args:
+        queue (asyncio.Queue): Queue of {"mime_type": ..., "data": ...} chunks.
+        window (float): Seconds to wait for more chunks after the first one (0 takes only
+            the chunks already queued).
+        max_bytes (int): Wire bytes per batch. A chunk that would exceed it is held for
+            the next batch; a single larger chunk is sent on its own.
+    """
+
+    def __init__(self, queue, window=BATCH_WINDOW, max_bytes=BATCH_MAX_BYTES):
+        self.queue = queue
+        self.window = window
+        self.max_bytes = max_bytes
+        self._held = None
+
+    async def next(self):
+        """The next batch: a non-empty list of chunks."""
+        if self._held is not None:
+            chunk, self._held = self._held, None
+        else:
+            chunk = await self.queue.get()
+        chunks = [chunk]
+        size = chunk_size(chunk)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while size < self.max_bytes:
+            try:
+                chunk = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    chunk = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            n = chunk_size(chunk)
+            if size + n > self.max_bytes:
+                self._held = chunk
+                break
+            chunks.append(chunk)
+            size += n
+        return chunks
+
+
+# A "data" key and the opening quote of its string value
+_DATA_KEY = re.compile(rb'"data"\s*:\s*"')
+
+ServerMessage = collections.namedtuple("ServerMessage", "message pcm")
+ServerMessage.__doc__ = """A decoded server message: the JSON `message` and its decoded audio parts in `pcm` (a list of bytes)."""
+
+
+def _inline_parts(message):
+    content = message.get("serverContent") if isinstance(message, dict) else None
+    turn = content.get("modelTurn") if isinstance(content, dict) else None
+    parts = turn.get("parts") if isinstance(turn, dict) else None
+    if not isinstance(parts, list):
+        return []
+    return [part["inlineData"] for part in parts if isinstance(part, dict) and isinstance(part.get("inlineData"), dict)]
+
+
+def _is_audio(inline):
+    return str(inline.get("mimeType", "")).startswith("audio/pcm")
+
+
+def decode_server_message(raw):
+    """
+    Decode a server message (bytes or str) into a `ServerMessage`.
+
+    In the skeleton path the inlineData "data" fields of the returned message are
+    empty; read the audio from `pcm`. Non-audio inline data is left in `message`.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode()
+    spans = []
+    key = _DATA_KEY.search(raw)
+    while key:
+        begin = key.end()
+        end = raw.find(b'"', begin)
+        if end < 0 or raw.find(b"\\", begin, end) >= 0:
+            spans = None
+            break
+        spans.append((begin, end))
+        key = _DATA_KEY.search(raw, end)
+    if spans:
+        pieces = []
+        last = 0
+        for begin, end in spans:
+            pieces.append(raw[last:begin])
+            last = end
+        pieces.append(raw[last:])
+        try:
+            message = json.loads(b"".join(pieces))
+        except ValueError:
+            message = None
+        inline = _inline_parts(message) if message is not None else []
+        # Every cut must have been an inlineData "data" field
+        if len(inline) == len(spans) and all(part.get("data") == "" for part in inline):
+            pcm = []
+            with memoryview(raw) as view:
+                for part, (begin, end) in zip(inline, spans):
+                    if _is_audio(part):
+                        pcm.append(binascii.a2b_base64(view[begin:end]))
+                    else:
+                        part["data"] = raw[begin:end].decode("ascii")
+            return ServerMessage(message, pcm)
+    message = json.loads(raw)
+    pcm = [binascii.a2b_base64(part.get("data", "")) for part in _inline_parts(message) if _is_audio(part)]
+    return ServerMessage(message, pcm)
+
+
+def _bench(seconds_of_audio=60):
+    import base64
+    import time
+
+    chunk_size, rate = 512, 16000
+    pcm = bytes(range(256)) * (chunk_size * 2 // 256)
+    view = memoryview(bytearray(pcm * 4))[chunk_size * 2:chunk_size * 4]
+    messages = int(seconds_of_audio * rate / chunk_size)
+
+    def dumps_encoding():
+        msg = {"realtime_input": {"media_chunks": [{"data": base64.b64encode(pcm).decode(), "mime_type": "audio/pcm"}]}}
+        return json.dumps(msg)
+
+    def template_encoding():
+        return realtime_input([{"mime_type": "audio/pcm", "data": pcm}])
+
+    def template_memoryview():
+        return realtime_input([{"mime_type": "audio/pcm", "data": view}])
+
+    assert json.loads(template_encoding()) == json.loads(dumps_encoding())
+    assert json.loads(template_memoryview()) == json.loads(dumps_encoding())
+    print(f"{messages} messages of {chunk_size} frames ({seconds_of_audio} s of audio)")
+    print(f"{'encoding':24} {'messages/s':>12} {'CPU ms per audio s':>19}")
+    for name, encode in (("dicts + json.dumps", dumps_encoding), ("template", template_encoding),
+                         ("template (memoryview)", template_memoryview)):
+        best = None
+        for _ in range(5):
+            start = time.process_time()
+            for _ in range(messages):
+                encode()
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:24} {messages / best:12,.0f} {best / seconds_of_audio * 1000:19.3f}")
+
+    # Server side: 24 kHz audio, ~0.2 s per message
+    reply_pcm = bytes(range(256)) * 38
+    reply_rate = 24000
+    reply = json.dumps({"serverContent": {"modelTurn": {"parts": [
+        {"inlineData": {"mimeType": f"audio/pcm;rate={reply_rate}", "data": base64.b64encode(reply_pcm).decode()}}]}}}).encode()
+    replies = int(seconds_of_audio * reply_rate * 2 / len(reply_pcm))
+
+    def loads_decoding():
+        message = json.loads(reply)
+        return [base64.b64decode(part["inlineData"]["data"]) for part in message["serverContent"]["modelTurn"]["parts"]]
+
+    def skeleton_decoding():
+        return decode_server_message(reply).pcm
+
+    assert loads_decoding() == skeleton_decoding() == [reply_pcm]
+    print()
+    print(f"{replies} server messages of {len(reply_pcm)} bytes ({seconds_of_audio} s of audio)")
+    print(f"{'decoding':24} {'messages/s':>12} {'CPU ms per audio s':>19}")
+    for name, decode in (("json.loads + b64decode", loads_decoding), ("skeleton", skeleton_decoding)):
+        best = None
+        for _ in range(5):
+            start = time.process_time()
+            for _ in range(replies):
+                decode()
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:24} {replies / best:12,.0f} {best / seconds_of_audio * 1000:19.3f}")
+
+
+def _bench_batching(seconds_of_audio=10, speedup=10):
+    """Replays 32 ms microphone chunks and a 60 KB frame per second, `speedup` times faster than real time."""
+    import time
+
+    chunk_interval, frame_interval = 512 / 16000, 1.0
+    pcm = bytes(1024)
+    frame = bytes(60 * 1024)
+
+    async def replay(window):
+        queue = asyncio.Queue(maxsize=5)
+        batcher = Batcher(queue, window / speedup) if window is not None else None
+        sent = []
+
+        async def produce(data, mime_type, interval):
+            start = time.perf_counter()
+            for i in range(int(seconds_of_audio / interval)):
+                await asyncio.sleep(max(0.0, start + i * interval / speedup - time.perf_counter()))
+                await queue.put({"mime_type": mime_type, "data": data, "queued": time.perf_counter()})
+
+        async def consume():
+            while True:
+                chunks = await batcher.next() if batcher else [await queue.get()]
+                now = time.perf_counter()
+                sent.append((len(realtime_input(chunks)), [(now - chunk["queued"]) * speedup for chunk in chunks]))
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.gather(produce(pcm, "audio/pcm", chunk_interval), produce(frame, "image/jpeg", frame_interval))
+        await asyncio.sleep(0.2 / speedup + (window or 0) / speedup)
+        consumer.cancel()
+        return sent
+
+    print()
+    print(f"{seconds_of_audio} s of microphone chunks and one 60 KB frame per second, {speedup}x real time")
+    print(f"{'window':14} {'messages/s':>11} {'chunks/msg':>11} {'framing %':>10} {'added ms p50':>13} {'max':>6}")
+    for window in (None, 0.0, 0.02, 0.05, 0.1):
+        sent = asyncio.run(replay(window))
+        delays = sorted(delay for _, batch in sent for delay in batch)
+        chunks = len(delays)
+        # JSON around the base64 payloads, plus a 14-byte websocket frame header per message
+        payload = sum(bandwidth.wire_size(pcm) for _ in range(int(seconds_of_audio / chunk_interval)))
+        payload += sum(bandwidth.wire_size(frame) for _ in range(int(seconds_of_audio / frame_interval)))
+        framing = sum(size + 14 for size, _ in sent) - payload
+        name = "unbatched" if window is None else f"{window * 1000:.0f} ms"
+        print(f"{name:14} {len(sent) / seconds_of_audio:11.1f} {chunks / len(sent):11.2f} "
+              f"{framing / payload * 100:10.3f} {delays[len(delays) // 2] * 1000:13.1f} {delays[-1] * 1000:6.1f}")
+
+
+if __name__ == "__main__":
+    _bench()
+    _bench_batching()